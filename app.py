@@ -1,11 +1,11 @@
 import os
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, Response, render_template, request, jsonify, session, abort
 import uuid # For generating unique thread IDs
+import secrets
 from pathlib import Path # Added for explicit .env path
 import sqlite3
 import datetime
-import ollama # Added for Ollama integration
 
 # Explicitly load .env from the script's directory or project root
 # This assumes app.py is in the project root directory 'magnus'
@@ -19,7 +19,20 @@ else:
     load_dotenv(override=True)
 
 # Import the chat logic
-from chat import invoke_chat_graph, set_active_llm_provider # Import new function
+from chat import invoke_chat_graph, set_active_llm_provider, generate_conversation_title # Import new function
+from tasks import submit_background_task # Post-response follow-up work
+from sessions import SqliteSessionInterface # Server-side session storage
+from assets import init_assets # Fingerprinted static assets
+from json_responses import init_json_responses # Fast, compressed JSON responses
+from profiling import init_profiling, is_admin_request # On-demand per-request profiles
+import ollama_pool # Load-balanced Ollama hosts
+import memory # Optional retrieval memory over past messages
+from history_io import iter_export # Streaming NDJSON export
+import cancellation # Client-initiated cancellation of in-flight generations
+import markdown_cache # Server-rendered, sanitized markdown for stored AI messages
+import branching # Conversation branches that share their parent's messages
+import db_maintenance # Schema migrations and scheduled vacuum/ANALYZE/checkpoints
+from cancellation import GenerationCancelled
 from langchain_core.messages import HumanMessage, AIMessage # For message type checking
 
 # Load environment variables from .env file
@@ -34,23 +47,69 @@ load_dotenv()
 
 # Initialize Flask app
 app = Flask(__name__)
-app.secret_key = os.urandom(24)  # For session management
 
 DATABASE = Path(__file__).resolve().parent / 'chat_history.db'
+SESSION_DATABASE = Path(__file__).resolve().parent / 'sessions.db'
+SECRET_KEY_FILE = Path(__file__).resolve().parent / '.flask_secret_key'
+
+# Seconds a connection waits on a locked database before giving up (several workers share the file)
+SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', '10'))
+
+def load_secret_key():
+    """Use FLASK_SECRET_KEY, or a key generated once and shared by every worker process."""
+    secret = os.getenv('FLASK_SECRET_KEY')
+    if secret:
+        return secret
+
+    if not SECRET_KEY_FILE.exists():
+        # Write to a temp file and hard-link it into place so concurrent workers agree on one key
+        tmp_path = SECRET_KEY_FILE.with_name(f"{SECRET_KEY_FILE.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(secrets.token_hex(32))
+        try:
+            os.chmod(tmp_path, 0o600)
+            os.link(tmp_path, SECRET_KEY_FILE)
+            app.logger.warning(f"FLASK_SECRET_KEY not set; generated one in {SECRET_KEY_FILE}.")
+        except FileExistsError:
+            pass
+        finally:
+            tmp_path.unlink(missing_ok=True)
+    return SECRET_KEY_FILE.read_text().strip()
+
+app.secret_key = load_secret_key()  # For session management, stable across restarts and workers
+
+# Keep session contents server-side; the cookie only holds a session ID
+app.session_interface = SqliteSessionInterface(SESSION_DATABASE)
+
+# Serve hashed, precompressed static files with long-lived caching
+init_assets(app)
+
+# orjson-backed jsonify plus gzip/brotli for large JSON bodies
+init_json_responses(app)
+
+# cProfile individual requests on demand (X-Profile header + ADMIN_TOKEN) or by sampling
+init_profiling(app)
+
+# How new chats get their title: 'words' (first three words) or 'llm' (short title
+# generated by the active provider in the background)
+TITLE_GENERATION_MODE = os.getenv('TITLE_GENERATION_MODE', 'words').lower()
 
 # --- Database Helper Functions ---
 def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
+    conn = sqlite3.connect(DATABASE, timeout=SQLITE_BUSY_TIMEOUT)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA synchronous = NORMAL") # Safe with WAL, avoids an fsync per commit
     return conn
 
-def init_db():
+def ensure_database():
+    """Create or migrate the schema and switch the file to WAL so readers don't block the writer."""
     conn = get_db_connection()
-    with open(Path(__file__).resolve().parent / 'schema.sql', 'r') as f:
-        conn.executescript(f.read())
-    conn.commit()
-    conn.close()
-    app.logger.info("Database initialized.")
+    try:
+        db_maintenance.migrate(conn)
+        journal_mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0] # Persistent, stored in the file
+        if journal_mode.lower() != 'wal':
+            app.logger.warning(f"Could not enable WAL mode, journal_mode is '{journal_mode}'.")
+    finally:
+        conn.close()
 
 def add_conversation_to_db(thread_id, title, icon):
     conn = get_db_connection()
@@ -84,31 +143,121 @@ def add_message_to_db(conversation_id, sender_type, content, sequence):
     conn.commit()
     conn.close()
 
-def get_messages_from_db(conversation_id):
+def save_chat_turn_to_db(conversation_id, messages, new_conversation=None):
+    """Write a chat turn in one transaction.
+
+    messages is a list of (sender_type, content, sequence) tuples. new_conversation is an
+    optional (title, icon) pair, or (title, icon, parent_id, fork_sequence) for a branch;
+    when given the conversation row is inserted first.
+    Returns the stored rows as dicts (with their generated message IDs).
+    """
+    rows = [
+        {'message_id': str(uuid.uuid4()), 'conversation_id': conversation_id, 'sender_type': sender_type, 'content': content, 'sequence': sequence}
+        for sender_type, content, sequence in messages
+    ]
     conn = get_db_connection()
-    messages_cursor = conn.execute(
-        "SELECT sender_type, content FROM messages WHERE conversation_id = ? ORDER BY sequence ASC",
-        (conversation_id,)
-    )
-    messages = [{'type': row['sender_type'], 'content': row['content']} for row in messages_cursor.fetchall()]
+    try:
+        with conn:
+            if new_conversation:
+                title, icon, parent_id, fork_sequence = (*new_conversation, None, None)[:4]
+                conn.execute(
+                    "INSERT INTO conversations (id, title, icon, updated_at, is_pinned, parent_id, fork_sequence) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (conversation_id, title, icon, datetime.datetime.now(datetime.timezone.utc), 0, parent_id, fork_sequence)
+                )
+            conn.executemany(
+                "INSERT INTO messages (id, conversation_id, sender_type, content, sequence) VALUES (?, ?, ?, ?, ?)",
+                [(r['message_id'], conversation_id, r['sender_type'], r['content'], r['sequence']) for r in rows]
+            )
+    finally:
+        conn.close()
+    return rows
+
+def get_messages_from_db(conversation_id, upto=None):
+    """The full history of a conversation (branches include what they inherit), optionally up to a sequence.
+
+    Plain text only: this is what the model is sent, so it never pays for rendered HTML.
+    """
+    conn = get_db_connection()
+    messages = [{'type': row['sender_type'], 'content': row['content'], 'sequence': row['sequence']} for row in branching.get_history(conn, conversation_id, upto)]
     conn.close()
     return messages
 
+def get_display_messages_from_db(conversation_id):
+    """The history as the page shows it: AI messages carry their rendered HTML when the cache is on."""
+    if markdown_cache.MARKDOWN_RENDER_ENABLED:
+        return markdown_cache.get_messages_with_html(get_db_connection, conversation_id)
+    return [{'type': m['type'], 'content': m['content']} for m in get_messages_from_db(conversation_id)]
+
+def get_memory_scope(conversation_id, upto, stored_messages, total_messages):
+    """Where retrieval finds the stored messages that stay in the prompt verbatim.
+
+    stored_messages come from get_messages_from_db(conversation_id, upto); total_messages
+    also counts the new prompt. Branch histories are read from their ancestors' rows and
+    their sequences needn't match positions, so both come from the stored rows.
+    """
+    if memory.memory_index is None or not stored_messages:
+        return None
+    recent_start = max(total_messages - memory.MEMORY_RECENT_MESSAGES, 0)
+    recent_from = stored_messages[recent_start]['sequence'] if recent_start < len(stored_messages) else None
+    conn = get_db_connection()
+    try:
+        segments = branching.get_history_segments(conn, conversation_id, upto)
+    finally:
+        conn.close()
+    return {'segments': segments, 'recent_from': recent_from}
+
+def make_conversation_version(message_count, last_sequence):
+    # Messages are only ever appended, so count plus last sequence changes on every write.
+    # The renderer tag makes client copies with HTML from an older renderer stale as well.
+    version = f"{message_count}.{last_sequence}"
+    return f"{version}.{markdown_cache.RENDERER_TAG}" if markdown_cache.RENDERER_TAG else version
+
+def get_conversation_versions(thread_ids):
+    """Map thread IDs to their current version (None for conversations that don't exist)."""
+    versions = dict.fromkeys(thread_ids)
+    if not thread_ids:
+        return versions
+    conn = get_db_connection()
+    try:
+        # One query for every thread; branches include the messages they inherit
+        for thread_id, (message_count, last_sequence) in branching.count_histories(conn, list(thread_ids)).items():
+            versions[thread_id] = make_conversation_version(message_count, -1 if last_sequence is None else last_sequence)
+    finally:
+        conn.close()
+    return versions
+
 def get_all_conversations_from_db():
     conn = get_db_connection()
     # Order by is_pinned (descending, so pinned are first), then by updated_at (descending)
-    conv_cursor = conn.execute("SELECT id, title, icon, is_pinned FROM conversations ORDER BY is_pinned DESC, updated_at DESC")
-    conversations = [{'thread_id': row['id'], 'title': row['title'], 'icon': row['icon'], 'is_pinned': bool(row['is_pinned'])} for row in conv_cursor.fetchall()]
+    conv_cursor = conn.execute("SELECT id, title, icon, is_pinned, parent_id FROM conversations ORDER BY is_pinned DESC, updated_at DESC")
+    conversations = [{'thread_id': row['id'], 'title': row['title'], 'icon': row['icon'], 'is_pinned': bool(row['is_pinned']), 'parent_id': row['parent_id']} for row in conv_cursor.fetchall()]
     conn.close()
     return conversations
 
 def get_last_message_sequence(conversation_id):
     conn = get_db_connection()
-    cursor = conn.execute("SELECT MAX(sequence) as last_sequence FROM messages WHERE conversation_id = ?", (conversation_id,))
+    # A branch without messages of its own continues from its fork point
+    cursor = conn.execute(
+        "SELECT COALESCE((SELECT MAX(sequence) FROM messages WHERE conversation_id = ?), "
+        "(SELECT fork_sequence FROM conversations WHERE id = ?)) as last_sequence",
+        (conversation_id, conversation_id)
+    )
     result = cursor.fetchone()
     conn.close()
     return result['last_sequence'] if result and result['last_sequence'] is not None else -1
 
+def replace_placeholder_title(thread_id, title, icon):
+    """Give a chat still called NEW_CHAT_PLACEHOLDER_TITLE its real title. Returns True if it did."""
+    conn = get_db_connection()
+    try:
+        with conn:
+            return conn.execute(
+                "UPDATE conversations SET title = ?, icon = ? WHERE id = ? AND title = ?",
+                (title, icon, thread_id, NEW_CHAT_PLACEHOLDER_TITLE)
+            ).rowcount == 1
+    finally:
+        conn.close()
+
 def update_conversation_updated_at(thread_id):
     conn = get_db_connection()
     conn.execute(
@@ -121,11 +270,17 @@ def update_conversation_updated_at(thread_id):
 def delete_conversation_from_db(thread_id):
     conn = get_db_connection()
     try:
+        # Branches keep what they inherited from this conversation
+        copied_messages = branching.detach_branches(conn, thread_id)
+        markdown_cache.forget_conversation(conn, thread_id)
         # Delete messages associated with the conversation
         conn.execute("DELETE FROM messages WHERE conversation_id = ?", (thread_id,))
         # Delete the conversation itself
         conn.execute("DELETE FROM conversations WHERE id = ?", (thread_id,))
         conn.commit()
+        memory.forget_conversation(thread_id)
+        if copied_messages and memory.memory_index is not None:
+            submit_background_task(memory.index_messages, copied_messages)
         app.logger.info(f"Conversation {thread_id} and its messages deleted from DB.")
     except Exception as e:
         app.logger.error(f"Error deleting conversation {thread_id}: {e}")
@@ -172,28 +327,71 @@ def toggle_pin_conversation_in_db(thread_id):
         conn.close()
 
 
-# Initialize DB if it doesn't exist or schema is not applied
-if not DATABASE.exists():
-    init_db()
-else: # Basic check if tables exist, can be more robust
-    conn = get_db_connection()
-    try:
-        conn.execute("SELECT 1 FROM conversations LIMIT 1")
-        conn.execute("SELECT 1 FROM messages LIMIT 1")
-    except sqlite3.OperationalError:
-        app.logger.warning("Database tables not found, re-initializing.")
-        init_db() # Re-initialize if tables are missing
-    finally:
-        conn.close()
+# Create the database, or bring an existing one up to the current schema version
+ensure_database()
+
+# Incremental vacuum, ANALYZE, WAL checkpoints and integrity checks while the app is idle
+db_maintenance.init_maintenance(app, DATABASE)
+
+# Cancellations are shared through the chat database so any worker can stop a generation
+cancellation.init_cancellation(DATABASE)
+
+# Ollama requests in flight are counted in the chat database too, so every worker balances on the same load
+ollama_pool.init_shared_load(DATABASE)
+
+# Rendered-HTML side table for stored AI messages (if markdown-it-py and nh3 are installed)
+markdown_cache.init_markdown_cache(DATABASE)
+
+# Load the retrieval index (if enabled); each process indexes anything stored before it
+# existed once it starts serving, so a preloaded gunicorn master never embeds before forking
+if memory.init_memory(DATABASE) is not None:
+    app.before_request(lambda: memory.start_backfill(get_db_connection))
 
 
 # --- Helper for chat icons ---
 CHAT_ICONS = ['📄', '💡', '⚙️', '💬', '🧠', '🚀', '✨']
 NEW_CHAT_PLACEHOLDER_ICON = '📝' # Placeholder for new, un-messaged chats
+NEW_CHAT_PLACEHOLDER_TITLE = 'New Conversation'
 
 def get_next_icon(current_icon_index):
     return CHAT_ICONS[current_icon_index % len(CHAT_ICONS)]
 
+def make_title_from_message(user_message_text):
+    words = user_message_text.split(' ')
+    return ' '.join(words[:3]) or "Chat"
+
+# --- Background follow-up tasks ---
+# These run on the task queue after the response is sent, so they must not touch
+# `session` or the request; everything they need is passed in.
+def persist_user_message_task(thread_id, user_message_text, sequence, new_conversation=None):
+    """Keep the user's message when generation failed, as if it had been stored up front."""
+    save_chat_turn_to_db(thread_id, [('human', user_message_text, sequence)], new_conversation=new_conversation)
+
+def refresh_conversation_title_task(thread_id, user_message_text, expected_title, provider, model_name, api_key=None):
+    """Replace the word-based title with an LLM-generated one, unless the user renamed the chat in the meantime.
+
+    provider, model_name and api_key are the requesting user's, captured when the task was
+    submitted; chat's globals may belong to another request by the time this runs.
+    """
+    conn = get_db_connection()
+    try:
+        row = conn.execute("SELECT title FROM conversations WHERE id = ?", (thread_id,)).fetchone()
+        if row is None or row['title'] != expected_title:
+            return
+
+        new_title = generate_conversation_title(user_message_text, provider, model_name, api_key=api_key)
+        if not new_title:
+            return  # Keep the word-based title
+
+        conn.execute(
+            "UPDATE conversations SET title = ? WHERE id = ? AND title = ?",
+            (new_title, thread_id, expected_title)
+        )
+        conn.commit()
+        app.logger.info(f"🏷️ Conversation {thread_id} titled '{new_title}' in background.")
+    finally:
+        conn.close()
+
 # --- Flask Routes ---
 
 @app.route('/')
@@ -201,7 +399,6 @@ def index():
     session.setdefault('icon_index', -1) 
     
     db_conversations = get_all_conversations_from_db()
-    session['chats'] = db_conversations
 
     active_thread_id = None
     if db_conversations:
@@ -218,15 +415,15 @@ def index():
 
     # Get current active model info
     try:
-        from chat import ACTIVE_PROVIDER, GEMINI_MODEL_NAME, OLLAMA_MODEL_NAME
+        from chat import ACTIVE_PROVIDER, GEMINI_MODEL_NAME, OLLAMA_MODEL_NAME, REPLAY_CASSETTE_NAME
         current_provider = ACTIVE_PROVIDER
-        current_model = GEMINI_MODEL_NAME if ACTIVE_PROVIDER == 'gemini' else OLLAMA_MODEL_NAME
+        current_model = {'gemini': GEMINI_MODEL_NAME, 'replay': REPLAY_CASSETTE_NAME}.get(ACTIVE_PROVIDER, OLLAMA_MODEL_NAME)
     except:
         current_provider = 'gemini'
         current_model = 'gemini-1.5-flash'
 
     return render_template('index.html', 
-                           initial_chats=session.get('chats', []), 
+                           initial_chats=db_conversations, 
                            initial_active_thread_id=active_thread_id,
                            current_provider=current_provider,
                            current_model=current_model)
@@ -248,23 +445,61 @@ def switch_chat():
     session['current_thread_id'] = target_thread_id
     
     all_db_conversations = get_all_conversations_from_db()
-    session['chats'] = all_db_conversations
 
-    history_messages = get_messages_from_db(target_thread_id)
+    response_data = {
+        'chats': all_db_conversations,
+        'active_thread_id': target_thread_id,
+        'version': get_conversation_versions([target_thread_id])[target_thread_id],
+    }
+    # The client sends the version of its cached copy; skip the messages if it's current
+    known_version = data.get('known_version')
+    if known_version and known_version == response_data['version']:
+        response_data['not_modified'] = True
+    else:
+        response_data['messages'] = get_display_messages_from_db(target_thread_id)
 
-    return jsonify({
-        'messages': history_messages, 
-        'chats': session['chats'],
-        'active_thread_id': target_thread_id
-    })
+    return jsonify(response_data)
+
+MAX_VERSION_CHECK_THREADS = 100
+
+@app.route('/chats', methods=['GET'])
+def chats_route():
+    """The sidebar's chat list; polled by the page while a generated title is pending."""
+    return jsonify({'chats': get_all_conversations_from_db()})
+
+@app.route('/chat_versions', methods=['POST'])
+def chat_versions_route():
+    """Cheap freshness check for client-cached conversations."""
+    thread_ids = (request.get_json(silent=True) or {}).get('thread_ids') or []
+    if not isinstance(thread_ids, list):
+        return jsonify({'error': 'thread_ids must be a list'}), 400
+    return jsonify({'versions': get_conversation_versions([str(t) for t in thread_ids[:MAX_VERSION_CHECK_THREADS]])})
+
+@app.route('/chat_messages/<thread_id>', methods=['GET'])
+def chat_messages_route(thread_id):
+    """A conversation's messages without making it the active one (used for prefetching)."""
+    version = get_conversation_versions([thread_id])[thread_id]
+    if version is None:
+        return jsonify({'error': 'Conversation not found'}), 404
+    return jsonify({'thread_id': thread_id, 'version': version, 'messages': get_display_messages_from_db(thread_id)})
 
 
 @app.route('/chat', methods=['POST'])
 def chat_route(): 
     user_message_text = request.json.get('message', '')
     requested_thread_id = request.json.get('thread_id')
-
-    app.logger.info(f"📝 Received chat request. Message: {user_message_text[:100]}...")
+    request_id = request.json.get('request_id') # Lets the client cancel this generation via /cancel
+    return run_chat_turn(user_message_text, requested_thread_id, request_id)
+
+def run_chat_turn(user_message_text, requested_thread_id, request_id, branch=None):
+    """Generate a reply and store the turn; shared by /chat, /regenerate and /edit_message.
+
+    branch is an optional (parent_id, fork_sequence, title) tuple: the turn then starts a
+    new branch of parent_id that inherits its messages up to fork_sequence. With
+    user_message_text None, the inherited history must end with a user message, and only
+    a new reply to it is generated (regenerate).
+    """
+    app.logger.info(f"📝 Received chat request. Message: {(user_message_text or '(regenerate)')[:100]}...")
     app.logger.info(f"🔖 Thread ID: {requested_thread_id if requested_thread_id else 'NEW THREAD'}")
 
     # Consolidate provider management
@@ -282,40 +517,67 @@ def chat_route():
         if not active_model_name:
             return jsonify({'error': 'Ollama model not selected.'}), 500
         set_active_llm_provider(provider='ollama', model_name=active_model_name)
+    elif active_provider == 'replay':
+        if not set_active_llm_provider(provider='replay', model_name=active_model_name):
+            return jsonify({'error': f'Replay cassette {active_model_name!r} could not be loaded.'}), 500
     else:
         return jsonify({'error': 'AI provider misconfiguration.'}), 500
     
     is_newly_created = False
-    title_updated = False
+    new_conversation = None
     
-    if requested_thread_id is None:
+    if branch is not None:
+        is_newly_created = True
+        thread_id = str(uuid.uuid4())
+        session['current_thread_id'] = thread_id
+        parent_id, fork_sequence, branch_title = branch
+        app.logger.info(f"🌿 Branching {parent_id} after sequence {fork_sequence} into {thread_id}")
+
+        # Written together with the first turn, like a new conversation
+        new_conversation = (branch_title, branching.BRANCH_ICON, parent_id, fork_sequence)
+    elif requested_thread_id is None:
         is_newly_created = True
         thread_id = str(uuid.uuid4())
         session['current_thread_id'] = thread_id
         app.logger.info(f"🆕 Created new thread with ID: {thread_id}")
 
-        words = user_message_text.split(' ')
-        new_title = ' '.join(words[:3]) or "Chat"
+        new_title = make_title_from_message(user_message_text)
         
         session['icon_index'] = session.get('icon_index', -1) + 1
         new_icon = get_next_icon(session['icon_index'])
         
-        add_conversation_to_db(thread_id, new_title, new_icon)
+        # The conversation row is written together with the first turn, after generation
+        new_conversation = (new_title, new_icon)
     else:
         thread_id = requested_thread_id
         session['current_thread_id'] = thread_id
 
     response_data = {}
+    user_message_sequence = None
+    turn_stored = False
     try:
-        # Store user message
-        last_sequence = get_last_message_sequence(thread_id)
-        user_message_sequence = last_sequence + 1
-        add_message_to_db(thread_id, 'human', user_message_text, user_message_sequence)
-        app.logger.info(f"💾 Stored user message in DB with sequence: {user_message_sequence}")
-
-        # Get full history for LangGraph
-        db_messages_for_graph = get_messages_from_db(thread_id)
+        # Build history from what's stored plus the new user message; nothing is written yet
+        if branch is not None:
+            user_message_sequence = branch[1] + 1
+            db_messages_for_graph = get_messages_from_db(branch[0], upto=branch[1])
+        elif is_newly_created:
+            user_message_sequence = 0
+            db_messages_for_graph = []
+        else:
+            user_message_sequence = get_last_message_sequence(thread_id) + 1
+            db_messages_for_graph = get_messages_from_db(thread_id)
+        stored_message_count = len(db_messages_for_graph)
+        base_version = None if is_newly_created else make_conversation_version(stored_message_count, user_message_sequence - 1)
+        if user_message_text is not None:
+            db_messages_for_graph.append({'type': 'human', 'content': user_message_text})
+            turn_messages = [('human', user_message_text, user_message_sequence)]
+            reply_sequence = user_message_sequence + 1
+        else:
+            turn_messages = [] # Regenerating: the prompt is already stored (inherited)
+            reply_sequence = user_message_sequence
         app.logger.info(f"📚 Retrieved message history from DB. Message count: {len(db_messages_for_graph)}")
+        memory_scope = get_memory_scope(branch[0] if branch is not None else thread_id, branch[1] if branch is not None else None,
+                                        db_messages_for_graph[:stored_message_count], len(db_messages_for_graph))
         
         langchain_history = []
         for msg in db_messages_for_graph:
@@ -325,11 +587,27 @@ def chat_route():
                 langchain_history.append(AIMessage(content=msg['content']))
 
         app.logger.info(f"🔄 Invoking chat graph with {len(langchain_history)} messages")
-        ai_response_content = invoke_chat_graph(langchain_history)
+        cancellation.register_request(request_id)
+        try:
+            ai_response_content = invoke_chat_graph(langchain_history, thread_id=thread_id, request_id=request_id, memory_scope=memory_scope)
+        except GenerationCancelled:
+            if is_newly_created:
+                # The client aborted its fetch and never learns the new thread's ID, so a
+                # stored prompt would only be an orphan chat; nothing is written for it
+                session['current_thread_id'] = requested_thread_id if branch is None else branch[0]
+                return jsonify({'cancelled': True, 'thread_id': None}), 499
+            # Keep the user's message, as when generation fails; there's no reply to store
+            if user_message_text is not None:
+                submit_background_task(persist_user_message_task, thread_id, user_message_text, user_message_sequence)
+            return jsonify({'cancelled': True, 'thread_id': thread_id}), 499
+        finally:
+            cancellation.finish_request(request_id)
         app.logger.info(f"📥 Received response from chat graph. Length: {len(ai_response_content)}")
         
         if "Error:" in ai_response_content or "Sorry, I encountered an error" in ai_response_content:
             app.logger.error(f"❌ Error in AI response: {ai_response_content}")
+            if user_message_text is not None:
+                submit_background_task(persist_user_message_task, thread_id, user_message_text, user_message_sequence, new_conversation)
             return jsonify({'error': ai_response_content})
         
         # Handle thinking content
@@ -352,10 +630,19 @@ def chat_route():
         except Exception as e:
             app.logger.warning(f"❌ Error parsing thinking response: {e}")
         
-        # Store AI message
-        add_message_to_db(thread_id, 'ai', final_content, user_message_sequence + 1)
-        app.logger.info(f"💾 Stored AI response in DB with sequence: {user_message_sequence + 1}")
+        # Store user and AI messages (and the conversation, if new) in a single write
+        stored_messages = save_chat_turn_to_db(
+            thread_id,
+            turn_messages + [('ai', final_content, reply_sequence)],
+            new_conversation=new_conversation
+        )
+        turn_stored = True
+        app.logger.info(f"💾 Stored chat turn in DB with sequences: {user_message_sequence}, {reply_sequence}")
         
+        # Lets the client extend its cached copy of the thread instead of refetching it
+        response_data['base_version'] = base_version
+        response_data['version'] = make_conversation_version(stored_message_count + len(stored_messages), reply_sequence)
+
         if thinking_content:
             app.logger.info("📦 Preparing response with thinking content")
             response_data['response'] = final_content
@@ -365,26 +652,40 @@ def chat_route():
             app.logger.info("📦 Preparing standard response (no thinking)")
             response_data['response'] = final_content
         
-        if not is_newly_created:
-            update_conversation_updated_at(thread_id)
-
-        # Check for title update
-        if not is_newly_created:
-            active_chat_from_db = next((c for c in get_all_conversations_from_db() if c['thread_id'] == thread_id), None)
-            if active_chat_from_db and active_chat_from_db['title'] == 'New Conversation':
-                if user_message_text: 
-                    words = user_message_text.split(' ')
-                    updated_title = ' '.join(words[:3]) or "Chat"
-                    
-                    session['icon_index'] = session.get('icon_index', -1) + 1
-                    updated_icon = get_next_icon(session['icon_index'])
-                    
-                    update_conversation_in_db(thread_id, updated_title, updated_icon)
-                    title_updated = True
-
-        if is_newly_created or title_updated:
-            session['chats'] = get_all_conversations_from_db()
-            response_data['chats'] = session['chats']
+        # Non-critical follow-ups run after the response is sent
+        if memory.memory_index is not None and active_provider != 'replay':
+            # Replay runs stay offline; the backfill indexes these when the app next starts
+            submit_background_task(memory.index_messages, stored_messages)
+        if markdown_cache.MARKDOWN_RENDER_ENABLED:
+            # Ready before the thread is next opened
+            submit_background_task(markdown_cache.render_and_store, get_db_connection,
+                                   [(m['message_id'], m['content']) for m in stored_messages if m['sender_type'] == 'ai'])
+        # A chat created empty from the sidebar gets its word-based title now, so the
+        # response can show it; an LLM title replaces it later (the page polls /chats)
+        word_title = None
+        if is_newly_created:
+            if branch is None:
+                word_title = new_conversation[0]
+        else:
+            submit_background_task(update_conversation_updated_at, thread_id)
+            if user_message_text:
+                candidate_title = make_title_from_message(user_message_text)
+                icon_index = session.get('icon_index', -1) + 1
+                if replace_placeholder_title(thread_id, candidate_title, get_next_icon(icon_index)):
+                    session['icon_index'] = icon_index # Only advance (and dirty the session) when the icon was used
+                    word_title = candidate_title
+        if word_title and TITLE_GENERATION_MODE == 'llm':
+            # Capture this request's provider settings now; the task runs after other requests
+            from chat import GEMINI_MODEL_NAME, OLLAMA_MODEL_NAME
+            if active_provider == 'gemini':
+                title_llm = ('gemini', GEMINI_MODEL_NAME, gemini_api_key_for_session)
+            else:
+                title_llm = (active_provider, OLLAMA_MODEL_NAME if active_provider == 'ollama' else None, None)
+            submit_background_task(refresh_conversation_title_task, thread_id, user_message_text, word_title, *title_llm)
+            response_data['title_pending'] = True
+
+        if is_newly_created or word_title:
+            response_data['chats'] = get_all_conversations_from_db()
             response_data['active_thread_id'] = thread_id 
             if is_newly_created:
                 response_data['newly_created_thread_id'] = thread_id
@@ -393,8 +694,82 @@ def chat_route():
             
     except Exception as e:
         app.logger.error(f"❌ Error in /chat route: {e}", exc_info=True)
+        if not turn_stored and user_message_text is not None and user_message_sequence is not None:
+            submit_background_task(persist_user_message_task, thread_id, user_message_text, user_message_sequence, new_conversation)
         return jsonify({'error': f'An unexpected server error occurred: {str(e)}'}), 500
 
+def find_branch_point(thread_id, index, sender_type, content=None):
+    """Locate the message a regenerate/edit request refers to.
+
+    index is the message's position in the thread as the page shows it. The page may also
+    show unsaved messages (e.g. errors), so if the message there doesn't match, the closest
+    earlier one with the same type and content is used. Returns (history rows, position,
+    conversation title), or None if there is no such message.
+    """
+    conn = get_db_connection()
+    try:
+        conversation = conn.execute("SELECT title FROM conversations WHERE id = ?", (thread_id,)).fetchone()
+        if conversation is None:
+            return None
+        history = branching.get_history(conn, thread_id)
+    finally:
+        conn.close()
+    start = len(history) - 1 if index is None else min(index, len(history) - 1)
+    for position in range(start, -1, -1):
+        row = history[position]
+        if row['sender_type'] == sender_type and (content is None or row['content'] == content):
+            return history, position, conversation['title']
+    return None
+
+@app.route('/regenerate', methods=['POST'])
+def regenerate_route():
+    """Answer a stored prompt again in a new branch; the original reply stays in its thread."""
+    data = request.get_json(silent=True) or {}
+    thread_id = data.get('thread_id')
+    if not thread_id:
+        return jsonify({'error': 'Thread ID missing'}), 400
+    if not isinstance(data.get('index'), (int, type(None))):
+        return jsonify({'error': 'index must be an integer'}), 400
+    found = find_branch_point(thread_id, data.get('index'), 'ai', data.get('content'))
+    if found is None:
+        return jsonify({'error': 'Message not found'}), 404
+    history, position, title = found
+    if position == 0 or history[position - 1]['sender_type'] != 'human':
+        return jsonify({'error': 'Only a reply to a prompt can be regenerated'}), 400
+    # The branch inherits everything up to and including the prompt
+    branch = (thread_id, history[position - 1]['sequence'], branching.branch_title(title))
+    return run_chat_turn(None, thread_id, data.get('request_id'), branch=branch)
+
+@app.route('/edit_message', methods=['POST'])
+def edit_message_route():
+    """Send an edited version of an earlier prompt in a new branch; the original stays in its thread."""
+    data = request.get_json(silent=True) or {}
+    thread_id = data.get('thread_id')
+    new_text = (data.get('message') or '').strip()
+    if not thread_id or not new_text:
+        return jsonify({'error': 'Thread ID or message missing'}), 400
+    if not isinstance(data.get('index'), (int, type(None))):
+        return jsonify({'error': 'index must be an integer'}), 400
+    found = find_branch_point(thread_id, data.get('index'), 'human', data.get('content'))
+    if found is None:
+        return jsonify({'error': 'Message not found'}), 404
+    history, position, title = found
+    # The branch inherits everything before the edited prompt
+    fork_sequence = history[position - 1]['sequence'] if position > 0 else -1
+    return run_chat_turn(new_text, thread_id, data.get('request_id'), branch=(thread_id, fork_sequence, branching.branch_title(title)))
+
+@app.route('/cancel', methods=['POST'])
+def cancel_route():
+    """Stop an in-flight /chat generation. Also sent with navigator.sendBeacon when the page is left."""
+    data = request.get_json(force=True, silent=True) or {}
+    request_id = data.get('request_id')
+    if not request_id:
+        return jsonify({'error': 'Missing request_id'}), 400
+
+    handled_here = cancellation.cancel_request(request_id)
+    app.logger.info(f"🛑 Cancel requested for {request_id} ({'this worker' if handled_here else 'shared'})")
+    return jsonify({'cancelled': True})
+
 @app.route('/rename_chat', methods=['POST'])
 def rename_chat_route():
     data = request.get_json()
@@ -407,7 +782,6 @@ def rename_chat_route():
     rename_conversation_in_db(thread_id, new_title)
     
     updated_chats = get_all_conversations_from_db()
-    session['chats'] = updated_chats
 
     return jsonify({
         'message': 'Chat renamed successfully',
@@ -428,7 +802,6 @@ def toggle_pin_chat_route():
         return jsonify({'error': 'Failed to toggle pin status'}), 500
     
     updated_chats = get_all_conversations_from_db()
-    session['chats'] = updated_chats
 
     return jsonify({
         'message': 'Chat pin status toggled successfully',
@@ -447,7 +820,6 @@ def delete_chat_route():
     delete_conversation_from_db(thread_id_to_delete)
 
     remaining_chats = get_all_conversations_from_db()
-    session['chats'] = remaining_chats
 
     new_active_thread_id = session.get('current_thread_id')
 
@@ -469,14 +841,15 @@ def delete_all_chats_route():
     """Delete all conversations and messages from the database"""
     conn = get_db_connection()
     try:
+        markdown_cache.clear(conn)
         # Delete all messages first (due to foreign key constraint)
         conn.execute("DELETE FROM messages")
         # Delete all conversations
         conn.execute("DELETE FROM conversations")
         conn.commit()
+        memory.clear_index()
         
         # Clear session data
-        session.pop('chats', None)
         session.pop('current_thread_id', None)
         session['icon_index'] = -1
         
@@ -490,78 +863,62 @@ def delete_all_chats_route():
     finally:
         conn.close()
 
+@app.route('/export', methods=['GET'])
+def export_route():
+    """Stream all conversations (or those given as ?thread_id=...) as NDJSON."""
+    conversation_ids = request.args.getlist('thread_id') or None
+    filename = f"chat_history-{datetime.datetime.now(datetime.timezone.utc):%Y%m%d-%H%M%S}.ndjson"
+    return Response(
+        iter_export(get_db_connection, conversation_ids),
+        mimetype='application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"', 'Cache-Control': 'no-store'}
+    )
+
 @app.route('/get_ollama_models', methods=['GET'])
 def get_ollama_models_route():
-    models_data_raw_response = None
-    client_used_desc = "None"
-
+    if ollama_pool.pool is None:
+        return jsonify({'error': 'Could not connect to Ollama: no hosts configured'}), 500
     try:
-        client_default = ollama.Client()
-        models_data_raw_response = client_default.list()
-        client_used_desc = "Default ollama.Client()"
-        app.logger.info(f"Raw response object from {client_used_desc}: {models_data_raw_response}")
-
-        if (not models_data_raw_response or not models_data_raw_response.get('models')) and os.getenv('OLLAMA_HOST'):
-            ollama_host_env = os.getenv('OLLAMA_HOST')
-            app.logger.info(f"{client_used_desc} returned no models. OLLAMA_HOST ('{ollama_host_env}') is set. Retrying with explicit host.")
-            client_explicit_env = ollama.Client(host=ollama_host_env)
-            models_data_raw_response = client_explicit_env.list()
-            client_used_desc = f"ollama.Client(host='{ollama_host_env}') from OLLAMA_HOST"
-            app.logger.info(f"Raw response object from {client_used_desc}: {models_data_raw_response}")
-
-        if (not models_data_raw_response or not models_data_raw_response.get('models')):
-            hardcoded_host = 'http://localhost:11434'
-            if os.getenv('OLLAMA_HOST') != hardcoded_host:
-                app.logger.info(f"{client_used_desc} returned no models. Retrying with hardcoded host: {hardcoded_host}.")
-                client_hardcoded = ollama.Client(host=hardcoded_host)
-                models_data_raw_response = client_hardcoded.list()
-                client_used_desc = f"ollama.Client(host='{hardcoded_host}')"
-                app.logger.info(f"Raw response object from {client_used_desc}: {models_data_raw_response}")
-            else:
-                app.logger.info(f"{client_used_desc} returned no models. Hardcoded host '{hardcoded_host}' was already tried via OLLAMA_HOST or default.")
-        
         models_list = []
-        if models_data_raw_response and 'models' in models_data_raw_response and isinstance(models_data_raw_response['models'], list):
-            actual_model_objects_list = models_data_raw_response['models']
-            app.logger.info(f"Actual list of model objects from Ollama: {actual_model_objects_list}")
-            for model_obj in actual_model_objects_list:
-                try:
-                    modified_at_str = model_obj.modified_at.isoformat() if hasattr(model_obj, 'modified_at') and model_obj.modified_at else None
-                    
-                    model_name_attr = getattr(model_obj, 'model', None)
-                    if not model_name_attr:
-                        app.logger.warning(f"Model object missing 'model' attribute: {model_obj}")
-                        continue
-
-                    models_list.append({
-                        'name': model_name_attr,
-                        'modified_at': modified_at_str,
-                        'size': getattr(model_obj, 'size', None)
-                    })
-                except AttributeError as ae:
-                    app.logger.warning(f"Skipping model entry due to AttributeError: {model_obj}. Error: {ae}")
-                except Exception as e_inner:
-                    app.logger.warning(f"Skipping model entry {getattr(model_obj, 'model', 'Unknown Model')} due to other error: {e_inner}. Object: {model_obj}")
+        for model_name, model_obj, host_names in ollama_pool.pool.list_models(refresh=True):
+            modified_at_str = model_obj.modified_at.isoformat() if getattr(model_obj, 'modified_at', None) else None
+            models_list.append({
+                'name': getattr(model_obj, 'model', None) or model_name,
+                'modified_at': modified_at_str,
+                'size': getattr(model_obj, 'size', None),
+                'hosts': host_names
+            })
+
+        if not models_list and not any(host.healthy for host in ollama_pool.pool.hosts):
+            errors = '; '.join(f"{host.name}: {host.last_error}" for host in ollama_pool.pool.hosts)
+            app.logger.error(f"No Ollama host is reachable ({errors})")
+            return jsonify({'error': f'Could not connect to Ollama: {errors}'}), 500
 
-        else:
-            app.logger.warning(f"No 'models' key found in Ollama response (using {client_used_desc}) or it's not a list. Full response: {models_data_raw_response}")
-            
         app.logger.info(f"Processed models_list to be sent to client: {models_list}")
         return jsonify({'models': models_list})
 
-    except ollama.ResponseError as e:
-        app.logger.error(f"Ollama ResponseError while trying to list models with {client_used_desc}: {str(e)}. Status code: {e.status_code}", exc_info=True)
-        return jsonify({'error': f'Ollama API error: {str(e)} (Status: {e.status_code})'}), 500
-    except ollama.RequestError as e:
-        app.logger.error(f"Ollama RequestError (e.g. connection issue) while trying to list models with {client_used_desc}: {str(e)}", exc_info=True)
-        return jsonify({'error': f'Could not connect to Ollama: {str(e)}'}), 500
     except Exception as e:
-        app.logger.error(f"Generic error connecting to Ollama or listing models with {client_used_desc}: {str(e)}", exc_info=True)
-        if isinstance(e, TypeError) and "not JSON serializable" in str(e):
-             app.logger.error("JSON serialization error likely due to unhandled Ollama model object structure.")
+        app.logger.error(f"Generic error listing Ollama models: {str(e)}", exc_info=True)
         return jsonify({'error': f'Could not connect to Ollama or list models: {str(e)}'}), 500
 
 
+@app.route('/admin/ollama_hosts', methods=['GET'])
+def ollama_hosts_status():
+    """Health, installed/loaded models and in-flight requests of each Ollama host (this worker's view)."""
+    if not is_admin_request() or ollama_pool.pool is None:
+        abort(404)
+    return jsonify({'hosts': ollama_pool.pool.status()})
+
+
+@app.route('/admin/db_maintenance', methods=['GET', 'POST'])
+def admin_db_maintenance():
+    """GET: database size, free pages and last maintenance runs. POST: run a maintenance pass now."""
+    if not is_admin_request():
+        abort(404)
+    ran = db_maintenance.scheduler.tick(force=True) if request.method == 'POST' else {}
+    return jsonify({'status': db_maintenance.database_status(DATABASE), 'ran': ran})
+
+
 @app.route('/update_model_settings', methods=['POST'])
 def update_model_settings():
     data = request.get_json()
@@ -609,6 +966,22 @@ def update_model_settings():
         else:
             app.logger.error(f"Failed to set Ollama model {model_name} in chat.py. It might not exist or Ollama is down.")
             return jsonify({'error': f'Failed to set Ollama model: {model_name}. Ensure it exists and Ollama is running.'}), 400
+
+    elif provider == 'replay':
+        # For offline perf runs: answer from a recorded cassette (model_name is its name)
+        model_name = data.get('model_name')
+        if not model_name:
+            return jsonify({'error': 'Cassette name cannot be empty.'}), 400
+
+        success = set_active_llm_provider(provider='replay', model_name=model_name)
+        if success:
+            session['active_provider'] = 'replay'
+            session['active_model_name'] = model_name
+            session.pop('gemini_api_key', None)
+            app.logger.info(f"Replay cassette set active: {model_name}")
+            return jsonify({'message': f'Now replaying cassette: {model_name}.'})
+        else:
+            return jsonify({'error': f'Failed to load cassette: {model_name}. Check server logs.'}), 400
     else:
         return jsonify({'error': 'Unknown model provider.'}), 400
 
@@ -616,7 +989,7 @@ def update_model_settings():
 def get_current_model():
     """Return the currently active model provider and model name"""
     try:
-        from chat import ACTIVE_PROVIDER, GEMINI_MODEL_NAME, OLLAMA_MODEL_NAME
+        from chat import ACTIVE_PROVIDER, GEMINI_MODEL_NAME, OLLAMA_MODEL_NAME, REPLAY_CASSETTE_NAME
         
         if ACTIVE_PROVIDER == 'gemini':
             return jsonify({
@@ -628,6 +1001,11 @@ def get_current_model():
                 'provider': 'ollama', 
                 'model_name': OLLAMA_MODEL_NAME or 'Unknown Ollama Model'
             })
+        elif ACTIVE_PROVIDER == 'replay':
+            return jsonify({
+                'provider': 'replay',
+                'model_name': REPLAY_CASSETTE_NAME
+            })
         else:
             return jsonify({
                 'provider': 'gemini',
@@ -0,0 +1,326 @@
+"""Static asset pipeline: vendored third-party files, fingerprinted builds, cache headers.
+
+    python assets.py vendor   # download pinned third-party assets into static/vendor/
+    python assets.py build    # minify, content-hash and precompress into static/dist/
+
+The app serves static/dist/ with immutable caching. Templates link assets through
+`asset_url(...)`, which resolves to the hashed file when a build exists (the manifest is
+re-read when a new build replaces it). Without a build it falls back to the plain static
+file. A build is fully offline: `build` downloads missing vendored files first and fails
+if any are still missing. Without a build, a vendored file that was never downloaded is
+loaded from its pinned CDN URL instead (with a startup warning), so a fresh checkout
+still renders until `python assets.py vendor` has been run and the files committed.
+"""
+import os
+import re
+import sys
+import time
+import gzip
+import json
+import shutil
+import hashlib
+import logging
+import argparse
+import mimetypes
+import urllib.request
+from pathlib import Path
+
+from flask import request, send_from_directory, url_for, abort
+
+try:
+    import brotli # Optional: enables .br variants
+except ImportError:
+    brotli = None
+
+try:
+    import rjsmin # Optional: JavaScript minification
+except ImportError:
+    rjsmin = None
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+STATIC_DIR = Path(__file__).resolve().parent / 'static'
+DIST_DIR = STATIC_DIR / 'dist'
+MANIFEST_PATH = DIST_DIR / 'manifest.json'
+
+# Extensions that are worth precompressing (fonts in woff2 are already compressed)
+COMPRESSIBLE_EXTENSIONS = {'.js', '.css', '.svg', '.json', '.ttf', '.txt', '.map'}
+MIN_COMPRESS_BYTES = 512
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+MANIFEST_CHECK_INTERVAL = 2.0 # Seconds between checks for a rebuilt manifest
+
+# --- Vendored third-party assets (pinned) ---
+# Maps a path under static/ to the URL it is downloaded from by `python assets.py vendor`.
+MARKED_VERSION = '15.0.12'
+FONT_AWESOME_VERSION = '6.5.1'
+INTER_VERSION = '5.0.18'
+INTER_WEIGHTS = (300, 400, 500, 600)
+
+_FONT_AWESOME_BASE = f'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/{FONT_AWESOME_VERSION}'
+_FONT_AWESOME_FONTS = ['fa-brands-400', 'fa-regular-400', 'fa-solid-900', 'fa-v4compatibility']
+
+VENDOR_DOWNLOADS = {
+    'vendor/marked/marked.min.js': f'https://cdn.jsdelivr.net/npm/marked@{MARKED_VERSION}/marked.min.js',
+    'vendor/fontawesome/css/all.min.css': f'{_FONT_AWESOME_BASE}/css/all.min.css',
+}
+for _font in _FONT_AWESOME_FONTS:
+    for _ext in ('woff2', 'ttf'):
+        VENDOR_DOWNLOADS[f'vendor/fontawesome/webfonts/{_font}.{_ext}'] = f'{_FONT_AWESOME_BASE}/webfonts/{_font}.{_ext}'
+for _weight in INTER_WEIGHTS:
+    VENDOR_DOWNLOADS[f'vendor/inter/inter-latin-{_weight}-normal.woff2'] = (
+        f'https://cdn.jsdelivr.net/npm/@fontsource/inter@{INTER_VERSION}/files/inter-latin-{_weight}-normal.woff2'
+    )
+
+VENDOR_GENERATED = ['vendor/inter/inter.css'] # Written by `vendor` rather than downloaded
+
+# Where templates load a vendored file from until it has been downloaded
+VENDOR_FALLBACK_URLS = {
+    'vendor/marked/marked.min.js': VENDOR_DOWNLOADS['vendor/marked/marked.min.js'],
+    'vendor/fontawesome/css/all.min.css': VENDOR_DOWNLOADS['vendor/fontawesome/css/all.min.css'],
+    'vendor/inter/inter.css': 'https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600&display=swap',
+}
+
+
+def missing_vendor_assets():
+    return [path for path in [*VENDOR_DOWNLOADS, *VENDOR_GENERATED] if not (STATIC_DIR / path).is_file()]
+
+
+def _inter_css():
+    rules = []
+    for weight in INTER_WEIGHTS:
+        rules.append(
+            "@font-face {\n"
+            "    font-family: 'Inter';\n"
+            "    font-style: normal;\n"
+            "    font-display: swap;\n"
+            f"    font-weight: {weight};\n"
+            f"    src: url(./inter-latin-{weight}-normal.woff2) format('woff2');\n"
+            "}\n"
+        )
+    return '\n'.join(rules)
+
+
+def vendor_assets(force=False):
+    """Download the pinned third-party assets into static/vendor/."""
+    for relative_path, source_url in VENDOR_DOWNLOADS.items():
+        target = STATIC_DIR / relative_path
+        if target.exists() and not force:
+            logger.info(f"✔️ {relative_path} already vendored")
+            continue
+        target.parent.mkdir(parents=True, exist_ok=True)
+        logger.info(f"⬇️ {source_url} -> {relative_path}")
+        with urllib.request.urlopen(source_url, timeout=60) as response:
+            data = response.read()
+        tmp_path = target.with_suffix(target.suffix + '.tmp')
+        tmp_path.write_bytes(data)
+        tmp_path.replace(target)
+
+    inter_css_path = STATIC_DIR / 'vendor/inter/inter.css'
+    inter_css_path.parent.mkdir(parents=True, exist_ok=True)
+    inter_css_path.write_text(_inter_css())
+    logger.info("✅ Vendored assets are up to date.")
+
+
+# --- Build: minify, fingerprint, precompress ---
+_CSS_URL_PATTERN = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+
+def _minify_css(text):
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.DOTALL)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+    return text.replace(';}', '}').strip()
+
+
+def _minify(relative_path, data):
+    if '.min.' in relative_path:
+        return data
+    if relative_path.endswith('.css'):
+        return _minify_css(data.decode('utf-8')).encode('utf-8')
+    if relative_path.endswith('.js') and rjsmin:
+        return rjsmin.jsmin(data.decode('utf-8')).encode('utf-8')
+    return data
+
+
+def _hashed_name(relative_path, data):
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    path = Path(relative_path)
+    return str(path.with_name(f"{path.stem}.{digest}{path.suffix}")).replace(os.sep, '/')
+
+
+def _rewrite_css_urls(relative_path, data, manifest):
+    """Point url(...) references in a CSS file at the hashed copies of what they reference."""
+    css_dir = Path(relative_path).parent
+
+    def replace(match):
+        quote, target = match.group(1), match.group(2)
+        if target.startswith(('data:', 'http:', 'https:', '//', '#')):
+            return match.group(0)
+        clean_target, sep, suffix = target, '', ''
+        split_at = re.search(r'[?#]', target)
+        if split_at:
+            clean_target, sep, suffix = target[:split_at.start()], split_at.group(0), target[split_at.end():]
+        referenced = os.path.normpath(css_dir / clean_target).replace(os.sep, '/')
+        if referenced not in manifest:
+            return match.group(0)
+        new_target = os.path.relpath(manifest[referenced], css_dir).replace(os.sep, '/')
+        return f"url({quote}{new_target}{sep}{suffix}{quote})"
+
+    return _CSS_URL_PATTERN.sub(replace, data.decode('utf-8')).encode('utf-8')
+
+
+def _write_precompressed(path, data):
+    if path.suffix not in COMPRESSIBLE_EXTENSIONS or len(data) < MIN_COMPRESS_BYTES:
+        return
+    gz_data = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(gz_data) < len(data):
+        path.with_name(path.name + '.gz').write_bytes(gz_data)
+    if brotli:
+        br_data = brotli.compress(data, quality=11)
+        if len(br_data) < len(data):
+            path.with_name(path.name + '.br').write_bytes(br_data)
+
+
+def build_assets():
+    """Build static/dist/ and its manifest from everything else under static/."""
+    if missing_vendor_assets():
+        vendor_assets()
+    missing = missing_vendor_assets()
+    if missing:
+        raise RuntimeError(f"Vendored assets are missing: {', '.join(missing)}")
+
+    if DIST_DIR.exists():
+        shutil.rmtree(DIST_DIR)
+    DIST_DIR.mkdir(parents=True)
+
+    sources = sorted(
+        p for p in STATIC_DIR.rglob('*')
+        if p.is_file() and DIST_DIR not in p.parents and not p.name.endswith('.tmp')
+    )
+    # CSS goes last so the files it references already have hashed names
+    sources.sort(key=lambda p: p.suffix == '.css')
+
+    manifest = {}
+    for source in sources:
+        relative_path = source.relative_to(STATIC_DIR).as_posix()
+        data = _minify(relative_path, source.read_bytes())
+        if relative_path.endswith('.css'):
+            data = _rewrite_css_urls(relative_path, data, manifest)
+        hashed_path = _hashed_name(relative_path, data)
+        output = DIST_DIR / hashed_path
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_bytes(data)
+        _write_precompressed(output, data)
+        manifest[relative_path] = hashed_path
+
+    MANIFEST_PATH.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+    if not brotli:
+        logger.warning("brotli is not installed; only .gz variants were written.")
+    logger.info(f"✅ Built {len(manifest)} assets into {DIST_DIR}")
+    return manifest
+
+
+# --- Runtime: Flask integration ---
+class Manifest:
+    """The build manifest, re-read when a new build replaces the file (no restart needed)."""
+
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = path
+        self.entries = {}
+        self._mtime = None
+        self._checked = 0.0
+        self.refresh()
+
+    def refresh(self):
+        try:
+            mtime = self.path.stat().st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        entries = {}
+        if mtime is not None:
+            try:
+                entries = json.loads(self.path.read_text())
+            except (OSError, ValueError) as e:
+                logger.error(f"Could not read asset manifest {self.path}: {e}")
+                return # Keep the previous entries; a build may be writing the file right now
+        self.entries, self._mtime = entries, mtime
+        if self._checked:
+            logger.info(f"Reloaded asset manifest ({len(entries)} assets).")
+
+    def get(self, relative_path):
+        now = time.monotonic()
+        if now - self._checked >= MANIFEST_CHECK_INTERVAL:
+            self._checked = now
+            self.refresh()
+        return self.entries.get(relative_path)
+
+
+def _preferred_encoding(filename):
+    """The precompressed variant the client accepts with the highest q-value (br wins ties)."""
+    best_quality, best = 0, (filename, None)
+    for encoding, extension in (('br', '.br'), ('gzip', '.gz')):
+        quality = request.accept_encodings[encoding] # 0 when absent or q=0
+        if quality > best_quality and (DIST_DIR / (filename + extension)).is_file():
+            best_quality, best = quality, (filename + extension, encoding)
+    return best
+
+
+def init_assets(app):
+    """Register `asset_url` for templates and the immutable, precompressed dist route."""
+    manifest = Manifest()
+    if manifest.entries:
+        app.logger.info(f"Serving {len(manifest.entries)} fingerprinted assets from {DIST_DIR}")
+    else:
+        app.logger.info("No asset build found, serving unversioned static files (run `python assets.py build`).")
+        missing = missing_vendor_assets()
+        if missing:
+            app.logger.warning(f"⚠️ {len(missing)} vendored assets are missing (e.g. static/{missing[0]}); loading them from their pinned CDN URLs. Run `python assets.py vendor` to work offline.")
+
+    def asset_url(relative_path):
+        hashed_path = manifest.get(relative_path)
+        if hashed_path:
+            return url_for('dist_asset', filename=hashed_path)
+        if relative_path in VENDOR_FALLBACK_URLS and not (STATIC_DIR / relative_path).is_file():
+            return VENDOR_FALLBACK_URLS[relative_path]
+        return url_for('static', filename=relative_path)
+
+    app.jinja_env.globals['asset_url'] = asset_url
+
+    @app.route('/static/dist/<path:filename>')
+    def dist_asset(filename):
+        if not (DIST_DIR / filename).is_file():
+            abort(404)
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+        served_name, encoding = _preferred_encoding(filename)
+        response = send_from_directory(DIST_DIR, served_name, mimetype=mimetype, max_age=31536000)
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        response.headers['Vary'] = 'Accept-Encoding'
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        return response
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    parser = argparse.ArgumentParser(description="Vendor, fingerprint and precompress static assets.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    vendor_parser = subparsers.add_parser('vendor', help="Download pinned third-party assets into static/vendor/")
+    vendor_parser.add_argument('--force', action='store_true', help="Re-download files that already exist")
+    subparsers.add_parser('build', help="Minify, content-hash and precompress static files into static/dist/")
+    args = parser.parse_args()
+
+    if args.command == 'vendor':
+        vendor_assets(force=args.force)
+    elif args.command == 'build':
+        try:
+            build_assets()
+        except (RuntimeError, OSError) as e:
+            logger.error(f"❌ Build failed: {e}")
+            sys.exit(1)
+    sys.exit(0)
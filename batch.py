@@ -0,0 +1,260 @@
+"""Offline batch generation: run a JSONL file of prompts through the chat graph.
+
+    python batch.py prompts.jsonl results.jsonl --provider ollama --model llama3:8b
+    python batch.py prompts.jsonl results.jsonl --provider gemini --workers 16
+
+Each input line is an object with a `prompt` string, or a `messages` list of
+{"type": "human"|"ai", "content": ...} ending with the human turn to answer, plus an
+optional `id` (the line number is used otherwise). Results are appended to the output
+file as they complete, one object per line with `id`, `response` (and `thinking`),
+or `error`, plus `elapsed` seconds. Rerunning with the same output file resumes:
+IDs that already have a result are skipped (`--retry-errors` re-runs failed ones).
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import concurrent.futures
+from pathlib import Path
+
+from dotenv import load_dotenv
+from langchain_core.messages import HumanMessage, AIMessage
+
+import chat
+import ollama_pool
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Default number of requests kept in flight per provider. A hosted API is latency bound
+# and takes many concurrent requests; a local Ollama server mostly queues them, so more
+# workers than its OLLAMA_NUM_PARALLEL setting (per host in OLLAMA_HOSTS) only adds
+# memory pressure.
+DEFAULT_CONCURRENCY = {
+    'gemini': 8,
+    'ollama': int(os.getenv('OLLAMA_NUM_PARALLEL', '2')) * max(1, len(ollama_pool.OLLAMA_HOSTS)),
+    'replay': 8, # Recorded replies; requests only wait on the replayed timing
+}
+PROGRESS_INTERVAL = 10.0 # Seconds between throughput reports
+
+
+# --- Input / Output ---
+def parse_history(record):
+    """Validate one input record and return its (sender_type, content) history.
+
+    Raises ValueError describing what is wrong, so the caller can report the line.
+    """
+    if not isinstance(record, dict):
+        raise ValueError("expected a JSON object")
+    if 'messages' in record:
+        messages = record['messages']
+        if not isinstance(messages, list) or not messages:
+            raise ValueError("'messages' must be a non-empty list")
+        history = []
+        for i, m in enumerate(messages):
+            if not isinstance(m, dict) or not isinstance(m.get('content'), str):
+                raise ValueError(f"message {i} needs a 'content' string")
+            sender_type = m.get('type', 'human')
+            if sender_type not in ('human', 'ai'):
+                raise ValueError(f"message {i} has type {sender_type!r}; expected 'human' or 'ai'")
+            history.append((sender_type, m['content']))
+        if history[-1][0] != 'human':
+            raise ValueError("'messages' must end with a human turn")
+        return history
+    if 'prompt' in record:
+        if not isinstance(record['prompt'], str):
+            raise ValueError("'prompt' must be a string")
+        return [('human', record['prompt'])]
+    raise ValueError("needs a 'prompt' or 'messages' field")
+
+
+def read_jobs(input_path):
+    """Yield (job_id, history) for every prompt line, lazily so huge inputs aren't loaded at once."""
+    with open(input_path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                logger.error(f"Skipping line {line_number}: invalid JSON ({e})")
+                continue
+            try:
+                history = parse_history(record)
+            except ValueError as e:
+                logger.error(f"Skipping line {line_number}: {e}.")
+                continue
+            yield str(record.get('id', line_number)), history
+
+
+def load_completed_ids(output_path, retry_errors=False):
+    """IDs that already have a result in the output file (for resuming)."""
+    completed = set()
+    if not output_path.exists():
+        return completed
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue # A line cut short by an interrupted run; that job is redone
+            if retry_errors and 'error' in record:
+                continue
+            completed.add(str(record['id']))
+    return completed
+
+
+# --- Workers ---
+def configure_provider(provider, api_key=None, model_name=None):
+    if not chat.set_active_llm_provider(provider=provider, api_key=api_key, model_name=model_name):
+        raise RuntimeError(f"Could not configure provider '{provider}' (model: {model_name or 'default'}).")
+
+
+def _init_process_worker(provider, api_key, model_name):
+    # Clients created before the fork aren't safe to share; give each process its own
+    chat.initialize_llm_providers()
+    configure_provider(provider, api_key, model_name)
+
+
+def run_job(job_id, history):
+    """Run one prompt through the chat graph and return its result record."""
+    langchain_history = [
+        HumanMessage(content=content) if sender_type == 'human' else AIMessage(content=content)
+        for sender_type, content in history
+    ]
+    started = time.perf_counter()
+    response = chat.invoke_chat_graph(langchain_history)
+    result = {'id': job_id, 'elapsed': round(time.perf_counter() - started, 3)}
+
+    if "Error:" in response or "Sorry, I encountered an error" in response:
+        result['error'] = response
+        return result
+
+    result['response'] = response
+    if response.startswith('{') and '"thinking"' in response:
+        try:
+            parsed = json.loads(response)
+            if isinstance(parsed, dict) and parsed.get('has_thinking'):
+                result['response'] = parsed.get('content', response)
+                result['thinking'] = parsed.get('thinking')
+        except ValueError:
+            pass
+    return result
+
+
+class ThroughputReporter:
+    def __init__(self, skipped):
+        self.skipped = skipped
+        self.completed = 0
+        self.failed = 0
+        self.latencies = []
+        self.started = time.perf_counter()
+        self._last_report = self.started
+
+    def record(self, result):
+        self.completed += 1
+        if 'error' in result:
+            self.failed += 1
+        self.latencies.append(result['elapsed'])
+        now = time.perf_counter()
+        if now - self._last_report >= PROGRESS_INTERVAL:
+            self._last_report = now
+            logger.info(f"⏱️ {self.summary()}")
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        rate = self.completed / elapsed if elapsed else 0.0
+        text = f"{self.completed} done ({self.failed} failed) in {elapsed:.1f}s, {rate:.2f} prompts/s"
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            p50 = latencies[len(latencies) // 2]
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            text += f", latency p50 {p50:.2f}s / p95 {p95:.2f}s"
+        return text
+
+
+def run_batch(input_path, output_path, provider, model_name=None, api_key=None,
+              workers=None, use_processes=False, retry_errors=False):
+    input_path, output_path = Path(input_path), Path(output_path)
+    workers = workers or DEFAULT_CONCURRENCY.get(provider, 4)
+
+    completed_ids = load_completed_ids(output_path, retry_errors=retry_errors)
+    if completed_ids:
+        logger.info(f"↩️ Resuming: {len(completed_ids)} prompts already have results in {output_path}")
+
+    if use_processes:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_process_worker, initargs=(provider, api_key, model_name)
+        )
+    else:
+        # The provider clients are shared by all threads
+        configure_provider(provider, api_key, model_name)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batch')
+
+    logger.info(f"🚀 Running {input_path} with {workers} {'processes' if use_processes else 'threads'} on {provider} ({model_name or 'default model'})")
+    reporter = ThroughputReporter(skipped=len(completed_ids))
+    write_lock = threading.Lock()
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(output_path, 'a', encoding='utf-8') as out, executor:
+        def write_result(result):
+            with write_lock:
+                out.write(json.dumps(result, ensure_ascii=False) + '\n')
+                out.flush() # A crash loses at most the jobs in flight
+            reporter.record(result)
+
+        # Keep a bounded number of jobs in flight so the input is streamed, not loaded up front
+        in_flight = set()
+        max_in_flight = workers * 2
+        try:
+            for job_id, history in read_jobs(input_path):
+                if job_id in completed_ids:
+                    continue
+                if len(in_flight) >= max_in_flight:
+                    done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        write_result(future.result())
+                in_flight.add(executor.submit(run_job, job_id, history))
+            for future in concurrent.futures.as_completed(in_flight):
+                write_result(future.result())
+        except KeyboardInterrupt:
+            logger.warning("Interrupted; finished results are saved, rerun the same command to resume.")
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    logger.info(f"✅ {reporter.summary()} ({reporter.skipped} skipped from earlier runs)")
+    if provider == 'replay' and not use_processes and chat.replay_cassette and chat.replay_cassette.misses:
+        logger.warning(f"📼 {chat.replay_cassette.misses} prompts had no recording in cassette {model_name}.")
+    return reporter
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    load_dotenv(Path(__file__).resolve().parent / '.env')
+
+    parser = argparse.ArgumentParser(description="Run a JSONL file of prompts through the chat graph.")
+    parser.add_argument('input', help="JSONL file with one prompt per line")
+    parser.add_argument('output', help="JSONL file results are appended to (also used to resume)")
+    parser.add_argument('--provider', choices=sorted(DEFAULT_CONCURRENCY), default='gemini')
+    parser.add_argument('--model', help="Model name (default: GEMINI_MODEL for gemini; required for ollama; the cassette name for replay)")
+    parser.add_argument('--workers', type=int, help="Concurrent requests (default: per provider, see DEFAULT_CONCURRENCY)")
+    parser.add_argument('--processes', action='store_true', help="Use worker processes instead of threads")
+    parser.add_argument('--retry-errors', action='store_true', help="Re-run prompts whose earlier result was an error")
+    args = parser.parse_args()
+
+    try:
+        run_batch(
+            args.input, args.output, args.provider,
+            model_name=args.model, api_key=os.getenv('GEMINI_API_KEY'),
+            workers=args.workers, use_processes=args.processes, retry_errors=args.retry_errors,
+        )
+    except KeyboardInterrupt:
+        sys.exit(130)
+    except RuntimeError as e:
+        logger.error(f"❌ {e}")
+        sys.exit(1)
+    sys.exit(0)
@@ -0,0 +1,91 @@
+"""Benchmark JSON encoding and bytes on the wire for large /switch_chat payloads.
+
+    python benchmarks/bench_json.py [--messages 2000] [--chats 300] [--repeat 20]
+
+Builds a synthetic thread shaped like a /switch_chat response and compares the
+stdlib-backed Flask provider with the orjson provider, then reports body size raw,
+gzip'd and brotli'd at the levels the app uses.
+"""
+import sys
+import gzip
+import time
+import random
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+import json_responses
+from json_responses import OrjsonProvider, GZIP_LEVEL, BROTLI_QUALITY
+
+WORDS = ("the model returns a markdown answer with `code`, lists, tables and some longer "
+         "explanations about python flask sqlite caching latency throughput").split()
+
+
+def make_payload(message_count, chat_count, seed=0):
+    rng = random.Random(seed)
+
+    def text(min_words, max_words):
+        return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words)))
+
+    messages = []
+    for i in range(message_count):
+        is_human = i % 2 == 0
+        messages.append({'type': 'human' if is_human else 'ai', 'content': text(5, 40) if is_human else text(60, 400)})
+    chats = [
+        {'thread_id': f"{rng.getrandbits(128):032x}", 'title': text(2, 4), 'icon': '💬', 'is_pinned': i < 3}
+        for i in range(chat_count)
+    ]
+    return {'messages': messages, 'chats': chats, 'active_thread_id': chats[0]['thread_id']}
+
+
+def time_encoder(provider, payload, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = provider.dumps(payload)
+        best = min(best, time.perf_counter() - start)
+    return best, body.encode('utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--chats', type=int, default=300)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    payload = make_payload(args.messages, args.chats)
+    print(f"Payload: {args.messages} messages, {args.chats} chats")
+
+    stdlib_time, stdlib_body = time_encoder(DefaultJSONProvider(app), payload, args.repeat)
+    print(f"  stdlib json encode: {stdlib_time * 1000:8.2f} ms  ({len(stdlib_body):,} bytes)")
+    if json_responses.orjson:
+        orjson_time, orjson_body = time_encoder(OrjsonProvider(app), payload, args.repeat)
+        print(f"  orjson encode:      {orjson_time * 1000:8.2f} ms  ({len(orjson_body):,} bytes, {stdlib_time / orjson_time:.1f}x faster)")
+    else:
+        orjson_body = stdlib_body
+        print("  orjson encode:      skipped (orjson not installed)")
+
+    body = orjson_body
+    start = time.perf_counter()
+    gz_body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+    gz_time = time.perf_counter() - start
+    print("Bytes on the wire:")
+    print(f"  identity: {len(body):>12,}")
+    print(f"  gzip-{GZIP_LEVEL}:   {len(gz_body):>12,}  ({len(gz_body) / len(body):.1%}, {gz_time * 1000:.2f} ms)")
+    if json_responses.brotli:
+        start = time.perf_counter()
+        br_body = json_responses.brotli.compress(body, quality=BROTLI_QUALITY)
+        br_time = time.perf_counter() - start
+        print(f"  br-{BROTLI_QUALITY}:     {len(br_body):>12,}  ({len(br_body) / len(body):.1%}, {br_time * 1000:.2f} ms)")
+    else:
+        print("  br:       skipped (brotli not installed)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+import uuid
+import logging
+import sqlite3
+from pathlib import Path
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# --- Conversation Branching ---
+# A branch (from editing an earlier prompt or regenerating an answer) is a conversation
+# whose parent_id points at the conversation it came from, and whose fork_sequence is
+# the last inherited message. It only stores the messages written after the fork.
+# Its history is every ancestor's messages up to the relevant fork point, followed by
+# its own. Sequences keep counting up from the fork, so ordering the combined rows by
+# sequence gives the thread in order.
+#
+# Deleting a conversation that has branches copies the messages each direct branch
+# inherits from it into that branch first (copy-on-write), then re-points the branch at
+# the deleted conversation's own parent. Nothing else is ever copied.
+MAX_BRANCH_DEPTH = 256 # Guards the parent walk against a corrupted cycle
+BRANCH_ICON = '🌿'
+BRANCH_TITLE_SUFFIX = ' (branch)'
+
+
+def ensure_branch_columns(conn):
+    """Add the branch columns to databases created before branching existed."""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(conversations)")}
+    if 'parent_id' not in columns:
+        conn.execute("ALTER TABLE conversations ADD COLUMN parent_id TEXT REFERENCES conversations (id)")
+    if 'fork_sequence' not in columns:
+        conn.execute("ALTER TABLE conversations ADD COLUMN fork_sequence INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_parent_id ON conversations (parent_id)")
+
+
+def branch_title(parent_title):
+    title = parent_title or "Chat"
+    return title if title.endswith(BRANCH_TITLE_SUFFIX) else f"{title}{BRANCH_TITLE_SUFFIX}"
+
+
+def get_history_segments(conn, conversation_id, upto=None):
+    """[(conversation_id, last sequence or None)] whose messages make up the history, root first.
+
+    upto limits the history to messages with sequence <= upto.
+    """
+    chain = conn.execute(
+        "WITH RECURSIVE chain(id, parent_id, fork_sequence, depth) AS ("
+        " SELECT id, parent_id, fork_sequence, 0 FROM conversations WHERE id = ?"
+        " UNION ALL"
+        " SELECT c.id, c.parent_id, c.fork_sequence, chain.depth + 1 FROM conversations c"
+        " JOIN chain ON c.id = chain.parent_id WHERE chain.depth < ?"
+        ") SELECT id, fork_sequence FROM chain ORDER BY depth",
+        (conversation_id, MAX_BRANCH_DEPTH)
+    ).fetchall()
+    if not chain:
+        return [(conversation_id, upto)]
+
+    segments = []
+    limit = upto
+    for chain_id, fork_sequence in chain:
+        segments.append((chain_id, limit))
+        if fork_sequence is not None:
+            limit = fork_sequence if limit is None else min(limit, fork_sequence)
+    segments.reverse()
+    return segments
+
+
+def history_filter(segments, prefix=''):
+    """SQL condition (and params) selecting the message rows of these segments."""
+    clauses, params = [], []
+    for segment_id, upto in segments:
+        if upto is None:
+            clauses.append(f"{prefix}conversation_id = ?")
+            params.append(segment_id)
+        else:
+            clauses.append(f"({prefix}conversation_id = ? AND {prefix}sequence <= ?)")
+            params.extend((segment_id, upto))
+    return f"({' OR '.join(clauses)})", params
+
+
+def get_history(conn, conversation_id, upto=None):
+    """Message rows (id, sender_type, content, sequence) of a conversation, including inherited ones."""
+    where, params = history_filter(get_history_segments(conn, conversation_id, upto))
+    return conn.execute(
+        f"SELECT id, sender_type, content, sequence FROM messages WHERE {where} ORDER BY sequence ASC", params
+    ).fetchall()
+
+
+def count_histories(conn, conversation_ids):
+    """{conversation_id: (message count, last sequence or None)} of full histories, in one query.
+
+    Walks every requested conversation's ancestor chain in a single recursive CTE, carrying
+    the sequence limit down from each fork, then counts the inherited and own rows together.
+    Conversations that don't exist are left out.
+    """
+    if not conversation_ids:
+        return {}
+    placeholders = ','.join('?' * len(conversation_ids))
+    rows = conn.execute(
+        "WITH RECURSIVE chain(root, id, parent_id, fork_sequence, upto, depth) AS ("
+        f" SELECT id, id, parent_id, fork_sequence, NULL, 0 FROM conversations WHERE id IN ({placeholders})"
+        " UNION ALL"
+        " SELECT chain.root, c.id, c.parent_id, c.fork_sequence,"
+        "  CASE WHEN chain.upto IS NULL THEN chain.fork_sequence"
+        "       WHEN chain.fork_sequence IS NULL THEN chain.upto"
+        "       ELSE MIN(chain.upto, chain.fork_sequence) END,"
+        "  chain.depth + 1"
+        " FROM conversations c JOIN chain ON c.id = chain.parent_id WHERE chain.depth < ?"
+        ") SELECT chain.root, COUNT(m.id), MAX(m.sequence) FROM chain"
+        " LEFT JOIN messages m ON m.conversation_id = chain.id AND (chain.upto IS NULL OR m.sequence <= chain.upto)"
+        " GROUP BY chain.root",
+        (*conversation_ids, MAX_BRANCH_DEPTH)
+    ).fetchall()
+    return {row[0]: (row[1], row[2]) for row in rows}
+
+
+def detach_branches(conn, conversation_id):
+    """Before deleting a conversation, give its direct branches their own copy of what they inherit.
+
+    Runs inside the caller's transaction. Returns the copied message rows as dicts.
+    """
+    parent = conn.execute("SELECT parent_id, fork_sequence FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+    if parent is None:
+        return []
+    grandparent_id, parent_fork = parent[0], parent[1]
+    branches = conn.execute("SELECT id, fork_sequence FROM conversations WHERE parent_id = ?", (conversation_id,)).fetchall()
+
+    copied = []
+    for branch_id, branch_fork in branches:
+        rows = conn.execute(
+            "SELECT sender_type, content, sequence, timestamp FROM messages WHERE conversation_id = ? AND sequence <= ?",
+            (conversation_id, branch_fork)
+        ).fetchall()
+        branch_rows = [
+            {'message_id': str(uuid.uuid4()), 'conversation_id': branch_id, 'sender_type': row[0], 'content': row[1], 'sequence': row[2], 'timestamp': row[3]}
+            for row in rows
+        ]
+        conn.executemany(
+            "INSERT INTO messages (id, conversation_id, sender_type, content, sequence, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+            [(r['message_id'], branch_id, r['sender_type'], r['content'], r['sequence'], r['timestamp']) for r in branch_rows]
+        )
+        # What came before the deleted conversation's own fork is still inherited from its parent
+        new_fork = min(branch_fork, parent_fork) if grandparent_id is not None else None
+        conn.execute("UPDATE conversations SET parent_id = ?, fork_sequence = ? WHERE id = ?", (grandparent_id, new_fork, branch_id))
+        copied.extend(branch_rows)
+    if branches:
+        logger.info(f"🌿 Copied {len(copied)} inherited messages into {len(branches)} branches of {conversation_id}.")
+    return copied
+
+
+# --- Self-check ---
+def self_check():
+    """Build a small branch tree in memory and check history assembly and detaching."""
+    conn = sqlite3.connect(':memory:')
+    conn.executescript((Path(__file__).resolve().parent / 'schema.sql').read_text())
+
+    def add(conversation_id, parent_id=None, fork_sequence=None, sequences=()):
+        conn.execute("INSERT INTO conversations (id, title, parent_id, fork_sequence) VALUES (?, ?, ?, ?)",
+                     (conversation_id, conversation_id, parent_id, fork_sequence))
+        for sequence in sequences:
+            conn.execute("INSERT INTO messages (id, conversation_id, sender_type, content, sequence) VALUES (?, ?, ?, ?, ?)",
+                         (str(uuid.uuid4()), conversation_id, 'human' if sequence % 2 == 0 else 'ai', f"{conversation_id}-{sequence}", sequence))
+
+    def contents(conversation_id, upto=None):
+        return [row[2] for row in get_history(conn, conversation_id, upto)]
+
+    # root: 0-5; a forks root after 3 and adds 4-6; b forks a after 4 and adds 5-6; c forks root after 1
+    add('root', sequences=range(6))
+    add('a', 'root', 3, range(4, 7))
+    add('b', 'a', 4, range(5, 7))
+    add('c', 'root', 1, range(2, 4))
+    expected = {
+        'root': [f"root-{i}" for i in range(6)],
+        'a': [f"root-{i}" for i in range(4)] + [f"a-{i}" for i in range(4, 7)],
+        'b': [f"root-{i}" for i in range(4)] + ['a-4'] + [f"b-{i}" for i in range(5, 7)],
+        'c': ['root-0', 'root-1', 'c-2', 'c-3'],
+    }
+
+    assert get_history_segments(conn, 'b') == [('root', 3), ('a', 4), ('b', None)]
+    assert get_history_segments(conn, 'b', upto=2) == [('root', 2), ('a', 2), ('b', 2)]
+    assert get_history_segments(conn, 'missing') == [('missing', None)]
+    assert contents('b', upto=4) == expected['b'][:5]
+    for conversation_id, history in expected.items():
+        assert contents(conversation_id) == history, conversation_id
+    assert count_histories(conn, list(expected) + ['missing']) == {
+        conversation_id: (len(history), int(history[-1].rsplit('-', 1)[1])) # Last sequence is in the content
+        for conversation_id, history in expected.items()
+    }
+
+    # Deleting a branch in the middle: b keeps its history and now inherits straight from root
+    detach_branches(conn, 'a')
+    conn.execute("DELETE FROM messages WHERE conversation_id = 'a'")
+    conn.execute("DELETE FROM conversations WHERE id = 'a'")
+    assert conn.execute("SELECT parent_id, fork_sequence FROM conversations WHERE id = 'b'").fetchone() == ('root', 3)
+    assert contents('b') == expected['b']
+
+    # Deleting the root: every branch gets its own copy and becomes a root itself
+    detach_branches(conn, 'root')
+    conn.execute("DELETE FROM messages WHERE conversation_id = 'root'")
+    conn.execute("DELETE FROM conversations WHERE id = 'root'")
+    for conversation_id in ('b', 'c'):
+        assert conn.execute("SELECT parent_id, fork_sequence FROM conversations WHERE id = ?", (conversation_id,)).fetchone() == (None, None)
+        assert contents(conversation_id) == expected[conversation_id], conversation_id
+    conn.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    self_check()
+    logger.info("✅ Branch history self-check passed.")
@@ -0,0 +1,124 @@
+import time
+import sqlite3
+import logging
+import threading
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# --- Generation Cancellation ---
+# The client tags each /chat request with a request ID. When the user stops generation
+# (or leaves the page), it aborts the fetch and posts the ID to /cancel. Provider calls
+# stream their output and check for cancellation between chunks. On cancellation they
+# close the stream, which stops the generation on the provider side too.
+#
+# /cancel may be handled by a different worker process than the one generating, so
+# cancellations are also recorded in a small SQLite table. Generating workers poll
+# that table at most every CANCEL_POLL_INTERVAL seconds.
+
+CANCEL_POLL_INTERVAL = 0.5 # Seconds between shared-table checks per in-flight request
+CANCEL_RECORD_TTL = 600 # Seconds a cancellation record is kept
+
+
+class GenerationCancelled(Exception):
+    """Raised inside a provider call when its request was cancelled by the client."""
+
+
+class CancellationRegistry:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._events = {} # request_id -> threading.Event, for requests running in this process
+        self._last_poll = {}
+        conn = self._connect()
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS cancelled_requests (request_id TEXT PRIMARY KEY, cancelled_at REAL NOT NULL)")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def register(self, request_id):
+        with self._lock:
+            self._events[request_id] = threading.Event()
+            self._last_poll[request_id] = 0.0 # Poll right away, in case /cancel arrived first
+
+    def finish(self, request_id):
+        with self._lock:
+            self._events.pop(request_id, None)
+            self._last_poll.pop(request_id, None)
+
+    def cancel(self, request_id):
+        """Mark a request as cancelled. Returns True if it was running in this process."""
+        with self._lock:
+            event = self._events.get(request_id)
+        if event is not None:
+            event.set()
+            return True
+
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("INSERT OR REPLACE INTO cancelled_requests (request_id, cancelled_at) VALUES (?, ?)", (request_id, now))
+            conn.execute("DELETE FROM cancelled_requests WHERE cancelled_at < ?", (now - CANCEL_RECORD_TTL,))
+            conn.commit()
+        finally:
+            conn.close()
+        return False
+
+    def is_cancelled(self, request_id):
+        with self._lock:
+            event = self._events.get(request_id)
+            if event is None:
+                return False
+            if event.is_set():
+                return True
+            now = time.monotonic()
+            if now - self._last_poll[request_id] < CANCEL_POLL_INTERVAL:
+                return False
+            self._last_poll[request_id] = now
+
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT 1 FROM cancelled_requests WHERE request_id = ?", (request_id,)).fetchone()
+        finally:
+            conn.close()
+        if row:
+            event.set()
+        return event.is_set()
+
+
+# --- Module State ---
+registry = None
+
+
+def init_cancellation(db_path):
+    global registry
+    registry = CancellationRegistry(db_path)
+    return registry
+
+
+def register_request(request_id):
+    if registry is not None and request_id:
+        registry.register(request_id)
+
+
+def finish_request(request_id):
+    if registry is not None and request_id:
+        registry.finish(request_id)
+
+
+def cancel_request(request_id):
+    if registry is None or not request_id:
+        return False
+    return registry.cancel(request_id)
+
+
+def raise_if_cancelled(request_id):
+    """Call between chunks of a provider response; raises GenerationCancelled if the client gave up."""
+    if registry is not None and request_id and registry.is_cancelled(request_id):
+        logger.info(f"🛑 Request {request_id} was cancelled by the client.")
+        raise GenerationCancelled(request_id)
@@ -0,0 +1,191 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import datetime
+import threading
+from pathlib import Path
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# --- Record/Replay Cassettes ---
+# With LLM_RECORD_CASSETTE set, every Gemini/Ollama call is written to a cassette: the
+# prompt it answered, the arrival time and text of each streamed chunk, and the final reply.
+# The "replay" provider then answers from a cassette without any network access. It
+# reproduces the recorded chunk timing, scaled by LLM_REPLAY_LATENCY_SCALE (1 = as
+# recorded, 0 = instant), and checks for cancellation between chunks just like a live
+# provider, so performance experiments can be repeated offline.
+#
+# Cassettes are JSONL files named <name>.jsonl in LLM_CASSETTE_DIR, one interaction per
+# line. Interactions are keyed by the message history sent to the model (after memory
+# windowing) plus any retrieved memory context, so a recording made with one provider
+# replays for the same conversation regardless of which provider is active. The memory
+# context is recorded too (under the full, unwindowed history) and served back during
+# replay instead of embedding the query, so replay never needs the embedding model.
+LLM_CASSETTE_DIR = Path(os.getenv('LLM_CASSETTE_DIR', Path(__file__).resolve().parent / 'cassettes'))
+LLM_RECORD_CASSETTE = os.getenv('LLM_RECORD_CASSETTE') # Cassette name to record into; unset disables recording
+LLM_REPLAY_LATENCY_SCALE = float(os.getenv('LLM_REPLAY_LATENCY_SCALE', '1'))
+LLM_REPLAY_STRICT = os.getenv('LLM_REPLAY_STRICT', '1') == '1' # Unrecorded prompts are an error; '0' replays a stand-in
+
+_CASSETTE_NAME_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]*$')
+
+
+def cassette_path(name):
+    """Path of a cassette by name; names can't point outside LLM_CASSETTE_DIR."""
+    if not name or not _CASSETTE_NAME_PATTERN.match(name):
+        raise ValueError(f"Invalid cassette name: {name!r}")
+    return LLM_CASSETTE_DIR / f"{name.removesuffix('.jsonl')}.jsonl"
+
+
+def interaction_key(messages, memory_context=None):
+    """Stable key for the prompt a provider is about to answer."""
+    payload = {
+        'messages': [[message.type, message.content] for message in messages],
+        'memory_context': memory_context,
+    }
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# --- Recording ---
+class Recording:
+    """One live provider call being captured; chunks are timed from its creation."""
+
+    def __init__(self, path, key, provider, model, prompt, history_key=None, memory_context=None):
+        self.path = path
+        self.key = key
+        self.provider = provider
+        self.model = model
+        self.prompt = prompt
+        self.history_key = history_key # interaction_key of the full history, before memory windowing
+        self.memory_context = memory_context
+        self.chunks = [] # [seconds since start, text]
+        self._started = time.perf_counter()
+        self._discarded = False
+
+    def chunk(self, text):
+        if text:
+            self.chunks.append([round(time.perf_counter() - self._started, 4), text])
+
+    def discard(self):
+        """The call failed; don't keep a half-finished interaction."""
+        self._discarded = True
+
+    def finish(self, response):
+        if self._discarded or not self.chunks:
+            return # Failed, or answered with an error before the provider sent anything
+        entry = {
+            'key': self.key,
+            'provider': self.provider,
+            'model': self.model,
+            'recorded_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'prompt': self.prompt,
+            'duration': round(time.perf_counter() - self._started, 4),
+            'chunks': self.chunks,
+            'response': response,
+        }
+        if self.history_key:
+            entry['history_key'] = self.history_key
+            entry['memory_context'] = self.memory_context
+        line = (json.dumps(entry, ensure_ascii=False) + '\n').encode('utf-8')
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # One O_APPEND write per interaction, so workers recording into the same file don't interleave
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        logger.info(f"📼 Recorded {self.provider} reply ({len(self.chunks)} chunks, {entry['duration']}s) into {self.path.name}")
+
+
+def start_recording(key, provider, model, prompt, history_key=None, memory_context=None):
+    """A Recording for this call if LLM_RECORD_CASSETTE is set, else None."""
+    if not LLM_RECORD_CASSETTE:
+        return None
+    return Recording(cassette_path(LLM_RECORD_CASSETTE), key, provider, model, prompt, history_key, memory_context)
+
+
+# --- Replay ---
+class Cassette:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.entries = []
+        self._by_key = {} # key -> entries recorded for it, in order
+        self._next_take = {} # key -> how many times it was replayed, to cycle through repeated recordings
+        self._contexts = {} # history_key -> memory context retrieved when it was recorded
+        self.misses = 0 # Prompts looked up that were never recorded
+        self._lock = threading.Lock()
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # A recording cut off mid-write
+                self.entries.append(entry)
+                self._by_key.setdefault(entry['key'], []).append(entry)
+                if entry.get('history_key'):
+                    self._contexts[entry['history_key']] = entry.get('memory_context')
+        self.mtime = self.path.stat().st_mtime
+
+    def __len__(self):
+        return len(self.entries)
+
+    def recorded_context(self, history_key):
+        """The memory context retrieved for this history when it was recorded (None if none was)."""
+        return self._contexts.get(history_key)
+
+    def lookup(self, key):
+        """The recorded interaction for key; on a miss None, or a deterministic stand-in with LLM_REPLAY_STRICT=0."""
+        takes = self._by_key.get(key)
+        if takes:
+            with self._lock:
+                take = self._next_take.get(key, 0)
+                self._next_take[key] = take + 1
+            return takes[take % len(takes)]
+        with self._lock:
+            self.misses += 1
+            misses = self.misses
+        if LLM_REPLAY_STRICT or not self.entries:
+            logger.warning(f"📼 No recording for this prompt in {self.path.name} ({misses} misses so far).")
+            return None
+        # Same prompt, same stand-in: keeps runs with new prompts repeatable
+        stand_in = self.entries[int(key[:8], 16) % len(self.entries)]
+        logger.warning(f"📼 No recording for this prompt in {self.path.name} ({misses} misses so far); replaying a stand-in.")
+        return stand_in
+
+
+def replay_chunks(entry, latency_scale=None):
+    """Yield an entry's chunk texts, sleeping to reproduce the recorded (scaled) timing."""
+    scale = LLM_REPLAY_LATENCY_SCALE if latency_scale is None else latency_scale
+    started = time.perf_counter()
+    for offset, text in entry['chunks']:
+        delay = offset * scale - (time.perf_counter() - started)
+        if delay > 0:
+            time.sleep(delay)
+        yield text
+    # Time after the last chunk (e.g. the closing message) counts too
+    delay = entry.get('duration', 0) * scale - (time.perf_counter() - started)
+    if delay > 0:
+        time.sleep(delay)
+
+
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+
+def load_cassette(name):
+    """Load a cassette by name, reusing the parsed copy until the file changes."""
+    path = cassette_path(name)
+    mtime = path.stat().st_mtime # Raises FileNotFoundError for unknown cassettes
+    with _cassettes_lock:
+        cassette = _cassettes.get(path)
+        if cassette is None or cassette.mtime != mtime:
+            cassette = Cassette(path)
+            _cassettes[path] = cassette
+            logger.info(f"📼 Loaded cassette {path.name} ({len(cassette)} interactions)")
+        return cassette
@@ -1,6 +1,8 @@
 import os
 import google.generativeai as genai
+from google.ai import generativelanguage as glm # Per-call Gemini clients (genai.configure is process-wide)
 import ollama # Import ollama
+import httpx
 from typing import TypedDict, Annotated
 import operator
 import logging
@@ -9,21 +11,29 @@ import json  # Import for prettier logging of responses
 from langgraph.graph import StateGraph, END
 from langchain_core.messages import HumanMessage, AIMessage, BaseMessage
 
+import memory
+import ollama_pool
+import cassette
+import cancellation
+from cancellation import GenerationCancelled
+
 # Configure logging for this module
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)  # Ensure logging level is at least INFO
 
 # --- Global LLM Provider State ---
-ACTIVE_PROVIDER = "gemini"  # 'gemini' or 'ollama'
+ACTIVE_PROVIDER = "gemini"  # 'gemini', 'ollama' or 'replay'
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
 OLLAMA_MODEL_NAME = None # e.g., "llama2:latest"
+REPLAY_CASSETTE_NAME = None # e.g., "perf-baseline" for cassettes/perf-baseline.jsonl
 
 gemini_model = None
-ollama_client = None
+ollama_hosts = None # ollama_pool.OllamaHostPool over every configured Ollama server
+replay_cassette = None # cassette.Cassette answered by the replay provider
 
 def initialize_llm_providers():
-    global gemini_model, ollama_client, GEMINI_API_KEY, GEMINI_MODEL_NAME
+    global gemini_model, ollama_hosts, GEMINI_API_KEY, GEMINI_MODEL_NAME
     
     # Initialize Gemini
     if GEMINI_API_KEY:
@@ -38,19 +48,17 @@ def initialize_llm_providers():
         logger.warning("GEMINI_API_KEY not found. Gemini functionality will be impaired.")
         gemini_model = None
 
-    # Initialize Ollama client
+    # Initialize the Ollama host pool; hosts that are down now are picked up by its health checks
     try:
-        ollama_client = ollama.Client() # Uses default host resolution
-        logger.info("Attempting to list models with Ollama client at startup...")
-        models_info = ollama_client.list()
-        logger.info(f"Ollama client initialized. Models found at startup: {models_info}") # Log this
+        ollama_hosts = ollama_pool.init_pool()
+        logger.info(f"Ollama models found at startup: {[name for name, _, _ in ollama_hosts.list_models()]}")
     except Exception as e:
-        logger.error(f"Failed to initialize Ollama client or list models at startup: {e}. Ensure Ollama is running.", exc_info=True)
-        ollama_client = None
+        logger.error(f"Failed to initialize Ollama host pool: {e}. Ensure Ollama is running.", exc_info=True)
+        ollama_hosts = None
 
 def set_active_llm_provider(provider: str, api_key: str = None, model_name: str = None):
-    global ACTIVE_PROVIDER, GEMINI_API_KEY, GEMINI_MODEL_NAME, OLLAMA_MODEL_NAME
-    global gemini_model # Allow modification of the global gemini_model
+    global ACTIVE_PROVIDER, GEMINI_API_KEY, GEMINI_MODEL_NAME, OLLAMA_MODEL_NAME, REPLAY_CASSETTE_NAME
+    global gemini_model, replay_cassette # Allow modification of the global gemini_model
 
     logger.info(f"Attempting to set active LLM provider to: {provider} with model: {model_name}")
     ACTIVE_PROVIDER = provider
@@ -80,22 +88,32 @@ def set_active_llm_provider(provider: str, api_key: str = None, model_name: str
     elif provider == "ollama":
         if model_name:
             OLLAMA_MODEL_NAME = model_name
-            # Test if the model exists with Ollama client
-            if ollama_client:
-                try:
-                    ollama_client.show(model_name) # Throws error if model doesn't exist
+            # Check that at least one healthy host has the model
+            if ollama_hosts:
+                if ollama_hosts.has_model(model_name):
                     logger.info(f"Ollama provider set. Active model: {OLLAMA_MODEL_NAME}")
                     return True
-                except Exception as e:
-                    logger.error(f"Failed to set Ollama model {OLLAMA_MODEL_NAME}. Model might not exist or Ollama error: {e}")
-                    OLLAMA_MODEL_NAME = None # Reset if invalid
-                    return False
+                logger.error(f"Failed to set Ollama model {OLLAMA_MODEL_NAME}. No reachable Ollama host has it.")
+                OLLAMA_MODEL_NAME = None # Reset if invalid
+                return False
             else:
-                logger.error("Ollama client not initialized. Cannot set Ollama model.")
+                logger.error("Ollama host pool not initialized. Cannot set Ollama model.")
                 return False
         else:
             logger.error("Cannot set Ollama provider: model name missing.")
             return False
+
+    elif provider == "replay":
+        # The "model" is the name of the cassette to answer from
+        try:
+            replay_cassette = cassette.load_cassette(model_name)
+        except (ValueError, OSError) as e:
+            logger.error(f"Cannot set replay provider with cassette {model_name!r}: {e}")
+            replay_cassette = None
+            return False
+        REPLAY_CASSETTE_NAME = model_name
+        logger.info(f"Replay provider set. Active cassette: {REPLAY_CASSETTE_NAME} ({len(replay_cassette)} interactions)")
+        return True
     else:
         logger.error(f"Unknown LLM provider: {provider}")
         return False
@@ -106,8 +124,28 @@ initialize_llm_providers()
 # 1. Define Graph State
 class GraphState(TypedDict):
     messages: Annotated[list[BaseMessage], operator.add]
+    thread_id: str | None
+    request_id: str | None
+    memory_context: str | None
+    memory_scope: dict | None # {'segments', 'recent_from'}: where this thread's stored history lives
 
 # --- Internal Node Functions ---
+def _close_gemini_stream(response):
+    """Stop a streamed Gemini response that won't be read to the end.
+
+    The SDK has no public close; cancelling the underlying gRPC call (or closing the REST
+    generator) ends the request instead of leaving it streaming until it is collected.
+    """
+    iterator = getattr(response, '_iterator', None)
+    for method in ('cancel', 'close'):
+        stop = getattr(iterator, method, None)
+        if callable(stop):
+            try:
+                stop()
+            except Exception as e:
+                logger.warning(f"Failed to close Gemini stream: {e}")
+            return
+
 def _call_gemini_node_internal(state: GraphState):
     if not gemini_model:
         logger.error("Gemini model not initialized. Cannot call API.")
@@ -130,11 +168,24 @@ def _call_gemini_node_internal(state: GraphState):
         logger.error(f"Invalid input to Gemini node. Last message not a HumanMessage or content not string. State: {state}")
         return {"messages": [AIMessage(content="Error: Invalid user input format for current prompt.")]}
 
+    if state.get('memory_context'):
+        current_user_prompt_text = f"{state['memory_context']}\n\n{current_user_prompt_text}"
+
     try:
         logger.info(f"🔍 Calling Gemini model: {GEMINI_MODEL_NAME} with prompt: {current_user_prompt_text[:100]}...")
         
         chat_session = gemini_model.start_chat(history=gemini_history_for_chat_start)
-        response = chat_session.send_message(current_user_prompt_text)
+        # Streamed so a cancelled request stops reading (and generating) between chunks
+        response = chat_session.send_message(current_user_prompt_text, stream=True)
+        recording = state.get('recording')
+        try:
+            for chunk in response:
+                cancellation.raise_if_cancelled(state.get('request_id'))
+                if recording:
+                    recording.chunk(_gemini_chunk_text(chunk))
+        except GenerationCancelled:
+            _close_gemini_stream(response)
+            raise
         
         # Log the raw response structure for debugging
         try:
@@ -193,14 +244,55 @@ def _call_gemini_node_internal(state: GraphState):
             logger.info("📦 Returning standard response (no thinking detected)")
             return {"messages": [AIMessage(content=ai_response_text)]}
             
+    except GenerationCancelled:
+        raise
     except Exception as e:
         logger.error(f"Gemini API call failed: {e}", exc_info=True)
+        if state.get('recording'):
+            state['recording'].discard()
         ai_response_text = "Sorry, I encountered an error while processing your request with Gemini."
         return {"messages": [AIMessage(content=ai_response_text)]}
 
+def _gemini_chunk_text(chunk):
+    try:
+        return chunk.text
+    except ValueError:
+        return '' # Chunks without text parts (e.g. only thoughts or a finish reason)
+
+def _stream_ollama_chat(messages, options, request_id=None, affinity_key=None, recording=None):
+    """Stream a chat completion from the pool and return the full text.
+
+    Cancellation is checked between chunks; closing the stream drops the connection, which
+    makes Ollama stop generating. If a host fails before sending anything, the request is
+    retried on another host.
+    """
+    failed_hosts = []
+    while True:
+        response_chunks = []
+        host = None
+        try:
+            with ollama_hosts.acquire(OLLAMA_MODEL_NAME, affinity_key=affinity_key, exclude=failed_hosts) as host:
+                logger.info(f"🖥️ Routing Ollama request to {host.name} ({host.load} in flight across workers)")
+                stream = host.client.chat(model=OLLAMA_MODEL_NAME, messages=messages, stream=True, options=options)
+                try:
+                    for chunk in stream:
+                        cancellation.raise_if_cancelled(request_id)
+                        if chunk.message and chunk.message.content:
+                            response_chunks.append(chunk.message.content)
+                            if recording:
+                                recording.chunk(chunk.message.content)
+                finally:
+                    stream.close()
+            return ''.join(response_chunks)
+        except (ConnectionError, httpx.TransportError):
+            if host is None or response_chunks or len(failed_hosts) + 1 >= len(ollama_hosts.hosts):
+                raise
+            failed_hosts.append(host)
+            logger.warning(f"Retrying Ollama request on another host after {host.name} failed.")
+
 def _call_ollama_node_internal(state: GraphState):
-    if not ollama_client:
-        logger.error("Ollama client not initialized.")
+    if not ollama_hosts:
+        logger.error("Ollama host pool not initialized.")
         return {"messages": [AIMessage(content="Error: Ollama client not available.")]}
     if not OLLAMA_MODEL_NAME:
         logger.error("Ollama model name not set.")
@@ -220,6 +312,9 @@ def _call_ollama_node_internal(state: GraphState):
          logger.error("No valid messages to send to Ollama.")
          return {"messages": [AIMessage(content="Error: No message to send.")]}
 
+    if state.get('memory_context'):
+        ollama_messages.insert(0, {'role': 'system', 'content': state['memory_context']})
+
     # Log the request being sent to Ollama
     last_user_message = next((msg['content'] for msg in reversed(ollama_messages) if msg['role'] == 'user'), None)
     logger.info(f"🔍 Calling Ollama model: {OLLAMA_MODEL_NAME} with prompt: {last_user_message[:100] if last_user_message else 'unknown'}...")
@@ -229,52 +324,17 @@ def _call_ollama_node_internal(state: GraphState):
     is_thinking_model = any(thinking_keyword in OLLAMA_MODEL_NAME.lower() for thinking_keyword in ['thinking', 'think', 'reasoning', 'reason'])
 
     try:
-        response = ollama_client.chat(
-            model=OLLAMA_MODEL_NAME,
-            messages=ollama_messages,
-            stream=False,
+        ai_response_text = _stream_ollama_chat(
+            ollama_messages,
             options={
                 'temperature': 0.7,
                 'top_p': 0.9
-            }
+            },
+            request_id=state.get('request_id'),
+            affinity_key=state.get('thread_id'), # Same conversation, same host: its KV cache is warm
+            recording=state.get('recording'),
         )
-        
-        # Handle the Ollama response object properly
-        try:
-            # Extract and log relevant parts of the response instead of trying to JSON dump the entire object
-            response_dict = {
-                'model': response.model if hasattr(response, 'model') else OLLAMA_MODEL_NAME,
-                'message': {
-                    'role': response.message.role if hasattr(response, 'message') and hasattr(response.message, 'role') else 'assistant',
-                    'content': response.message.content if hasattr(response, 'message') and hasattr(response.message, 'content') else ''
-                },
-                'done': hasattr(response, 'done') and response.done
-            }
-            logger.info(f"📥 Raw Ollama response (converted to dict): {json.dumps(response_dict, indent=2)}")
-            
-            # Extract the actual text content
-            ai_response_text = response.message.content if hasattr(response, 'message') and hasattr(response.message, 'content') else ""
-            logger.info(f"📤 Ollama response text: {ai_response_text[:500]}...")
-        except AttributeError as e:
-            # If we can't access attributes as expected, try a more careful approach with getattr
-            ai_response_text = ""
-            logger.warning(f"Attribute error when extracting response content: {e}")
-            
-            if hasattr(response, 'message'):
-                msg = response.message
-                if hasattr(msg, 'content'):
-                    ai_response_text = msg.content
-            
-            # If we still don't have content, try accessing as a dict
-            if not ai_response_text and isinstance(response, dict) and 'message' in response:
-                msg = response['message']
-                if isinstance(msg, dict) and 'content' in msg:
-                    ai_response_text = msg['content']
-            
-            # Last resort
-            if not ai_response_text:
-                ai_response_text = str(response)
-                logger.warning(f"Using string representation of response: {ai_response_text[:100]}...")
+        logger.info(f"📤 Ollama response text: {ai_response_text[:500]}...")
         
         thinking_content = None
         
@@ -330,32 +390,106 @@ def _call_ollama_node_internal(state: GraphState):
             logger.info("📦 Returning standard response (no thinking detected)")
             return {"messages": [AIMessage(content=ai_response_text)]}
             
+    except GenerationCancelled:
+        raise
     except Exception as e:
         logger.error(f"Ollama API call failed for model {OLLAMA_MODEL_NAME}: {e}", exc_info=True)
+        if state.get('recording'):
+            state['recording'].discard()
         ai_response_text = f"Sorry, I encountered an error while processing your request with Ollama model {OLLAMA_MODEL_NAME}."
         return {"messages": [AIMessage(content=ai_response_text)]}
 
-# 2. Node to call the active LLM
+def _call_replay_node_internal(state: GraphState):
+    if not replay_cassette:
+        logger.error("Replay cassette not loaded.")
+        return {"messages": [AIMessage(content="Error: Replay cassette not selected.")]}
+
+    entry = replay_cassette.lookup(cassette.interaction_key(state['messages'], state.get('memory_context')))
+    if entry is None:
+        logger.error(f"No recorded reply for this prompt in cassette {REPLAY_CASSETTE_NAME}.")
+        return {"messages": [AIMessage(content=f"Error: No recorded reply for this prompt in cassette {REPLAY_CASSETTE_NAME}.")]}
+
+    logger.info(f"📼 Replaying {entry.get('provider')} reply ({len(entry['chunks'])} chunks, {entry.get('duration')}s recorded) from {REPLAY_CASSETTE_NAME}")
+    for _ in cassette.replay_chunks(entry):
+        cancellation.raise_if_cancelled(state.get('request_id'))
+    return {"messages": [AIMessage(content=entry['response'])]}
+
+# 2. Node to look up relevant snippets from stored messages (no-op unless memory is enabled)
+def retrieve_memory_node(state: GraphState):
+    messages = state['messages']
+    if ACTIVE_PROVIDER == "replay":
+        # Serve the context retrieved when the cassette was recorded; no embedding calls offline
+        if not replay_cassette:
+            return {"memory_context": None}
+        return {"memory_context": replay_cassette.recorded_context(cassette.interaction_key(messages))}
+    if memory.memory_index is None or len(messages) < 1:
+        return {"memory_context": None}
+    # Batch the latest user turns into one embedding request
+    queries = [m.content for m in messages if isinstance(m, HumanMessage) and isinstance(m.content, str)]
+    queries = queries[-memory.MEMORY_QUERY_MESSAGES:]
+    # Stored messages still in the recent window are sent verbatim, so don't retrieve them again
+    scope = state.get('memory_scope') or {}
+    context = memory.retrieve_context(queries, scope.get('segments', ()), scope.get('recent_from'))
+    return {"memory_context": context}
+
+# 3. Node to call the active LLM
 def call_llm_node(state: GraphState):
     logger.debug(f"Calling LLM node with active provider: {ACTIVE_PROVIDER}")
+    cancellation.raise_if_cancelled(state.get('request_id')) # Cancelled while retrieving memory
+    full_messages = state['messages']
+    if state.get('memory_context') and len(state['messages']) > memory.MEMORY_RECENT_MESSAGES:
+        # Older turns are covered by the retrieved snippets; only replay the recent tail.
+        # Without retrieved context (nothing relevant, or embedding failed) keep the full history.
+        recent = state['messages'][-memory.MEMORY_RECENT_MESSAGES:]
+        while recent and not isinstance(recent[0], HumanMessage):
+            recent = recent[1:] # Gemini history has to start with a user turn
+        state = {**state, 'messages': recent}
+    if ACTIVE_PROVIDER == "replay":
+        return _call_replay_node_internal(state)
+
+    recording = None
+    if cassette.LLM_RECORD_CASSETTE and ACTIVE_PROVIDER in ("gemini", "ollama"):
+        last_message = state['messages'][-1] if state['messages'] else None
+        recording = cassette.start_recording(
+            cassette.interaction_key(state['messages'], state.get('memory_context')),
+            ACTIVE_PROVIDER,
+            GEMINI_MODEL_NAME if ACTIVE_PROVIDER == "gemini" else OLLAMA_MODEL_NAME,
+            last_message.content if last_message else None,
+            history_key=cassette.interaction_key(full_messages),
+            memory_context=state.get('memory_context'),
+        )
+        state = {**state, 'recording': recording} # Provider nodes time their chunks into it
+
     if ACTIVE_PROVIDER == "gemini":
-        return _call_gemini_node_internal(state)
+        result = _call_gemini_node_internal(state)
     elif ACTIVE_PROVIDER == "ollama":
-        return _call_ollama_node_internal(state)
+        result = _call_ollama_node_internal(state)
     else:
         logger.error(f"Unknown active provider: {ACTIVE_PROVIDER}")
         return {"messages": [AIMessage(content="Error: AI provider not configured correctly.")]}
 
-# 3. Create and compile graph
+    if recording:
+        recording.finish(result['messages'][-1].content)
+    return result
+
+# 4. Create and compile graph
 workflow = StateGraph(GraphState)
+workflow.add_node("retrieve", retrieve_memory_node)
 workflow.add_node("llm", call_llm_node) # Use the dispatcher node
-workflow.set_entry_point("llm")
+workflow.set_entry_point("retrieve")
+workflow.add_edge("retrieve", "llm")
 workflow.add_edge("llm", END)
 
 app_graph = workflow.compile()
 
-def invoke_chat_graph(full_langchain_history: list[BaseMessage]) -> str:
-    global ACTIVE_PROVIDER, gemini_model, ollama_client, OLLAMA_MODEL_NAME
+def invoke_chat_graph(full_langchain_history: list[BaseMessage], thread_id: str = None, request_id: str = None,
+                      memory_scope: dict = None) -> str:
+    """Run the graph and return the AI reply. Raises GenerationCancelled if request_id is cancelled.
+
+    memory_scope ({'segments', 'recent_from'}, see memory.retrieve_context) tells retrieval
+    which stored rows are already in the history, so they aren't injected again.
+    """
+    global ACTIVE_PROVIDER, gemini_model, ollama_hosts, OLLAMA_MODEL_NAME
 
     logger.info(f"⚙️ Invoking chat graph with provider: {ACTIVE_PROVIDER}")
     logger.info(f"📝 Message history length: {len(full_langchain_history)}")
@@ -368,11 +502,14 @@ def invoke_chat_graph(full_langchain_history: list[BaseMessage]) -> str:
     if ACTIVE_PROVIDER == "gemini" and (not GEMINI_API_KEY or not gemini_model):
         logger.error("Cannot invoke chat graph with Gemini: API_KEY or model not configured.")
         return "Error: Gemini AI service is not configured. Please check API key and model settings."
-    elif ACTIVE_PROVIDER == "ollama" and (not ollama_client or not OLLAMA_MODEL_NAME):
+    elif ACTIVE_PROVIDER == "ollama" and (not ollama_hosts or not OLLAMA_MODEL_NAME):
         logger.error(f"Cannot invoke chat graph with Ollama: Client not init or model not set (Current: {OLLAMA_MODEL_NAME}).")
         return "Error: Ollama AI service is not configured. Please select a model and ensure Ollama is running."
+    elif ACTIVE_PROVIDER == "replay" and not replay_cassette:
+        logger.error(f"Cannot invoke chat graph with replay: cassette not loaded (Current: {REPLAY_CASSETTE_NAME}).")
+        return "Error: Replay provider is not configured. Please select a recorded cassette."
 
-    inputs = {"messages": full_langchain_history}
+    inputs = {"messages": full_langchain_history, "thread_id": thread_id, "request_id": request_id, "memory_context": None, "memory_scope": memory_scope}
     
     try:
         logger.info("🔄 Starting graph execution...")
@@ -399,10 +536,63 @@ def invoke_chat_graph(full_langchain_history: list[BaseMessage]) -> str:
             logger.error(f"Graph did not return expected messages. Final state: {final_graph_state}")
             return "Error: No response from AI after graph execution."
             
+    except GenerationCancelled:
+        logger.info("🛑 Graph execution stopped: request cancelled.")
+        raise
     except Exception as e:
         logger.error(f"Error during LangGraph invocation with {ACTIVE_PROVIDER}: {e}", exc_info=True)
         return f"An error occurred while communicating with the AI ({ACTIVE_PROVIDER}): {str(e)}"
 
+def generate_conversation_title(first_user_message: str, provider: str, model_name: str,
+                                api_key: str = None, max_words: int = 6) -> str | None:
+    """Ask the given provider for a short chat title. Returns None if it can't.
+
+    Runs as a background task, after other requests may have switched this process's
+    active provider, model and Gemini key, so it uses only what it is passed: Gemini gets
+    its own client for api_key instead of the process-wide genai.configure() one.
+    """
+    prompt = (
+        f"Write a short title (at most {max_words} words) for a conversation that starts with the message below. "
+        "Reply with the title only, no quotes or punctuation at the end.\n\n"
+        f"{first_user_message[:1000]}"
+    )
+
+    try:
+        if provider == "gemini" and api_key and model_name:
+            client = glm.GenerativeServiceClient(client_options={'api_key': api_key})
+            try:
+                response = client.generate_content(
+                    model=model_name if model_name.startswith('models/') else f"models/{model_name}",
+                    contents=[glm.Content(role='user', parts=[glm.Part(text=prompt)])],
+                )
+            finally:
+                client.transport.close()
+            title = ''.join(part.text for part in response.candidates[0].content.parts) if response.candidates else ''
+        elif provider == "ollama" and ollama_hosts and model_name:
+            with ollama_hosts.acquire(model_name) as host:
+                response = host.client.chat(
+                    model=model_name,
+                    messages=[{'role': 'user', 'content': prompt}],
+                    stream=False,
+                    options={'temperature': 0.2, 'num_predict': 24}
+                )
+            title = response.message.content
+        else:
+            return None
+    except Exception as e:
+        logger.warning(f"Title generation with {provider} failed: {e}")
+        return None
+
+    import re
+    # Drop any thinking blocks and keep the first non-empty line
+    title = re.sub(r'<think(?:ing)?>.*?</think(?:ing)?>', '', title or '', flags=re.DOTALL | re.IGNORECASE)
+    title = next((line.strip() for line in title.splitlines() if line.strip()), '')
+    title = title.strip('"\'`*# ').rstrip('.')
+    words = title.split()
+    if not words:
+        return None
+    return ' '.join(words[:max_words])
+
 # Renamed from reinitialize_model for clarity, though set_active_llm_provider is more descriptive
 # This function is kept for compatibility if app.py was calling reinitialize_model directly for Gemini.
 # It's better to use set_active_llm_provider from app.py.
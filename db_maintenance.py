@@ -0,0 +1,438 @@
+"""Schema migrations and online maintenance for the chat database.
+
+Migrations are versioned with PRAGMA user_version and only ever add to the schema.
+Maintenance (WAL checkpoints, incremental vacuum, ANALYZE and integrity checks) runs in
+the background while the app is idle, and can also be run from the command line:
+
+    python db_maintenance.py status
+    python db_maintenance.py run              # one maintenance pass now
+    python db_maintenance.py check            # full integrity_check
+    python db_maintenance.py vacuum           # full VACUUM (switches old files to incremental auto_vacuum)
+"""
+import os
+import sys
+import time
+import sqlite3
+import logging
+import argparse
+import datetime
+import threading
+from pathlib import Path
+
+import branching
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFAULT_DATABASE = Path(__file__).resolve().parent / 'chat_history.db'
+SCHEMA_FILE = Path(__file__).resolve().parent / 'schema.sql'
+
+
+# --- Schema Migrations ---
+# schema.sql always holds the current schema. Existing databases are upgraded by the
+# migrations below, in order, each in its own transaction together with the user_version
+# bump; schema.sql is then applied to them as well (every statement is IF NOT EXISTS), so
+# tables or indexes missing from an older or partial file are created. Append new
+# migrations (and update schema.sql to match); never edit, reorder or remove an existing one.
+def _create_maintenance_runs(conn):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS maintenance_runs ("
+        "task TEXT PRIMARY KEY, started_at REAL, finished_at REAL, duration REAL, result TEXT)"
+    )
+
+
+MIGRATIONS = [
+    (1, "branch columns on conversations", branching.ensure_branch_columns),
+    (2, "maintenance_runs table", _create_maintenance_runs),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def _has_table(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+
+def _table_names(conn):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    """Create the schema, or upgrade it to SCHEMA_VERSION. Safe to run from several processes at once."""
+    version = schema_version(conn)
+    if version > SCHEMA_VERSION:
+        logger.warning(f"Database schema version {version} is newer than this code ({SCHEMA_VERSION}).")
+        return version
+    if version == 0 and not _has_table(conn, 'conversations'):
+        # New database; schema.sql also turns on incremental auto_vacuum, which only
+        # takes effect before the first table is created
+        conn.executescript(SCHEMA_FILE.read_text())
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        logger.info(f"🗄️ Created database schema (version {SCHEMA_VERSION}).")
+        return SCHEMA_VERSION
+
+    for target, description, apply in MIGRATIONS:
+        if target <= version:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = schema_version(conn) # Another process may have migrated while we waited
+            if target > version:
+                apply(conn)
+                conn.execute(f"PRAGMA user_version = {target}")
+                version = target
+                logger.info(f"🗄️ Migrated database to schema version {target}: {description}.")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    # Columns the indexes in schema.sql refer to exist now, so it can fill in anything missing
+    tables_before = _table_names(conn)
+    conn.executescript(SCHEMA_FILE.read_text())
+    created = sorted(_table_names(conn) - tables_before)
+    if created:
+        logger.info(f"🗄️ Created missing tables: {', '.join(created)}.")
+    return version
+
+
+# --- Maintenance ---
+# A maintenance pass does a bounded amount of work, so it never holds the write lock for
+# long: a PASSIVE WAL checkpoint (TRUNCATE once the WAL is large), an incremental vacuum
+# of at most DB_VACUUM_PAGES_PER_RUN free pages, and PRAGMA optimize with ANALYZE limited
+# by DB_ANALYSIS_LIMIT. A quick_check runs less often (it reads the whole file, but
+# readers don't block the writer in WAL mode). Anything that finds the database busy
+# gives up and is retried next time. The one unbounded step, the full VACUUM that
+# switches an old file to incremental auto_vacuum, only runs in a pass started while the
+# worker is idle, and only for files up to DB_AUTO_VACUUM_CONVERT_MAX_MB.
+#
+# Each worker watches its own traffic and runs a pass once it has had no requests for
+# DB_MAINTENANCE_IDLE_SECONDS (or when a pass is long overdue), optionally only within
+# DB_MAINTENANCE_HOURS. Passes are claimed in the maintenance_runs table, so only one
+# worker does each one.
+DB_MAINTENANCE = os.getenv('DB_MAINTENANCE', '1') == '1'
+DB_MAINTENANCE_INTERVAL = float(os.getenv('DB_MAINTENANCE_INTERVAL', '3600'))
+DB_MAINTENANCE_IDLE_SECONDS = float(os.getenv('DB_MAINTENANCE_IDLE_SECONDS', '120'))
+DB_MAINTENANCE_HOURS = os.getenv('DB_MAINTENANCE_HOURS', '') # e.g. "2-6" (local time); empty means any hour
+DB_INTEGRITY_CHECK_INTERVAL = float(os.getenv('DB_INTEGRITY_CHECK_INTERVAL', '86400'))
+DB_VACUUM_PAGES_PER_RUN = int(os.getenv('DB_VACUUM_PAGES_PER_RUN', '2000'))
+DB_ANALYSIS_LIMIT = int(os.getenv('DB_ANALYSIS_LIMIT', '1000')) # Rows sampled per index by ANALYZE
+DB_WAL_TRUNCATE_MB = float(os.getenv('DB_WAL_TRUNCATE_MB', '64'))
+DB_AUTO_VACUUM_CONVERT_MAX_MB = float(os.getenv('DB_AUTO_VACUUM_CONVERT_MAX_MB', '16'))
+
+MAINTENANCE_BUSY_TIMEOUT = 2.0 # Seconds to wait for a lock before skipping a step
+MAINTENANCE_OVERDUE_FACTOR = 4 # Run anyway once a pass is this many intervals late, idle or not
+SCHEDULER_TICK = 60.0
+QUICK_CHECK_MAX_ERRORS = 10
+AUTO_VACUUM_MODES = {0: 'none', 1: 'full', 2: 'incremental'}
+
+
+def connect(database, busy_timeout=MAINTENANCE_BUSY_TIMEOUT):
+    conn = sqlite3.connect(database, timeout=busy_timeout)
+    conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+
+def _pragma(conn, name):
+    return conn.execute(f"PRAGMA {name}").fetchone()[0]
+
+
+def _wal_bytes(database):
+    try:
+        return os.path.getsize(f"{database}-wal")
+    except OSError:
+        return 0
+
+
+def checkpoint(conn, database):
+    """PASSIVE checkpoint; TRUNCATE (resetting the WAL file) once it has grown past DB_WAL_TRUNCATE_MB."""
+    mode = 'TRUNCATE' if _wal_bytes(database) > DB_WAL_TRUNCATE_MB * 1024 * 1024 else 'PASSIVE'
+    busy, log_frames, checkpointed = conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+    return {'mode': mode, 'busy': bool(busy), 'wal_frames': log_frames, 'checkpointed': checkpointed}
+
+
+def incremental_vacuum(conn, max_pages=None):
+    """Return up to max_pages free pages to the filesystem."""
+    max_pages = DB_VACUUM_PAGES_PER_RUN if max_pages is None else max_pages
+    if _pragma(conn, 'auto_vacuum') != 2:
+        return {'skipped': 'auto_vacuum is not incremental'}
+    free_before = _pragma(conn, 'freelist_count')
+    if free_before and max_pages > 0:
+        # executescript steps the pragma to completion; execute() would free a single page
+        conn.executescript(f"PRAGMA incremental_vacuum({int(max_pages)});")
+    free_after = _pragma(conn, 'freelist_count')
+    return {'freed_pages': free_before - free_after, 'free_pages': free_after}
+
+
+def optimize(conn):
+    """Refresh query planner statistics, sampling at most DB_ANALYSIS_LIMIT rows per index."""
+    conn.execute(f"PRAGMA analysis_limit = {int(DB_ANALYSIS_LIMIT)}")
+    if _has_table(conn, 'sqlite_stat1'):
+        conn.execute("PRAGMA optimize = 0x10002") # Check every table, not just ones this connection used
+        action = 'optimize'
+    else:
+        conn.execute("ANALYZE") # Never analyzed; optimize would leave it that way
+        action = 'analyze'
+    conn.commit()
+    return {'action': action}
+
+
+def convert_auto_vacuum(conn, database, max_mb=None):
+    """Switch a database created without incremental auto_vacuum over (needs one full VACUUM).
+
+    Skipped above max_mb, since VACUUM rewrites the whole file while blocking writers;
+    run `python db_maintenance.py vacuum` during downtime instead.
+    """
+    if _pragma(conn, 'auto_vacuum') == 2:
+        return None
+    size_mb = os.path.getsize(database) / (1024 * 1024)
+    max_mb = DB_AUTO_VACUUM_CONVERT_MAX_MB if max_mb is None else max_mb
+    if size_mb > max_mb:
+        return {'skipped': f"{size_mb:.0f} MB is over DB_AUTO_VACUUM_CONVERT_MAX_MB; run `python db_maintenance.py vacuum`"}
+    started = time.perf_counter()
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    logger.info(f"🧹 Switched {Path(database).name} to incremental auto_vacuum ({size_mb:.1f} MB in {time.perf_counter() - started:.1f}s).")
+    return {'converted': True, 'seconds': round(time.perf_counter() - started, 3)}
+
+
+def quick_check(conn, full=False):
+    """Returns (ok, problems). full runs integrity_check, which also verifies indexes against their tables."""
+    check = 'integrity_check' if full else 'quick_check'
+    rows = [row[0] for row in conn.execute(f"PRAGMA {check}({QUICK_CHECK_MAX_ERRORS})").fetchall()]
+    ok = rows == ['ok']
+    if not ok:
+        logger.error(f"❌ {check} found problems: {rows}")
+    return ok, [] if ok else rows
+
+
+def _run_step(results, name, fn, *args):
+    try:
+        results[name] = fn(*args)
+    except sqlite3.OperationalError as e:
+        # Usually "database is locked": leave it for the next pass
+        results[name] = {'error': str(e)}
+        logger.warning(f"⚠️ Maintenance step {name} skipped: {e}")
+
+
+def run_maintenance(database, idle=False):
+    """One bounded maintenance pass. Returns what each step did.
+
+    Only an idle pass may switch an old file over with a (small) full VACUUM.
+    """
+    started = time.perf_counter()
+    results = {}
+    conn = connect(database)
+    try:
+        _run_step(results, 'checkpoint', checkpoint, conn, database)
+        if idle:
+            _run_step(results, 'auto_vacuum', convert_auto_vacuum, conn, database)
+        _run_step(results, 'incremental_vacuum', incremental_vacuum, conn)
+        _run_step(results, 'optimize', optimize, conn)
+    finally:
+        conn.close()
+    results['seconds'] = round(time.perf_counter() - started, 3)
+    logger.info(f"🧹 Database maintenance done in {results['seconds']}s: {results}")
+    return results
+
+
+def run_integrity_check(database, idle=False):
+    conn = connect(database)
+    try:
+        started = time.perf_counter()
+        ok, problems = quick_check(conn)
+    finally:
+        conn.close()
+    return {'ok': ok, 'problems': problems, 'seconds': round(time.perf_counter() - started, 3)}
+
+
+def database_status(database):
+    conn = connect(database)
+    try:
+        status = {
+            'schema_version': schema_version(conn),
+            'page_size': _pragma(conn, 'page_size'),
+            'page_count': _pragma(conn, 'page_count'),
+            'free_pages': _pragma(conn, 'freelist_count'),
+            'auto_vacuum': AUTO_VACUUM_MODES.get(_pragma(conn, 'auto_vacuum')),
+            'journal_mode': _pragma(conn, 'journal_mode'),
+            'file_bytes': os.path.getsize(database),
+            'wal_bytes': _wal_bytes(database),
+            'runs': {},
+        }
+        if _has_table(conn, 'maintenance_runs'):
+            for task, started_at, finished_at, duration, result in conn.execute(
+                "SELECT task, started_at, finished_at, duration, result FROM maintenance_runs"
+            ):
+                status['runs'][task] = {'started_at': started_at, 'finished_at': finished_at, 'duration': duration, 'result': result}
+    finally:
+        conn.close()
+    return status
+
+
+# --- Scheduling ---
+def _claim(database, task, interval, now):
+    """Mark task as started if its last run is at least interval ago; only one caller wins."""
+    conn = connect(database)
+    try:
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO maintenance_runs (task) VALUES (?)", (task,))
+            claimed = conn.execute(
+                "UPDATE maintenance_runs SET started_at = ? WHERE task = ? AND (started_at IS NULL OR started_at <= ?)",
+                (now, task, now - interval)
+            ).rowcount == 1
+    finally:
+        conn.close()
+    return claimed
+
+
+def _record(database, task, started_at, summary):
+    conn = connect(database)
+    try:
+        with conn:
+            conn.execute(
+                "UPDATE maintenance_runs SET finished_at = ?, duration = ?, result = ? WHERE task = ?",
+                (time.time(), round(time.time() - started_at, 3), str(summary), task)
+            )
+    finally:
+        conn.close()
+
+
+def _parse_hours(spec):
+    if not spec:
+        return None
+    start, _, end = spec.partition('-')
+    return int(start) % 24, int(end or start) % 24
+
+
+def in_maintenance_hours(hour=None, spec=None):
+    hours = _parse_hours(DB_MAINTENANCE_HOURS if spec is None else spec)
+    if hours is None:
+        return True
+    hour = datetime.datetime.now().hour if hour is None else hour
+    start, end = hours
+    return start <= hour < end if start < end else hour >= start or hour < end # Windows may wrap midnight
+
+
+class MaintenanceScheduler:
+    def __init__(self, database):
+        self.database = database
+        self.last_request = time.monotonic()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def note_request(self):
+        self.last_request = time.monotonic()
+        self._ensure_thread()
+
+    def _ensure_thread(self):
+        # Started lazily so each forked worker process gets its own thread
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name='db-maintenance', daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(SCHEDULER_TICK)
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error(f"Database maintenance failed: {e}", exc_info=True)
+
+    def tick(self, force=False):
+        """Run whatever is due. Returns {task: result} for the tasks this process ran."""
+        now = time.time()
+        idle = time.monotonic() - self.last_request >= DB_MAINTENANCE_IDLE_SECONDS
+        ran = {}
+        for task, interval, run in (
+            ('maintenance', DB_MAINTENANCE_INTERVAL, run_maintenance),
+            ('integrity', DB_INTEGRITY_CHECK_INTERVAL, run_integrity_check),
+        ):
+            if not force:
+                if not in_maintenance_hours():
+                    break
+                # Not idle: only go ahead once the task is long overdue (the work is bounded anyway)
+                if not idle and not self._overdue(task, interval, now):
+                    continue
+            if not _claim(self.database, task, 0 if force else interval, now):
+                continue
+            summary = run(self.database, idle=idle and not force)
+            _record(self.database, task, now, summary)
+            ran[task] = summary
+        return ran
+
+    def _overdue(self, task, interval, now):
+        conn = connect(self.database)
+        try:
+            row = conn.execute("SELECT started_at FROM maintenance_runs WHERE task = ?", (task,)).fetchone()
+        finally:
+            conn.close()
+        last = row[0] if row and row[0] is not None else None
+        return last is None or now - last >= interval * MAINTENANCE_OVERDUE_FACTOR
+
+
+# --- Module State ---
+scheduler = None
+
+
+def init_maintenance(app, database):
+    """Create this app's scheduler and let it watch request traffic."""
+    global scheduler
+    scheduler = MaintenanceScheduler(database)
+    if DB_MAINTENANCE:
+        app.before_request(scheduler.note_request)
+        app.logger.info(f"🧹 Database maintenance every {DB_MAINTENANCE_INTERVAL:.0f}s when idle{f' (hours {DB_MAINTENANCE_HOURS})' if DB_MAINTENANCE_HOURS else ''}.")
+    return scheduler
+
+
+# --- Command line ---
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    parser = argparse.ArgumentParser(description="Migrate and maintain the chat database.")
+    parser.add_argument('--database', type=Path, default=DEFAULT_DATABASE, help="SQLite database (default: chat_history.db)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('status', help="Show size, free pages, schema version and last maintenance runs")
+    subparsers.add_parser('migrate', help="Create or upgrade the schema")
+    subparsers.add_parser('run', help="Run one maintenance pass now (never a full VACUUM)")
+    subparsers.add_parser('check', help="Run a full integrity_check")
+    subparsers.add_parser('vacuum', help="Full VACUUM; also switches the file to incremental auto_vacuum (stop the app first on large databases)")
+    args = parser.parse_args()
+
+    if args.command != 'migrate' and not args.database.exists():
+        logger.error(f"❌ {args.database} does not exist.")
+        sys.exit(1)
+    if args.command == 'status':
+        for key, value in database_status(args.database).items():
+            logger.info(f"{key}: {value}")
+    elif args.command == 'migrate':
+        conn = connect(args.database, busy_timeout=30)
+        try:
+            logger.info(f"✅ Schema version {migrate(conn)}.")
+        finally:
+            conn.close()
+    elif args.command == 'run':
+        run_maintenance(args.database)
+    elif args.command == 'check':
+        conn = connect(args.database, busy_timeout=30)
+        try:
+            ok, problems = quick_check(conn, full=True)
+        finally:
+            conn.close()
+        logger.info("✅ integrity_check ok." if ok else f"❌ integrity_check: {problems}")
+        sys.exit(0 if ok else 1)
+    elif args.command == 'vacuum':
+        conn = connect(args.database, busy_timeout=30)
+        try:
+            if convert_auto_vacuum(conn, args.database, max_mb=float('inf')) is None:
+                conn.execute("VACUUM")
+        finally:
+            conn.close()
+        logger.info(f"✅ Vacuumed {args.database}.")
+    sys.exit(0)
@@ -0,0 +1,44 @@
+# Gunicorn settings for running Magnus in production:
+#   gunicorn -c gunicorn.conf.py wsgi:application
+#
+# Every value can be overridden from the environment.
+import os
+import multiprocessing
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5001")
+
+# The active provider, model and Gemini API key are process-wide state in chat.py (and
+# genai.configure() is global to the process), and every request sets them from its
+# session. Two threads in one worker could therefore answer one user's request with
+# another user's provider, model or API key, so each worker handles one request at a time.
+# Requests mostly wait on Gemini/Ollama, so run more workers than cores for concurrency.
+# GUNICORN_THREADS > 1 is only safe when every user shares one provider, model and key.
+workers = int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv("GUNICORN_THREADS", "1"))
+worker_class = "gthread"
+
+# LLM calls can take well over gunicorn's 30s default
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "180"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+
+# Import the app once in the master: the database schema and WAL mode are set up
+# before any worker exists, so workers never race on init.
+preload_app = True
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+
+def post_fork(server, worker):
+    # Provider clients (HTTP connection pools, gRPC channels) must not be shared across
+    # forked processes, so each worker builds its own.
+    import chat
+    chat.initialize_llm_providers()
+
+
+def worker_exit(server, worker):
+    # Let queued post-response work (timestamps, titles) finish before the worker goes away
+    from tasks import task_queue
+    task_queue.shutdown()
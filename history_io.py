@@ -0,0 +1,256 @@
+"""Export and import conversation history as NDJSON.
+
+    python history_io.py export backup.ndjson          # or `-` for stdout
+    python history_io.py import backup.ndjson [--replace]
+
+The export is one JSON object per line: a header, then every conversation, then every
+message ordered by conversation and sequence. It is read from a single snapshot with
+incremental `fetchmany` calls, so memory use stays flat however large the database is.
+The same stream is served by the app at `/export`.
+
+The import streams the file back in with batched `executemany` inserts in large
+transactions. Secondary indexes are dropped first and rebuilt once at the end, which
+is much faster than updating them row by row. Rows whose ID already exists are skipped,
+or overwritten with `--replace`, so re-importing the same file is harmless.
+"""
+import re
+import sys
+import json
+import sqlite3
+import logging
+import argparse
+import datetime
+from pathlib import Path
+
+import db_maintenance
+
+try:
+    import orjson # Optional: faster line encoding/decoding
+except ImportError:
+    orjson = None
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFAULT_DATABASE = Path(__file__).resolve().parent / 'chat_history.db'
+
+EXPORT_FORMAT = 'chat-history'
+EXPORT_VERSION = 2 # 2 added the branch columns
+EXPORT_FETCH_ROWS = 1000 # Rows pulled from the cursor (and lines yielded) per step
+IMPORT_BATCH_ROWS = 10000 # Rows per executemany call
+IMPORT_COMMIT_ROWS = 200000 # Rows per transaction; bounds WAL growth on huge imports
+
+CONVERSATION_COLUMNS = ('id', 'title', 'icon', 'created_at', 'updated_at', 'is_pinned', 'parent_id', 'fork_sequence')
+MESSAGE_COLUMNS = ('id', 'conversation_id', 'sender_type', 'content', 'sequence', 'timestamp')
+
+
+def _dumps(record):
+    if orjson:
+        return orjson.dumps(record) + b'\n'
+    return (json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def _loads(line):
+    return orjson.loads(line) if orjson else json.loads(line)
+
+
+# --- Export ---
+def _stream_rows(conn, record_type, columns, query, params=()):
+    cursor = conn.execute(query, params)
+    while True:
+        rows = cursor.fetchmany(EXPORT_FETCH_ROWS)
+        if not rows:
+            return
+        yield b''.join(_dumps({'type': record_type, **dict(zip(columns, row))}) for row in rows)
+
+
+def _with_ancestors(conn, conversation_ids):
+    placeholders = ','.join('?' * len(conversation_ids))
+    rows = conn.execute(
+        "WITH RECURSIVE chain(id, parent_id) AS ("
+        f" SELECT id, parent_id FROM conversations WHERE id IN ({placeholders})"
+        " UNION SELECT c.id, c.parent_id FROM conversations c JOIN chain ON c.id = chain.parent_id"
+        ") SELECT id FROM chain",
+        tuple(conversation_ids)
+    ).fetchall()
+    return [row[0] for row in rows] or list(conversation_ids)
+
+
+def iter_export(get_connection, conversation_ids=None):
+    """Yield the NDJSON export in chunks of bytes. Owns (and closes) its connection."""
+    conn = get_connection()
+    conn.row_factory = None # Plain tuples; no per-row Row objects
+    try:
+        conn.execute("BEGIN") # Under WAL this pins one consistent snapshot for both queries
+        yield _dumps({
+            'type': 'header',
+            'format': EXPORT_FORMAT,
+            'version': EXPORT_VERSION,
+            'exported_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        })
+
+        where, params = '', ()
+        if conversation_ids:
+            # Branches need the conversations they inherit messages from
+            conversation_ids = _with_ancestors(conn, conversation_ids)
+            placeholders = ','.join('?' * len(conversation_ids))
+            params = tuple(conversation_ids)
+            where = f" WHERE id IN ({placeholders})"
+        yield from _stream_rows(
+            conn, 'conversation', CONVERSATION_COLUMNS,
+            f"SELECT {', '.join(CONVERSATION_COLUMNS)} FROM conversations{where} ORDER BY created_at, id", params
+        )
+        if where:
+            where = where.replace(' id IN', ' conversation_id IN')
+        # Ordered to match idx_messages_sequence, so SQLite walks the index instead of sorting
+        yield from _stream_rows(
+            conn, 'message', MESSAGE_COLUMNS,
+            f"SELECT {', '.join(MESSAGE_COLUMNS)} FROM messages{where} ORDER BY conversation_id, sequence", params
+        )
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def export_to_file(get_connection, output, conversation_ids=None):
+    count = 0
+    for chunk in iter_export(get_connection, conversation_ids):
+        output.write(chunk)
+        count += chunk.count(b'\n')
+    return count - 1 # Minus the header
+
+
+# --- Import ---
+def _secondary_indexes(conn):
+    return conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name IN ('conversations', 'messages') AND sql LIKE 'CREATE INDEX%'"
+    ).fetchall()
+
+
+def import_from_file(get_connection, input_file, replace=False, rebuild_indexes=True):
+    """Bulk-load an NDJSON export. Returns (conversations, messages) rows written."""
+    verb = 'INSERT OR REPLACE' if replace else 'INSERT OR IGNORE'
+    conversation_sql = f"{verb} INTO conversations ({', '.join(CONVERSATION_COLUMNS)}) VALUES ({', '.join('?' * len(CONVERSATION_COLUMNS))})"
+    message_sql = f"{verb} INTO messages ({', '.join(MESSAGE_COLUMNS)}) VALUES ({', '.join('?' * len(MESSAGE_COLUMNS))})"
+
+    conn = get_connection()
+    conn.row_factory = None
+    counts = {'conversation': 0, 'message': 0}
+    batches = {'conversation': [], 'message': []}
+    statements = {'conversation': conversation_sql, 'message': message_sql}
+    columns = {'conversation': CONVERSATION_COLUMNS, 'message': MESSAGE_COLUMNS}
+    rows_in_transaction = 0
+
+    def flush(record_type):
+        nonlocal rows_in_transaction
+        batch = batches[record_type]
+        if batch:
+            counts[record_type] += conn.executemany(statements[record_type], batch).rowcount
+            rows_in_transaction += len(batch)
+            batch.clear()
+
+    db_maintenance.migrate(conn) # Databases from older versions of the app
+    indexes = _secondary_indexes(conn) if rebuild_indexes else []
+    try:
+        conn.execute("BEGIN")
+        if replace and conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rendered_messages'").fetchone():
+            conn.execute("DELETE FROM rendered_messages") # Replaced messages may have new content; re-rendered on demand
+        for name, _ in indexes:
+            conn.execute(f'DROP INDEX IF EXISTS "{name}"')
+
+        for line_number, line in enumerate(input_file, start=1):
+            if not line.strip():
+                continue
+            record = _loads(line)
+            record_type = record.get('type')
+            if record_type == 'header':
+                if record.get('format') != EXPORT_FORMAT or record.get('version', 0) > EXPORT_VERSION:
+                    raise ValueError(f"Unsupported export format on line {line_number}: {record}")
+                continue
+            if record_type not in batches:
+                raise ValueError(f"Unknown record type on line {line_number}: {record_type!r}")
+
+            batches[record_type].append(tuple(record.get(column) for column in columns[record_type]))
+            if len(batches[record_type]) >= IMPORT_BATCH_ROWS:
+                flush(record_type)
+                if rows_in_transaction >= IMPORT_COMMIT_ROWS:
+                    conn.commit()
+                    conn.execute("BEGIN")
+                    rows_in_transaction = 0
+                    logger.info(f"... {counts['conversation']} conversations, {counts['message']} messages")
+
+        flush('conversation')
+        flush('message')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        # Put the indexes back even if the import failed part-way
+        if indexes:
+            logger.info(f"Rebuilding {len(indexes)} indexes...")
+            with conn:
+                for _, sql in indexes:
+                    conn.execute(re.sub(r'^CREATE INDEX (IF NOT EXISTS )?', 'CREATE INDEX IF NOT EXISTS ', sql))
+            conn.execute("ANALYZE")
+        conn.close()
+
+    return counts['conversation'], counts['message']
+
+
+# --- Command line ---
+def _connect_factory(database):
+    def connect():
+        conn = sqlite3.connect(database, timeout=30)
+        conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+    return connect
+
+
+def _ensure_schema(database):
+    created = not database.exists()
+    conn = sqlite3.connect(database)
+    try:
+        db_maintenance.migrate(conn)
+        conn.execute("PRAGMA journal_mode = WAL")
+    finally:
+        conn.close()
+    if created:
+        logger.info(f"Created {database}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    parser = argparse.ArgumentParser(description="Export or import conversation history as NDJSON.")
+    parser.add_argument('--database', type=Path, default=DEFAULT_DATABASE, help="SQLite database (default: chat_history.db)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help="Write all (or selected) conversations to NDJSON")
+    export_parser.add_argument('output', help="Output file, or - for stdout")
+    export_parser.add_argument('--conversation', action='append', dest='conversation_ids', help="Only export this conversation ID (repeatable)")
+    import_parser = subparsers.add_parser('import', help="Bulk-load an NDJSON export")
+    import_parser.add_argument('input', help="Input file, or - for stdin")
+    import_parser.add_argument('--replace', action='store_true', help="Overwrite rows whose ID already exists instead of skipping them")
+    import_parser.add_argument('--keep-indexes', action='store_true', help="Don't drop and rebuild indexes (slower, but the app's queries stay fast while it runs)")
+    args = parser.parse_args()
+
+    connect = _connect_factory(args.database)
+    if args.command == 'export':
+        if not args.database.exists():
+            logger.error(f"❌ {args.database} does not exist.")
+            sys.exit(1)
+        if args.output == '-':
+            written = export_to_file(connect, sys.stdout.buffer, args.conversation_ids)
+        else:
+            with open(args.output, 'wb') as f:
+                written = export_to_file(connect, f, args.conversation_ids)
+        logger.info(f"✅ Exported {written} records.")
+    elif args.command == 'import':
+        _ensure_schema(args.database)
+        if args.input == '-':
+            conversations, messages = import_from_file(connect, sys.stdin.buffer, args.replace, not args.keep_indexes)
+        else:
+            with open(args.input, 'rb') as f:
+                conversations, messages = import_from_file(connect, f, args.replace, not args.keep_indexes)
+        logger.info(f"✅ Imported {conversations} conversations and {messages} messages.")
+    sys.exit(0)
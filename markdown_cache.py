@@ -0,0 +1,165 @@
+import os
+import re
+import sqlite3
+import hashlib
+import logging
+
+try:
+    from markdown_it import MarkdownIt # Optional: server-side markdown rendering
+    import markdown_it
+except ImportError:
+    MarkdownIt = None
+try:
+    import nh3 # Optional: HTML sanitizer for the rendered markdown
+except ImportError:
+    nh3 = None
+
+import branching
+from tasks import submit_background_task
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# --- Rendered Markdown Cache ---
+# Stored messages never change, so AI replies are rendered to sanitized HTML once and
+# kept in the rendered_messages side table. /switch_chat and /chat_messages return that
+# HTML with each AI message, and the page only has to parse replies that aren't cached.
+# A message is rendered the first time it is read, or in the background right after
+# it is stored. Rows are keyed by RENDERER_VERSION, so changing the renderer options or
+# library versions re-renders everything lazily.
+#
+# Needs the optional markdown-it-py and nh3 packages; without them (or with
+# MARKDOWN_RENDER=0) messages are sent without HTML and the page parses them as before.
+MARKDOWN_RENDER_ENABLED = os.getenv('MARKDOWN_RENDER', '1') == '1' and MarkdownIt is not None and nh3 is not None
+RENDER_INLINE_LIMIT = int(os.getenv('MARKDOWN_RENDER_INLINE_LIMIT', '200')) # Per request; the rest is rendered in the background
+
+RENDERER_REVISION = 1 # Bump when the options below change
+RENDERER_VERSION = (
+    f"{RENDERER_REVISION}/markdown-it-py {markdown_it.__version__}/nh3 {nh3.__version__}"
+    if MARKDOWN_RENDER_ENABLED else None
+)
+# Short form of RENDERER_VERSION for conversation versions, so client caches of old HTML go stale too
+RENDERER_TAG = hashlib.sha1(RENDERER_VERSION.encode('utf-8')).hexdigest()[:8] if RENDERER_VERSION else None
+
+_ALIGN_STYLE = re.compile(r'^text-align:\s*(left|center|right)$')
+
+_markdown = None
+if MARKDOWN_RENDER_ENABLED:
+    # Same behaviour as the page's marked options: GFM tables and strikethrough, single
+    # newlines as <br>, smart quotes, inline HTML allowed (and then sanitized below)
+    _markdown = MarkdownIt('commonmark', {'breaks': True, 'html': True, 'typographer': True})
+    _markdown.enable(['table', 'strikethrough', 'replacements', 'smartquotes'])
+    _cleaner = nh3.Cleaner(
+        attributes={
+            **nh3.ALLOWED_ATTRIBUTES,
+            'code': {'class'}, # language-xyz on fenced code
+            'th': nh3.ALLOWED_ATTRIBUTES.get('th', set()) | {'style'},
+            'td': nh3.ALLOWED_ATTRIBUTES.get('td', set()) | {'style'},
+        },
+        attribute_filter=lambda element, attribute, value: (
+            value if attribute != 'style' or _ALIGN_STYLE.match(value) else None
+        ),
+    )
+
+
+def render_markdown(text):
+    """Markdown to sanitized HTML, as shown in an AI message bubble."""
+    return _cleaner.clean(_markdown.render(text))
+
+
+def init_markdown_cache(db_path):
+    if not MARKDOWN_RENDER_ENABLED:
+        logger.info("Server-side markdown rendering disabled; the page renders messages itself.")
+        return False
+    conn = sqlite3.connect(db_path, timeout=10)
+    try:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS rendered_messages ("
+            "message_id TEXT PRIMARY KEY, renderer_version TEXT NOT NULL, html TEXT NOT NULL)"
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    logger.info(f"📝 Caching rendered markdown ({RENDERER_VERSION}).")
+    return True
+
+
+def store_rendered(get_connection, rendered):
+    """Save [(message_id, html)] rendered with the current renderer."""
+    if not rendered:
+        return
+    conn = get_connection()
+    try:
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO rendered_messages (message_id, renderer_version, html) VALUES (?, ?, ?)",
+                [(message_id, RENDERER_VERSION, html) for message_id, html in rendered]
+            )
+    finally:
+        conn.close()
+
+
+def render_and_store(get_connection, messages):
+    """Render [(message_id, content)] and cache the HTML (run in the background)."""
+    store_rendered(get_connection, [(message_id, render_markdown(content)) for message_id, content in messages])
+
+
+def get_messages_with_html(get_connection, conversation_id, upto=None):
+    """A conversation's messages (including inherited ones) as {'type', 'content'} dicts, AI ones with their 'html'.
+
+    Cached HTML comes from the same query. Missing HTML is rendered here for the newest
+    RENDER_INLINE_LIMIT messages (the ones the page shows first); older ones are rendered
+    in the background and sent without HTML this time, so the page parses them itself.
+    """
+    conn = get_connection()
+    try:
+        where, params = branching.history_filter(branching.get_history_segments(conn, conversation_id, upto), prefix='m.')
+        rows = conn.execute(
+            "SELECT m.id, m.sender_type, m.content, r.html FROM messages m "
+            "LEFT JOIN rendered_messages r ON r.message_id = m.id AND r.renderer_version = ? "
+            f"WHERE {where} ORDER BY m.sequence ASC",
+            (RENDERER_VERSION, *params)
+        ).fetchall()
+    finally:
+        conn.close()
+
+    messages = []
+    missing = [] # (index, message_id, content) of AI messages without current HTML
+    for row in rows:
+        message = {'type': row[1], 'content': row[2]}
+        if row[1] == 'ai':
+            if row[3] is not None:
+                message['html'] = row[3]
+            else:
+                missing.append((len(messages), row[0], row[2]))
+        messages.append(message)
+
+    if missing:
+        rendered = []
+        split = max(len(missing) - max(RENDER_INLINE_LIMIT, 0), 0)
+        deferred, inline = missing[:split], missing[split:]
+        for index, message_id, content in inline:
+            messages[index]['html'] = render_markdown(content)
+            rendered.append((message_id, messages[index]['html']))
+        # Saving is off the request path; a lost write just means rendering again next time
+        if rendered:
+            submit_background_task(store_rendered, get_connection, rendered)
+        if deferred:
+            submit_background_task(render_and_store, get_connection, [(message_id, content) for _, message_id, content in deferred])
+        logger.info(f"📝 Rendered {len(inline)} messages for {conversation_id}; {len(deferred)} more queued.")
+    return messages
+
+
+def forget_conversation(conn, conversation_id):
+    """Drop cached HTML for a conversation; call before its messages are deleted."""
+    if MARKDOWN_RENDER_ENABLED:
+        conn.execute(
+            "DELETE FROM rendered_messages WHERE message_id IN (SELECT id FROM messages WHERE conversation_id = ?)",
+            (conversation_id,)
+        )
+
+
+def clear(conn):
+    if MARKDOWN_RENDER_ENABLED:
+        conn.execute("DELETE FROM rendered_messages")
@@ -0,0 +1,371 @@
+import os
+import json
+import base64
+import fcntl
+import logging
+import threading
+from pathlib import Path
+
+import numpy as np
+
+import ollama_pool
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# --- Retrieval Memory Settings ---
+# Stored messages are embedded (in the background) with a local Ollama embedding model.
+# At chat time, the most relevant snippets from other conversations (and from older parts
+# of the current one) are added to the prompt, and only the recent tail of the thread is
+# replayed instead of the whole history.
+MEMORY_ENABLED = os.getenv('MEMORY_ENABLED', '0').lower() in ('1', 'true', 'yes')
+MEMORY_EMBEDDING_MODEL = os.getenv('MEMORY_EMBEDDING_MODEL', 'nomic-embed-text')
+MEMORY_TOP_K = int(os.getenv('MEMORY_TOP_K', '5'))
+MEMORY_MIN_SCORE = float(os.getenv('MEMORY_MIN_SCORE', '0.35'))
+MEMORY_RECENT_MESSAGES = int(os.getenv('MEMORY_RECENT_MESSAGES', '12'))
+MEMORY_QUERY_MESSAGES = 2 # Latest user messages embedded together as one batched query
+
+EMBED_BATCH_SIZE = 32
+EMBED_MAX_CHARS = 2000 # Input truncation for the embedding model
+SNIPPET_MAX_CHARS = 600 # What gets injected into the prompt per hit
+
+
+class VectorIndex:
+    """In-memory NumPy matrix of normalized embeddings, persisted as an append-only log.
+
+    The log is JSONL next to the database; each line is either an added row (metadata plus
+    the float32 vector in base64) or a 'forget' record for a deleted conversation. Every
+    batch is appended with a single write, so several worker processes can share the file;
+    each process picks up rows written by the others before it searches.
+    """
+
+    def __init__(self, log_path):
+        self.log_path = Path(log_path)
+        self._lock = threading.RLock()
+        self._reset()
+        self._read_new_records()
+
+    def _reset(self):
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._size = 0
+        self._meta = []
+        self._conversation_ids = np.zeros(0, dtype=object)
+        self._sequences = np.zeros(0, dtype=np.int64)
+        self._active = np.zeros(0, dtype=bool)
+        self._message_ids = set()
+        self._forgotten = set()
+        self._log_offset = 0
+
+    def __len__(self):
+        with self._lock:
+            return int(self._active[:self._size].sum())
+
+    def has_message(self, message_id):
+        with self._lock:
+            return message_id in self._message_ids
+
+    def refresh(self):
+        """Pick up rows other processes appended since this one last read the log."""
+        with self._lock:
+            self._read_new_records()
+
+    # --- Persistence ---
+    def _read_new_records(self):
+        """Load records appended to the log (by any process) since the last read."""
+        try:
+            if self.log_path.stat().st_size < self._log_offset:
+                self._reset() # Log was cleared or compacted by another process
+            with open(self.log_path, 'rb') as f:
+                f.seek(self._log_offset)
+                chunk = f.read()
+        except FileNotFoundError:
+            if self._log_offset:
+                self._reset()
+            return
+
+        end = chunk.rfind(b'\n') + 1 # Ignore a partially written last line
+        if end == 0:
+            return
+        self._log_offset += end
+
+        rows, vectors = [], []
+        for line in chunk[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.warning("Skipping corrupt line in vector index log.")
+                continue
+            if 'forget' in record:
+                self._apply_forget(record['forget'])
+            else:
+                rows.append(record)
+                vectors.append(np.frombuffer(base64.b64decode(record.pop('vector')), dtype=np.float32))
+        if rows:
+            self._append_rows(rows, np.vstack(vectors))
+
+    def _append_to_log(self, records):
+        self.log_path.parent.mkdir(parents=True, exist_ok=True)
+        payload = ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records).encode('utf-8')
+        fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, payload)
+        finally:
+            os.close(fd)
+
+    # --- In-memory state ---
+    def _append_rows(self, rows, vectors):
+        batch_ids = set()
+        keep = []
+        for i, row in enumerate(rows):
+            if row['message_id'] not in self._message_ids and row['message_id'] not in batch_ids:
+                batch_ids.add(row['message_id'])
+                keep.append(i)
+        if len(keep) < len(rows):
+            rows, vectors = [rows[i] for i in keep], vectors[keep]
+        if not rows:
+            return
+        count, dim = vectors.shape
+        if self._size and dim != self._vectors.shape[1]:
+            logger.error(f"Embedding dimension changed ({self._vectors.shape[1]} -> {dim}); clear the index after switching embedding models.")
+            return
+
+        needed = self._size + count
+        if needed > self._vectors.shape[0]:
+            # Grow geometrically so repeated appends stay amortized O(1)
+            capacity = max(needed, 2 * self._vectors.shape[0], 256)
+            grown = np.zeros((capacity, dim), dtype=np.float32)
+            if self._size:
+                grown[:self._size] = self._vectors[:self._size]
+            self._vectors = grown
+            self._conversation_ids = np.resize(self._conversation_ids, capacity)
+            self._sequences = np.resize(self._sequences, capacity)
+            self._active = np.resize(self._active, capacity)
+
+        sl = slice(self._size, needed)
+        self._vectors[sl] = vectors
+        self._conversation_ids[sl] = [row['conversation_id'] for row in rows]
+        self._sequences[sl] = [row['sequence'] for row in rows]
+        self._active[sl] = [row['conversation_id'] not in self._forgotten for row in rows]
+        self._meta.extend(rows)
+        self._message_ids.update(row['message_id'] for row in rows)
+        self._size = needed
+
+    def _apply_forget(self, conversation_id):
+        self._forgotten.add(conversation_id)
+        if self._size:
+            self._active[:self._size] &= self._conversation_ids[:self._size] != conversation_id
+
+    # --- Public API ---
+    def add(self, rows, vectors):
+        """rows: dicts with message_id, conversation_id, sequence, sender_type, text."""
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        records = []
+        for row, vector in zip(rows, vectors):
+            records.append({**row, 'vector': base64.b64encode(vector.tobytes()).decode('ascii')})
+        with self._lock:
+            self._append_to_log(records)
+            self._read_new_records() # Picks up our rows plus anything other processes appended
+
+    def forget_conversation(self, conversation_id):
+        with self._lock:
+            self._append_to_log([{'forget': conversation_id}])
+            self._read_new_records()
+
+    def clear(self):
+        with self._lock:
+            self.log_path.unlink(missing_ok=True)
+            self._reset()
+
+    def search(self, query_vectors, k, exclude=()):
+        """Top-k rows by cosine similarity to any of the query vectors.
+
+        exclude holds (conversation_id, from_sequence, to_sequence or None) ranges of rows to
+        skip (they are already in the prompt as recent history).
+        """
+        queries = _normalize(np.atleast_2d(np.asarray(query_vectors, dtype=np.float32)))
+        with self._lock:
+            self._read_new_records()
+            n = self._size
+            if n == 0 or k <= 0:
+                return []
+            if queries.shape[1] != self._vectors.shape[1]:
+                logger.error(f"Query dimension {queries.shape[1]} doesn't match index dimension {self._vectors.shape[1]}.")
+                return []
+            vectors = self._vectors[:n]
+            candidates = self._active[:n].copy()
+            for conversation_id, from_sequence, to_sequence in exclude:
+                excluded = (self._conversation_ids[:n] == conversation_id) & (self._sequences[:n] >= from_sequence)
+                if to_sequence is not None:
+                    excluded &= self._sequences[:n] <= to_sequence
+                candidates &= ~excluded
+            meta = self._meta
+
+        # One matrix product scores every query against every row; keep each row's best score
+        scores = (queries @ vectors.T).max(axis=0)
+        scores[~candidates] = -np.inf
+        k = min(k, int(candidates.sum()))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(meta[i], float(scores[i])) for i in top]
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+# --- Module State ---
+memory_index = None
+_backfill_started = False
+_backfill_guard = threading.Lock()
+
+
+def init_memory(database_path):
+    """Load (or create) the index persisted next to the chat database."""
+    global memory_index
+    if not MEMORY_ENABLED:
+        return None
+    database_path = Path(database_path)
+    memory_index = VectorIndex(database_path.with_name(f"{database_path.stem}.vectors.jsonl"))
+    logger.info(f"🧠 Retrieval memory enabled ({MEMORY_EMBEDDING_MODEL}); {len(memory_index)} messages indexed.")
+    return memory_index
+
+
+def embed_texts(texts):
+    """Embed a batch of texts with the local embedding model, one request per batch.
+
+    Always goes through the Ollama host pool, which chat.initialize_llm_providers creates in
+    every process (a single OLLAMA_HOST, or the default server, is a pool of one), so the
+    batches are spread over the hosts that have the model.
+    """
+    if ollama_pool.pool is None:
+        raise RuntimeError("Ollama host pool is not initialized; cannot embed.")
+    inputs = [t[:EMBED_MAX_CHARS] for t in texts]
+    with ollama_pool.pool.acquire(MEMORY_EMBEDDING_MODEL) as host:
+        response = host.client.embed(model=MEMORY_EMBEDDING_MODEL, input=inputs)
+    return np.asarray(response['embeddings'], dtype=np.float32)
+
+
+def index_messages(messages):
+    """Background task: embed and index messages (dicts with message_id, conversation_id,
+    sequence, sender_type, content) that aren't indexed yet."""
+    if memory_index is None:
+        return 0
+    pending = [m for m in messages if m['content'] and not memory_index.has_message(m['message_id'])]
+    for start in range(0, len(pending), EMBED_BATCH_SIZE):
+        batch = pending[start:start + EMBED_BATCH_SIZE]
+        vectors = embed_texts([m['content'] for m in batch])
+        rows = [{
+            'message_id': m['message_id'],
+            'conversation_id': m['conversation_id'],
+            'sequence': m['sequence'],
+            'sender_type': m['sender_type'],
+            'text': m['content'][:SNIPPET_MAX_CHARS],
+        } for m in batch]
+        memory_index.add(rows, vectors)
+    return len(pending)
+
+
+def start_backfill(get_connection):
+    """Queue the backfill once per process, from the first request the process serves.
+
+    Registered as a before_request hook rather than run at import, so a preloaded gunicorn
+    master (which never serves requests) doesn't start threads or embed before forking.
+    """
+    global _backfill_started
+    if memory_index is None or _backfill_started:
+        return
+    with _backfill_guard:
+        if _backfill_started:
+            return
+        _backfill_started = True
+    from tasks import submit_background_task
+    submit_background_task(backfill_index, get_connection)
+
+
+def backfill_index(get_connection):
+    """Background task: index stored messages that predate the index (or were missed).
+
+    Holds an exclusive lock file next to the index log, so when several workers start
+    together only one embeds the backlog; the others skip it.
+    """
+    if memory_index is None:
+        return
+    lock_file = open(memory_index.log_path.with_suffix('.backfill.lock'), 'w')
+    try:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info("🧠 Another worker is backfilling the retrieval index; skipping.")
+            return
+        memory_index.refresh() # Skip rows a previous backfill (in any process) already indexed
+        conn = get_connection()
+        try:
+            cursor = conn.execute("SELECT id, conversation_id, sequence, sender_type, content FROM messages ORDER BY conversation_id, sequence")
+            total = 0
+            while True:
+                rows = cursor.fetchmany(EMBED_BATCH_SIZE * 4)
+                if not rows:
+                    break
+                total += index_messages([
+                    {'message_id': r[0], 'conversation_id': r[1], 'sequence': r[2], 'sender_type': r[3], 'content': r[4]}
+                    for r in rows
+                ])
+        finally:
+            conn.close()
+    finally:
+        lock_file.close() # Releases the lock
+    if total:
+        logger.info(f"🧠 Backfilled {total} messages into the retrieval index.")
+
+
+def forget_conversation(conversation_id):
+    if memory_index is not None:
+        memory_index.forget_conversation(conversation_id)
+
+
+def clear_index():
+    if memory_index is not None:
+        memory_index.clear()
+
+
+def retrieve_context(query_texts, history_segments=(), recent_from=None, k=MEMORY_TOP_K):
+    """Return a prompt block with the most relevant stored snippets, or None.
+
+    history_segments are the (conversation_id, last sequence or None) pairs the thread's
+    stored history is read from (branching.get_history_segments): a branch's inherited
+    messages live under its ancestors' IDs. Rows from sequence recent_from on are sent
+    verbatim, so they are skipped in every segment; None means none of them are.
+    """
+    if memory_index is None or not query_texts or len(memory_index) == 0:
+        return None
+    try:
+        query_vectors = embed_texts(query_texts)
+    except Exception as e:
+        logger.warning(f"Memory retrieval skipped, embedding failed: {e}")
+        return None
+
+    exclude = []
+    if recent_from is not None:
+        exclude = [(segment_id, recent_from, upto) for segment_id, upto in history_segments if upto is None or upto >= recent_from]
+    hits = memory_index.search(query_vectors, k, exclude=exclude)
+    hits = [(row, score) for row, score in hits if score >= MEMORY_MIN_SCORE]
+    if not hits:
+        return None
+
+    logger.info(f"🧠 Retrieved {len(hits)} memory snippets (best score {hits[0][1]:.2f}).")
+    own = dict(history_segments) # conversation_id -> last inherited sequence (None: all of it)
+    lines = []
+    for row, score in hits:
+        speaker = 'User' if row['sender_type'] == 'human' else 'Assistant'
+        conversation_id = row['conversation_id']
+        in_thread = conversation_id in own and (own[conversation_id] is None or row['sequence'] <= own[conversation_id])
+        where = 'earlier in this conversation' if in_thread else 'another conversation'
+        lines.append(f"- ({where}) {speaker}: {row['text']}")
+    return "Relevant notes from past messages (use them only if they help):\n" + '\n'.join(lines)
@@ -0,0 +1,293 @@
+import os
+import time
+import uuid
+import random
+import hashlib
+import sqlite3
+import logging
+import threading
+import contextlib
+
+import httpx
+import ollama
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# --- Ollama Host Pool ---
+# Local-model traffic is spread over every Ollama server listed in OLLAMA_HOSTS
+# (comma-separated; falls back to OLLAMA_HOST, then Ollama's default). A background thread
+# checks each host's health and which models it has installed and loaded. Each request goes
+# to the healthy host with that model and the fewest requests in flight. A conversation
+# sticks to one host, so its KV cache stays warm, unless that host is clearly busier than
+# the others.
+#
+# Gunicorn runs many single-threaded workers, so routing state can't live in one process.
+# Requests in flight are recorded in a small SQLite table in the chat database (once the
+# app calls init_shared_load), and every worker counts them from there. A conversation's
+# host is chosen by rendezvous hashing of its thread ID over the candidate hosts, which
+# every worker computes the same way without sharing a map. Without the shared table
+# (batch.py, tests) the counts are this process's own.
+OLLAMA_HOSTS = [h.strip() for h in os.getenv('OLLAMA_HOSTS', os.getenv('OLLAMA_HOST', '')).split(',') if h.strip()]
+OLLAMA_HEALTH_INTERVAL = float(os.getenv('OLLAMA_HEALTH_INTERVAL', '15'))
+OLLAMA_HEALTH_TIMEOUT = 3.0
+AFFINITY_MAX_EXTRA_LOAD = 2 # Leave a conversation's host once it has this many more requests than the idlest host
+INFLIGHT_RECORD_TTL = 900 # Seconds after which an in-flight record (e.g. from a killed worker) is ignored
+MISSING_MODEL_REFRESH_INTERVAL = 5.0 # Min seconds between refreshes triggered by an unknown model
+
+
+def normalize_model_name(name):
+    return name if ':' in name else f"{name}:latest"
+
+
+class SharedHostLoad:
+    """Requests in flight per host, shared by every worker process through SQLite."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        conn = self._connect()
+        try:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS ollama_inflight ("
+                "token TEXT PRIMARY KEY, host TEXT NOT NULL, started_at REAL NOT NULL)"
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def counts(self):
+        """{host name: requests in flight across all workers}"""
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT host, COUNT(*) FROM ollama_inflight WHERE started_at > ? GROUP BY host",
+                (time.time() - INFLIGHT_RECORD_TTL,)
+            ).fetchall()
+        finally:
+            conn.close()
+        return dict(rows)
+
+    def start(self, host_name):
+        token = uuid.uuid4().hex
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("INSERT INTO ollama_inflight (token, host, started_at) VALUES (?, ?, ?)", (token, host_name, now))
+            conn.execute("DELETE FROM ollama_inflight WHERE started_at < ?", (now - INFLIGHT_RECORD_TTL,))
+            conn.commit()
+        finally:
+            conn.close()
+        return token
+
+    def finish(self, token):
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM ollama_inflight WHERE token = ?", (token,))
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def _rendezvous_score(affinity_key, host):
+    return hashlib.blake2b(f"{affinity_key}\0{host.name}".encode('utf-8'), digest_size=8).digest()
+
+
+class OllamaHost:
+    def __init__(self, host):
+        self.host = host # None means the ollama package's default
+        self.name = host or 'default'
+        self.client = ollama.Client(host=host) if host else ollama.Client()
+        self._probe_client = ollama.Client(host=host, timeout=OLLAMA_HEALTH_TIMEOUT) if host else ollama.Client(timeout=OLLAMA_HEALTH_TIMEOUT)
+        self.healthy = None # Unknown until the first check
+        self.models = {} # Installed models: normalized name -> list() entry
+        self.loaded_models = set() # Models currently in memory (from ps())
+        self.outstanding = 0 # In this process
+        self.load = 0 # In all workers, as of the last routing decision (shared table), else outstanding
+        self.last_error = None
+        self.last_checked = None
+
+    def check(self):
+        try:
+            models = self._probe_client.list().models
+            try:
+                loaded = {normalize_model_name(m.model) for m in self._probe_client.ps().models}
+            except Exception:
+                loaded = set() # Older servers have no /api/ps
+        except Exception as e:
+            if self.healthy is not False:
+                logger.warning(f"⚠️ Ollama host {self.name} is unreachable: {e}")
+            self.healthy = False
+            self.last_error = str(e)
+        else:
+            if self.healthy is False:
+                logger.info(f"✅ Ollama host {self.name} is back.")
+            self.models = {normalize_model_name(m.model): m for m in models if getattr(m, 'model', None)}
+            self.loaded_models = loaded
+            self.healthy = True
+            self.last_error = None
+        self.last_checked = time.time()
+        return self.healthy
+
+    def has_model(self, model_name):
+        return normalize_model_name(model_name) in self.models
+
+    def status(self):
+        return {
+            'host': self.name,
+            'healthy': self.healthy,
+            'outstanding': self.outstanding,
+            'load': self.load,
+            'models': sorted(self.models),
+            'loaded_models': sorted(self.loaded_models),
+            'last_error': self.last_error,
+            'last_checked': self.last_checked,
+        }
+
+
+class OllamaHostPool:
+    def __init__(self, hosts):
+        self.hosts = [OllamaHost(h) for h in (hosts or [None])]
+        self._lock = threading.Lock()
+        self._monitor = None
+        self._last_missing_refresh = 0.0
+
+    # --- Health checks ---
+    def refresh(self):
+        """Check every host now (in parallel, so one slow host doesn't delay the rest)."""
+        checkers = [threading.Thread(target=h.check, daemon=True) for h in self.hosts]
+        for checker in checkers:
+            checker.start()
+        for checker in checkers:
+            checker.join(OLLAMA_HEALTH_TIMEOUT * 3)
+        return any(h.healthy for h in self.hosts)
+
+    def _ensure_monitor(self):
+        # Started lazily so each forked worker process gets its own monitor thread
+        with self._lock:
+            if self._monitor is not None and self._monitor.is_alive():
+                return
+            self._monitor = threading.Thread(target=self._monitor_loop, name='ollama-health', daemon=True)
+            self._monitor.start()
+
+    def _monitor_loop(self):
+        while True:
+            time.sleep(OLLAMA_HEALTH_INTERVAL)
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Ollama health check failed: {e}", exc_info=True)
+
+    # --- Model availability ---
+    def has_model(self, model_name):
+        """True if some healthy host has the model (refreshing once if nobody seems to)."""
+        if any(h.healthy and h.has_model(model_name) for h in self.hosts):
+            return True
+        now = time.monotonic()
+        if now - self._last_missing_refresh >= MISSING_MODEL_REFRESH_INTERVAL:
+            self._last_missing_refresh = now
+            self.refresh()
+        return any(h.healthy and h.has_model(model_name) for h in self.hosts)
+
+    def list_models(self, refresh=False):
+        """Every model on a healthy host: [(name, list() entry, [host names])]."""
+        if refresh:
+            self.refresh()
+        models = {}
+        for host in self.hosts:
+            if not host.healthy:
+                continue
+            for name, entry in host.models.items():
+                models.setdefault(name, (entry, []))[1].append(host.name)
+        return [(name, entry, host_names) for name, (entry, host_names) in sorted(models.items())]
+
+    def status(self):
+        return [h.status() for h in self.hosts]
+
+    # --- Routing ---
+    def _update_load(self):
+        """Set each host's load from the shared table, or this process's counts without one."""
+        counts = None
+        if shared_load is not None:
+            try:
+                counts = shared_load.counts()
+            except sqlite3.Error as e:
+                logger.warning(f"Shared Ollama load unavailable, routing on this worker's counts: {e}")
+        for host in self.hosts:
+            host.load = counts.get(host.name, 0) if counts is not None else host.outstanding
+
+    def _choose(self, model_name, affinity_key, exclude=()):
+        model_name = normalize_model_name(model_name) if model_name else None
+        hosts = [h for h in self.hosts if h not in exclude] or self.hosts
+        healthy = [h for h in hosts if h.healthy is not False]
+        candidates = [h for h in healthy if model_name is None or h.has_model(model_name)]
+        # Fall back to hosts whose models aren't known yet, then to anything at all
+        candidates = candidates or [h for h in healthy if not h.models] or healthy or hosts
+
+        least_load = min(h.load for h in candidates)
+        if affinity_key:
+            # Same key, same host, in every worker (and only keys of a removed host move)
+            preferred = max(candidates, key=lambda h: _rendezvous_score(affinity_key, h))
+            if preferred.load <= least_load + AFFINITY_MAX_EXTRA_LOAD:
+                return preferred
+        # Fewest requests in flight; prefer hosts that already have the model in memory
+        return min(candidates, key=lambda h: (h.load, model_name not in h.loaded_models, random.random()))
+
+    @contextlib.contextmanager
+    def acquire(self, model_name=None, affinity_key=None, exclude=()):
+        """Pick a host for one request and yield it; its in-flight count covers the block.
+
+        exclude lists hosts that already failed this request, for retrying elsewhere.
+        """
+        self._ensure_monitor()
+        with self._lock:
+            self._update_load()
+            host = self._choose(model_name, affinity_key, exclude)
+            host.outstanding += 1
+        token = None
+        if shared_load is not None:
+            try:
+                token = shared_load.start(host.name)
+            except sqlite3.Error as e:
+                logger.warning(f"Could not record Ollama request for {host.name}: {e}")
+        try:
+            yield host
+        except (ConnectionError, httpx.TransportError) as e:
+            # Take it out of rotation until the next health check says otherwise
+            logger.warning(f"⚠️ Ollama host {host.name} failed a request: {e}")
+            host.healthy = False
+            host.last_error = str(e)
+            raise
+        finally:
+            with self._lock:
+                host.outstanding -= 1
+            if token is not None:
+                try:
+                    shared_load.finish(token)
+                except sqlite3.Error as e:
+                    logger.warning(f"Could not clear Ollama request record for {host.name}: {e}")
+
+
+# --- Module State ---
+pool = None
+shared_load = None
+
+
+def init_shared_load(db_path):
+    """Count requests in flight across worker processes in this SQLite database."""
+    global shared_load
+    shared_load = SharedHostLoad(db_path)
+    return shared_load
+
+
+def init_pool(hosts=None):
+    """(Re)create the pool, e.g. after a fork, and run a first health check."""
+    global pool
+    pool = OllamaHostPool(hosts if hosts is not None else OLLAMA_HOSTS)
+    pool.refresh()
+    healthy = [h.name for h in pool.hosts if h.healthy]
+    logger.info(f"Ollama pool: {len(healthy)}/{len(pool.hosts)} hosts healthy ({', '.join(healthy) or 'none'})")
+    return pool
@@ -0,0 +1,173 @@
+import os
+import io
+import re
+import hmac
+import json
+import time
+import pstats
+import random
+import secrets
+import cProfile
+import logging
+import datetime
+from pathlib import Path
+
+from flask import request, g, jsonify, send_from_directory, abort
+
+from tasks import submit_background_task
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# --- On-Demand Request Profiling ---
+# A request is profiled with cProfile when it sends `X-Profile: 1` together with a valid
+# admin token, or when it is picked by PROFILE_SAMPLE_RATE. The last PROFILE_KEEP profiles
+# are written to PROFILE_DIR (shared by all workers) with their request metadata and can be
+# listed and downloaded from /admin/profiles. Unprofiled requests only pay for a header
+# lookup and, when sampling is on, one random() call.
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN') # Admin endpoints are disabled (404) when unset
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0')) # e.g. 0.01 profiles 1% of requests
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', '20'))
+PROFILE_DIR = Path(os.getenv('PROFILE_DIR', Path(__file__).resolve().parent / 'profiles'))
+
+PROFILE_HEADER = 'X-Profile'
+ADMIN_TOKEN_HEADER = 'X-Admin-Token'
+PROFILE_SUMMARY_ROWS = 15 # Hottest functions kept in the metadata
+PROFILE_TEXT_ROWS = 60 # Rows in the text report
+PROFILE_SORT_KEYS = ('cumulative', 'tottime', 'ncalls')
+
+# Endpoints that are never sampled (cheap static files and the profile endpoints themselves)
+_UNSAMPLED_ENDPOINTS = {'static', 'dist_asset', 'list_profiles', 'download_profile'}
+_PROFILE_ID_PATTERN = re.compile(r'^\d{8}T\d{6}-[0-9a-f]{8}$')
+
+
+def is_admin_request():
+    if not ADMIN_TOKEN:
+        return False
+    token = request.headers.get(ADMIN_TOKEN_HEADER, '')
+    return hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8'))
+
+
+def _profile_trigger():
+    if request.headers.get(PROFILE_HEADER):
+        return 'header' if is_admin_request() else None
+    if PROFILE_SAMPLE_RATE > 0 and request.endpoint not in _UNSAMPLED_ENDPOINTS and random.random() < PROFILE_SAMPLE_RATE:
+        return 'sampled'
+    return None
+
+
+def _start_profiling():
+    trigger = _profile_trigger()
+    if trigger is None:
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Python 3.12+ allows only one active cProfile at a time; skip this request
+        logger.info(f"Profiler busy, not profiling {request.path}")
+        return
+    g.profiler = profiler
+    g.profile_trigger = trigger
+    g.profile_id = f"{datetime.datetime.now(datetime.timezone.utc):%Y%m%dT%H%M%S}-{secrets.token_hex(4)}"
+    g.profile_started = time.perf_counter()
+
+
+def _tag_response(response):
+    if 'profile_id' in g:
+        response.headers['X-Profile-Id'] = g.profile_id
+        g.profile_status = response.status_code
+    return response
+
+
+def _finish_profiling(exc):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return
+    profiler.disable()
+    metadata = {
+        'id': g.profile_id,
+        'trigger': g.profile_trigger,
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': g.get('profile_status', 500 if exc else None),
+        'error': repr(exc) if exc else None,
+        'duration_ms': round((time.perf_counter() - g.profile_started) * 1000, 2),
+        'started_at': g.profile_id.split('-')[0],
+        'pid': os.getpid(),
+    }
+    # Dumping and summarizing takes a few ms, so do it off the request path
+    submit_background_task(save_profile, profiler, metadata)
+
+
+def _hot_functions(stats, limit):
+    rows = []
+    for (filename, line, name), (_, calls, own_time, cumulative_time, _) in stats.stats.items():
+        rows.append({
+            'function': f"{Path(filename).name}:{line}({name})",
+            'calls': calls,
+            'own_ms': round(own_time * 1000, 2),
+            'cumulative_ms': round(cumulative_time * 1000, 2),
+        })
+    rows.sort(key=lambda row: row['cumulative_ms'], reverse=True)
+    return rows[:limit]
+
+
+def save_profile(profiler, metadata):
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    profiler.dump_stats(PROFILE_DIR / f"{metadata['id']}.prof")
+    metadata['top'] = _hot_functions(pstats.Stats(profiler), PROFILE_SUMMARY_ROWS)
+    (PROFILE_DIR / f"{metadata['id']}.json").write_text(json.dumps(metadata, indent=2))
+    logger.info(f"🔬 Saved profile {metadata['id']} for {metadata['method']} {metadata['path']} ({metadata['duration_ms']} ms)")
+    _prune_profiles()
+
+
+def _prune_profiles():
+    # IDs start with a timestamp, so name order is age order
+    for old in sorted(PROFILE_DIR.glob('*.json'))[:-PROFILE_KEEP or None]:
+        old.unlink(missing_ok=True)
+        old.with_suffix('.prof').unlink(missing_ok=True)
+
+
+def list_profile_metadata():
+    if not PROFILE_DIR.exists():
+        return []
+    profiles = []
+    for path in sorted(PROFILE_DIR.glob('*.json'), reverse=True):
+        try:
+            profiles.append(json.loads(path.read_text()))
+        except (OSError, ValueError):
+            continue # Pruned or still being written by another worker
+    return profiles
+
+
+def init_profiling(app):
+    """Register the profiling request hooks and the admin endpoints."""
+    app.before_request(_start_profiling)
+    app.after_request(_tag_response)
+    app.teardown_request(_finish_profiling)
+    if PROFILE_SAMPLE_RATE > 0:
+        app.logger.info(f"Profiling {PROFILE_SAMPLE_RATE:.2%} of requests into {PROFILE_DIR}")
+
+    @app.route('/admin/profiles', methods=['GET'])
+    def list_profiles():
+        if not is_admin_request():
+            abort(404)
+        return jsonify({'profiles': list_profile_metadata()})
+
+    @app.route('/admin/profiles/<profile_id>', methods=['GET'])
+    def download_profile(profile_id):
+        """The raw cProfile dump (for snakeviz / pstats), or ?format=text for a report."""
+        if not is_admin_request() or not _PROFILE_ID_PATTERN.match(profile_id):
+            abort(404)
+        if not (PROFILE_DIR / f"{profile_id}.prof").is_file():
+            abort(404)
+        if request.args.get('format') == 'text':
+            report = io.StringIO()
+            stats = pstats.Stats(str(PROFILE_DIR / f"{profile_id}.prof"), stream=report)
+            sort_key = request.args.get('sort', 'cumulative')
+            stats.sort_stats(sort_key if sort_key in PROFILE_SORT_KEYS else 'cumulative').print_stats(PROFILE_TEXT_ROWS)
+            return report.getvalue(), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+        return send_from_directory(PROFILE_DIR, f"{profile_id}.prof", as_attachment=True, mimetype='application/octet-stream')
@@ -1,16 +1,22 @@
-DROP TABLE IF EXISTS messages;
-DROP TABLE IF EXISTS conversations;
+-- Schema for new databases. Existing ones are upgraded by the migrations in
+-- db_maintenance.py; keep the two in step.
 
-CREATE TABLE conversations (
+-- Free pages are returned to the filesystem by scheduled incremental vacuums.
+-- Only takes effect before the first table is created.
+PRAGMA auto_vacuum = INCREMENTAL;
+
+CREATE TABLE IF NOT EXISTS conversations (
     id TEXT PRIMARY KEY, -- UUID
     title TEXT NOT NULL,
     icon TEXT,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, -- Will be updated manually in app logic
-    is_pinned INTEGER DEFAULT 0 -- 0 for false, 1 for true
+    is_pinned INTEGER DEFAULT 0, -- 0 for false, 1 for true
+    parent_id TEXT REFERENCES conversations (id), -- Set for branches: the conversation this one was forked from
+    fork_sequence INTEGER -- Last message sequence inherited from parent_id
 );
 
-CREATE TABLE messages (
+CREATE TABLE IF NOT EXISTS messages (
     id TEXT PRIMARY KEY, -- UUID
     conversation_id TEXT NOT NULL,
     sender_type TEXT NOT NULL CHECK(sender_type IN ('human', 'ai')),
@@ -25,3 +31,13 @@ CREATE INDEX IF NOT EXISTS idx_messages_conversation_id ON messages (conversatio
 CREATE INDEX IF NOT EXISTS idx_messages_sequence ON messages (conversation_id, sequence);
 CREATE INDEX IF NOT EXISTS idx_conversations_updated_at ON conversations (updated_at);
 CREATE INDEX IF NOT EXISTS idx_conversations_is_pinned ON conversations (is_pinned); -- Index for pinned status
+CREATE INDEX IF NOT EXISTS idx_conversations_parent_id ON conversations (parent_id); -- Finding a conversation's branches
+
+-- Last run of each scheduled maintenance task (see db_maintenance.py)
+CREATE TABLE IF NOT EXISTS maintenance_runs (
+    task TEXT PRIMARY KEY,
+    started_at REAL,
+    finished_at REAL,
+    duration REAL,
+    result TEXT
+);
@@ -0,0 +1,155 @@
+import secrets
+import sqlite3
+import threading
+import time
+import logging
+
+from flask.sessions import SessionInterface, SessionMixin
+from flask.json.tag import TaggedJSONSerializer
+from werkzeug.datastructures import CallbackDict
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# --- Server-Side Sessions ---
+# The cookie only carries a random session ID; the session contents (active thread,
+# provider settings, API key, ...) live in a small SQLite database, so per-request
+# header bytes stay constant no matter how much is stored.
+
+PURGE_EVERY_N_SAVES = 200  # How often expired rows are swept
+# Expiry slides with activity: a session that is only read gets its expires_at pushed
+# forward at most this often, so active users stay signed in without a write per request
+SESSION_TOUCH_INTERVAL = 300
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False, expires_at=None):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.expires_at = expires_at # Stored expiry when the session was read
+        self.modified = False
+
+
+class SqliteSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._save_count = 0
+        self._lock = threading.Lock()
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode = WAL") # Several worker processes share this file
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions (expires_at)")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    @staticmethod
+    def _generate_sid():
+        return secrets.token_urlsafe(32)
+
+    def _lifetime_seconds(self, app):
+        return app.permanent_session_lifetime.total_seconds()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if not sid:
+            return ServerSideSession(sid=self._generate_sid(), new=True)
+
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT data, expires_at FROM sessions WHERE id = ? AND expires_at > ?", (sid, time.time())
+            ).fetchone()
+        finally:
+            conn.close()
+
+        if row is None:
+            # Unknown or expired ID: start fresh under a new ID rather than trusting the client's
+            return ServerSideSession(sid=self._generate_sid(), new=True)
+        try:
+            return ServerSideSession(self.serializer.loads(row[0]), sid=sid, expires_at=row[1])
+        except Exception as e:
+            logger.warning(f"Discarding unreadable session data: {e}")
+            return ServerSideSession(sid=self._generate_sid(), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified and not session.new:
+                conn = self._connect()
+                try:
+                    conn.execute("DELETE FROM sessions WHERE id = ?", (session.sid,))
+                    conn.commit()
+                finally:
+                    conn.close()
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        expires_at = time.time() + self._lifetime_seconds(app)
+
+        # Unmodified sessions are not rewritten, only their expiry is pushed forward now and then
+        if not session.modified and not session.new and not self.should_set_cookie(app, session):
+            if session.expires_at is not None and expires_at - session.expires_at >= SESSION_TOUCH_INTERVAL:
+                self._touch(session.sid, expires_at)
+            return
+
+        conn = self._connect()
+        try:
+            conn.execute(
+                "INSERT INTO sessions (id, data, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at",
+                (session.sid, self.serializer.dumps(dict(session)), expires_at)
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        self._maybe_purge_expired()
+
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+    def _touch(self, sid, expires_at):
+        conn = self._connect()
+        try:
+            conn.execute("UPDATE sessions SET expires_at = ? WHERE id = ?", (expires_at, sid))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _maybe_purge_expired(self):
+        with self._lock:
+            self._save_count += 1
+            if self._save_count % PURGE_EVERY_N_SAVES:
+                return
+        conn = self._connect()
+        try:
+            deleted = conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),)).rowcount
+            conn.commit()
+            if deleted:
+                logger.info(f"Purged {deleted} expired sessions.")
+        finally:
+            conn.close()
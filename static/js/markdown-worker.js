@@ -0,0 +1,38 @@
+// Markdown parsing worker: keeps marked.parse off the main thread so opening long
+// threads doesn't freeze the page. The page sends the marked script URL in an
+// 'init' message, then 'parse' messages with { id, text }.
+let markedReady = false;
+
+self.onmessage = function(event) {
+    const data = event.data;
+
+    if (data.type === 'init') {
+        try {
+            importScripts(data.markedUrl);
+            // Same options the page uses for GitHub Flavored Markdown
+            marked.setOptions({
+                gfm: true,
+                breaks: true,
+                sanitize: false, // Allow HTML
+                smartLists: true,
+                smartypants: true
+            });
+            markedReady = true;
+        } catch (error) {
+            self.postMessage({ type: 'init_error', error: String(error) });
+        }
+        return;
+    }
+
+    if (data.type === 'parse') {
+        if (!markedReady) {
+            self.postMessage({ type: 'parsed', id: data.id, error: 'marked not loaded' });
+            return;
+        }
+        try {
+            self.postMessage({ type: 'parsed', id: data.id, html: marked.parse(data.text) });
+        } catch (error) {
+            self.postMessage({ type: 'parsed', id: data.id, error: String(error) });
+        }
+    }
+};
@@ -334,6 +334,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 throw new Error(errData.error || 'Failed to delete chat.');
             }
             const data = await response.json();
+            forgetCachedConversation(thread_id);
             
             const wasActive = (thread_id === currentActiveThreadId);
             
@@ -404,49 +405,81 @@ document.addEventListener('DOMContentLoaded', function() {
     timestampDiv.textContent = getFormattedDate();
 
     // --- Message Management ---
-    function clearMessagesUI() {
-        while (messagesContainer.children.length > 1) {
-            if (messagesContainer.lastChild.classList.contains('message') || messagesContainer.lastChild.id === 'typing-indicator') {
-                messagesContainer.removeChild(messagesContainer.lastChild);
-            } else {
-                break; 
-            }
-        }
+    // The message list is virtualized: every message lives in `messageItems`, but only the
+    // ones near the viewport are mounted. Two spacer elements stand in for the rest, sized
+    // from measured heights (or an estimate for messages that were never mounted).
+    const MESSAGE_GAP_PX = 12; // Matches the .messages-container gap
+    const MESSAGE_OVERSCAN_PX = 800; // Extra pixels rendered above and below the viewport
+    const MESSAGE_BOTTOM_THRESHOLD_PX = 40;
+
+    let messageItems = [];
+    let nextMessageKey = 0;
+    let stickToBottom = false;
+    let messageRenderScheduled = false;
+    const mountedMessageNodes = new Map(); // message item -> element
+
+    const topMessageSpacer = document.createElement('div');
+    topMessageSpacer.className = 'messages-spacer';
+    topMessageSpacer.style.display = 'none';
+    const bottomMessageSpacer = document.createElement('div');
+    bottomMessageSpacer.className = 'messages-spacer';
+    bottomMessageSpacer.style.display = 'none';
+    timestampDiv.after(topMessageSpacer, bottomMessageSpacer);
+
+    function createMessageItem(text, isSent, thinkingContent = null, timeText = getCurrentTime()) {
+        return {
+            key: nextMessageKey++,
+            text: text,
+            isSent: isSent,
+            thinking: thinkingContent,
+            time: timeText,
+            html: null, // Rendered markdown for AI messages, filled in by the markdown worker
+            pending: false,
+            height: null
+        };
     }
 
-    function displayInitialAIMessage() {
-        // Remove the initial greeting message completely
-        // The function is kept empty to maintain code structure in case other initialization is needed later
+    function estimateMessageHeight(item) {
+        const lineCount = Math.ceil(item.text.length / 70) + (item.text.match(/\n/g) || []).length;
+        return 44 + lineCount * 22;
     }
 
-    function addMessage(text, isSent = true, thinkingContent = null) {
-        const messageDiv = document.createElement('div');
-        messageDiv.className = `message ${isSent ? 'sent' : 'received'}`;
-        
-        const timeText = getCurrentTime();
-        let messageHTML = '';
-        
-        // Process text content based on sender
-        let processedText = text;
-        if (!isSent) {
-            // For AI responses, parse markdown
-            // Configure marked with options for GitHub Flavored Markdown
-            marked.setOptions({
-                gfm: true,
-                breaks: true,
-                sanitize: false, // Allow HTML
-                smartLists: true,
-                smartypants: true
-            });
-            
-            processedText = marked.parse(text);
-        } else {
+    function getMessageHeight(item) {
+        return item.height !== null ? item.height : estimateMessageHeight(item);
+    }
+
+    function isMessagesScrolledToBottom() {
+        return messagesContainer.scrollHeight - messagesContainer.scrollTop - messagesContainer.clientHeight < MESSAGE_BOTTOM_THRESHOLD_PX;
+    }
+
+    function scheduleMessageRender() {
+        if (messageRenderScheduled) return;
+        messageRenderScheduled = true;
+        requestAnimationFrame(renderMessageWindow);
+    }
+
+    function scrollMessagesToBottom() {
+        stickToBottom = true;
+        renderMessageWindow();
+    }
+
+    function renderMessageBody(item) {
+        if (item.isSent) {
             // For user-sent messages, escape HTML but preserve line breaks
-            processedText = escapeHtml(text).replace(/\n/g, '<br>');
+            return escapeHtml(item.text).replace(/\n/g, '<br>');
         }
-        
-        if (thinkingContent && !isSent) {
-            messageHTML = `
+        // AI messages show escaped text until their markdown has been parsed
+        return item.html !== null ? item.html : escapeHtml(item.text).replace(/\n/g, '<br>');
+    }
+
+    function createMessageElement(item) {
+        const messageDiv = document.createElement('div');
+        messageDiv.className = `message ${item.isSent ? 'sent' : 'received'}`;
+        const pendingClass = !item.isSent && item.html === null ? ' markdown-pending' : '';
+        const processedText = renderMessageBody(item);
+
+        if (item.thinking && !item.isSent) {
+            messageDiv.innerHTML = `
                 <div class="message-bubble">
                     <div class="thinking-component">
                         <div class="thinking-header" onclick="toggleThinking(this)">
@@ -455,25 +488,264 @@ document.addEventListener('DOMContentLoaded', function() {
                             <i class="fa-solid fa-chevron-down thinking-toggle"></i>
                         </div>
                         <div class="thinking-content" style="display: none;">
-                            <div class="thinking-text">${thinkingContent.replace(/\n/g, '<br>')}</div>
+                            <div class="thinking-text">${item.thinking.replace(/\n/g, '<br>')}</div>
                         </div>
                     </div>
-                    <div class="message-text markdown-content">${processedText}</div>
+                    <div class="message-text markdown-content${pendingClass}">${processedText}</div>
                 </div>
-                <div class="message-time">${timeText}</div>
+                <div class="message-time">${item.time}</div>
             `;
         } else {
-            messageHTML = `
+            messageDiv.innerHTML = `
                 <div class="message-bubble">
-                    <div class="message-text ${!isSent ? 'markdown-content' : ''}">${processedText}</div>
+                    <div class="message-text ${!item.isSent ? 'markdown-content' : ''}${pendingClass}">${processedText}</div>
                 </div>
-                <div class="message-time">${timeText}</div>
+                <div class="message-time">${item.time}</div>
             `;
         }
-        
-        messageDiv.innerHTML = messageHTML;
-        messagesContainer.appendChild(messageDiv);
-        messagesContainer.scrollTop = messagesContainer.scrollHeight;
+        const actionsDiv = document.createElement('div');
+        actionsDiv.className = 'message-actions';
+        actionsDiv.innerHTML = item.isSent
+            ? '<button class="message-action" data-action="edit" title="Edit in a new branch"><i class="fa-solid fa-pen"></i></button>'
+            : '<button class="message-action" data-action="regenerate" title="Regenerate in a new branch"><i class="fa-solid fa-rotate-right"></i></button>';
+        messageDiv.appendChild(actionsDiv);
+        return messageDiv;
+    }
+
+    function renderMessageWindow() {
+        messageRenderScheduled = false;
+        const count = messageItems.length;
+        const pinToBottom = stickToBottom || (count > 0 && isMessagesScrolledToBottom());
+        stickToBottom = false;
+
+        if (count === 0) {
+            mountedMessageNodes.forEach(node => node.remove());
+            mountedMessageNodes.clear();
+            topMessageSpacer.style.display = 'none';
+            bottomMessageSpacer.style.display = 'none';
+            return;
+        }
+
+        // Remember where the first visible message sits so measuring doesn't make the view jump
+        let anchorItem = null;
+        let anchorTop = 0;
+        if (!pinToBottom) {
+            const containerTop = messagesContainer.getBoundingClientRect().top;
+            for (const [item, node] of mountedMessageNodes) {
+                const rect = node.getBoundingClientRect();
+                if (rect.bottom > containerTop && (anchorItem === null || rect.top < anchorTop)) {
+                    anchorItem = item;
+                    anchorTop = rect.top;
+                }
+            }
+        }
+
+        const offsets = new Array(count);
+        let totalHeight = 0;
+        for (let i = 0; i < count; i++) {
+            offsets[i] = totalHeight;
+            totalHeight += getMessageHeight(messageItems[i]) + MESSAGE_GAP_PX;
+        }
+
+        // Offsets are relative to the first message, which starts just below the date header
+        const listStart = timestampDiv.getBoundingClientRect().bottom - messagesContainer.getBoundingClientRect().top
+            + messagesContainer.scrollTop + MESSAGE_GAP_PX;
+        const viewportBottom = pinToBottom ? totalHeight : messagesContainer.scrollTop - listStart + messagesContainer.clientHeight;
+        const viewTop = viewportBottom - messagesContainer.clientHeight - MESSAGE_OVERSCAN_PX;
+        const viewBottom = viewportBottom + MESSAGE_OVERSCAN_PX;
+
+        let start = 0;
+        while (start < count - 1 && offsets[start] + getMessageHeight(messageItems[start]) < viewTop) start++;
+        let end = start;
+        while (end < count - 1 && offsets[end + 1] <= viewBottom) end++;
+
+        // Unmount messages that left the window, then mount/reorder the ones inside it
+        const wanted = new Set(messageItems.slice(start, end + 1));
+        mountedMessageNodes.forEach((node, item) => {
+            if (!wanted.has(item)) {
+                node.remove();
+                mountedMessageNodes.delete(item);
+            }
+        });
+
+        let previousNode = topMessageSpacer;
+        for (let i = start; i <= end; i++) {
+            const item = messageItems[i];
+            let node = mountedMessageNodes.get(item);
+            if (!node) {
+                node = createMessageElement(item);
+                mountedMessageNodes.set(item, node);
+            }
+            if (previousNode.nextSibling !== node) {
+                previousNode.after(node);
+            }
+            previousNode = node;
+            requestMarkdown(item);
+        }
+
+        let heightsChanged = false;
+        for (let i = start; i <= end; i++) {
+            const item = messageItems[i];
+            const measured = mountedMessageNodes.get(item).offsetHeight;
+            if (measured !== item.height) {
+                heightsChanged = heightsChanged || item.height !== null || Math.abs(measured - estimateMessageHeight(item)) > 1;
+                item.height = measured;
+            }
+        }
+
+        let hiddenAbove = 0;
+        for (let i = 0; i < start; i++) hiddenAbove += getMessageHeight(messageItems[i]) + MESSAGE_GAP_PX;
+        let hiddenBelow = 0;
+        for (let i = end + 1; i < count; i++) hiddenBelow += getMessageHeight(messageItems[i]) + MESSAGE_GAP_PX;
+
+        // A visible spacer adds one flex gap itself, so it is that much shorter
+        topMessageSpacer.style.display = start > 0 ? 'block' : 'none';
+        topMessageSpacer.style.height = `${Math.max(0, hiddenAbove - MESSAGE_GAP_PX)}px`;
+        bottomMessageSpacer.style.display = end < count - 1 ? 'block' : 'none';
+        bottomMessageSpacer.style.height = `${Math.max(0, hiddenBelow - MESSAGE_GAP_PX)}px`;
+
+        if (pinToBottom) {
+            messagesContainer.scrollTop = messagesContainer.scrollHeight;
+        } else if (anchorItem && mountedMessageNodes.has(anchorItem)) {
+            messagesContainer.scrollTop += mountedMessageNodes.get(anchorItem).getBoundingClientRect().top - anchorTop;
+        }
+
+        // Estimates were off: render again so the window still covers the viewport
+        if (heightsChanged) {
+            stickToBottom = pinToBottom;
+            scheduleMessageRender();
+        }
+    }
+
+    messagesContainer.addEventListener('scroll', scheduleMessageRender, { passive: true });
+    window.addEventListener('resize', () => {
+        // Widths changed, so every measured height is stale
+        messageItems.forEach(item => { item.height = null; });
+        scheduleMessageRender();
+    });
+
+    // --- Markdown Parsing (Web Worker) ---
+    // AI messages are parsed by static/js/markdown-worker.js so long threads don't block the
+    // main thread. If workers are unavailable, parsing falls back to marked on the page,
+    // still only for messages that are actually mounted.
+    const markdownRequests = new Map(); // message key -> message item
+    let markdownWorker = createMarkdownWorker();
+
+    function createMarkdownWorker() {
+        if (typeof Worker === 'undefined' || typeof markdownWorkerUrl === 'undefined') {
+            return null;
+        }
+        const markedScript = document.getElementById('marked-script');
+        if (!markedScript) {
+            return null;
+        }
+        try {
+            const worker = new Worker(markdownWorkerUrl);
+            worker.onmessage = handleMarkdownWorkerMessage;
+            worker.onerror = (event) => {
+                console.warn('Markdown worker failed, parsing on the main thread instead:', event.message);
+                disableMarkdownWorker();
+            };
+            worker.postMessage({ type: 'init', markedUrl: markedScript.src });
+            return worker;
+        } catch (error) {
+            console.warn('Could not start markdown worker:', error);
+            return null;
+        }
+    }
+
+    function disableMarkdownWorker() {
+        if (markdownWorker) {
+            markdownWorker.terminate();
+            markdownWorker = null;
+        }
+        // Parse anything still waiting on the worker here instead
+        const waiting = Array.from(markdownRequests.values());
+        markdownRequests.clear();
+        waiting.forEach(item => applyParsedMarkdown(item, parseMarkdownSync(item.text)));
+    }
+
+    function parseMarkdownSync(text) {
+        // Configure marked with options for GitHub Flavored Markdown
+        marked.setOptions({
+            gfm: true,
+            breaks: true,
+            sanitize: false, // Allow HTML
+            smartLists: true,
+            smartypants: true
+        });
+        return marked.parse(text);
+    }
+
+    function requestMarkdown(item) {
+        if (item.isSent || item.html !== null || item.pending) return;
+        if (!markdownWorker) {
+            applyParsedMarkdown(item, parseMarkdownSync(item.text));
+            return;
+        }
+        item.pending = true;
+        markdownRequests.set(item.key, item);
+        markdownWorker.postMessage({ type: 'parse', id: item.key, text: item.text });
+    }
+
+    function handleMarkdownWorkerMessage(event) {
+        const data = event.data;
+        if (data.type === 'init_error') {
+            console.warn('Markdown worker could not load marked:', data.error);
+            disableMarkdownWorker();
+            return;
+        }
+        const item = markdownRequests.get(data.id);
+        if (!item) return; // Chat was switched or cleared meanwhile
+        markdownRequests.delete(data.id);
+        applyParsedMarkdown(item, data.error ? parseMarkdownSync(item.text) : data.html);
+    }
+
+    function applyParsedMarkdown(item, html) {
+        item.html = html;
+        item.pending = false;
+        const node = mountedMessageNodes.get(item);
+        if (!node) return;
+        const textDiv = node.querySelector('.message-text');
+        textDiv.innerHTML = html;
+        textDiv.classList.remove('markdown-pending');
+        scheduleMessageRender(); // Height changed
+    }
+
+    function clearMessagesUI() {
+        messageItems = [];
+        markdownRequests.clear();
+        removeTypingIndicator();
+        renderMessageWindow();
+    }
+
+    function hasMessagesInUI() {
+        return messageItems.length > 0;
+    }
+
+    function displayInitialAIMessage() {
+        // Remove the initial greeting message completely
+        // The function is kept empty to maintain code structure in case other initialization is needed later
+    }
+
+    function addMessage(text, isSent = true, thinkingContent = null) {
+        messageItems.push(createMessageItem(text, isSent, thinkingContent));
+        scrollMessagesToBottom();
+    }
+
+    function setMessages(messages) {
+        // Replace the whole thread at once; only the visible tail gets mounted and parsed
+        messageItems = messages.map(msg => {
+            const item = createMessageItem(msg.content, msg.type === 'human', msg.thinking || null);
+            if (!item.isSent && msg.html) {
+                item.html = msg.html; // Already rendered and sanitized by the server
+            }
+            return item;
+        });
+        markdownRequests.clear();
+        mountedMessageNodes.forEach(node => node.remove());
+        mountedMessageNodes.clear();
+        scrollMessagesToBottom();
     }
 
     // Helper function to escape HTML
@@ -514,83 +786,519 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
 
-    // --- Sidebar Rendering ---
-    function renderSidebar(chatsFromServer, activeThreadIdToSet) {
-        chatListUL.innerHTML = '';
-        currentChats = chatsFromServer;
-        currentActiveThreadId = activeThreadIdToSet;
+    // --- Generation Cancellation ---
+    // Each /chat request carries an ID and an AbortController. Stopping aborts the fetch and
+    // posts the ID to /cancel so the server stops the provider call too, instead of finishing
+    // a generation nobody will read.
+    const stopButton = document.getElementById('stop-button');
+    const inFlightChatRequests = new Map(); // requestId -> AbortController
 
-        if (currentActiveThreadId === TEMP_NEW_CHAT_ID) {
-            const tempListItem = document.createElement('li');
-            tempListItem.className = 'chat-list-item active';
-            tempListItem.dataset.threadId = TEMP_NEW_CHAT_ID;
-            tempListItem.innerHTML = `
-                <span class="chat-item-icon">${NEW_CHAT_PLACEHOLDER_ICON_JS}</span>
-                <span class="chat-item-text">New Conversation</span>
-                <span class="chat-item-time">Now</span>
-                <div class="chat-item-options-button" style="display:none;">
-                    <i class="fa-solid fa-ellipsis-vertical"></i>
-                </div>`;
-            tempListItem.addEventListener('click', () => {
-                if (currentActiveThreadId !== TEMP_NEW_CHAT_ID) {
-                    handleSwitchChat(TEMP_NEW_CHAT_ID);
-                } else {
-                    userInput.focus();
-                }
-            });
-            chatListUL.appendChild(tempListItem);
+    function generateRequestId() {
+        if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+        return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+    }
+
+    function updateStopButton() {
+        if (stopButton) stopButton.classList.toggle('visible', inFlightChatRequests.size > 0);
+    }
+
+    function startChatRequest() {
+        const requestId = generateRequestId();
+        const controller = new AbortController();
+        inFlightChatRequests.set(requestId, controller);
+        updateStopButton();
+        return { requestId, signal: controller.signal };
+    }
+
+    function finishChatRequest(requestId) {
+        inFlightChatRequests.delete(requestId);
+        updateStopButton();
+    }
+
+    function sendCancel(requestId) {
+        const payload = JSON.stringify({ request_id: requestId });
+        // sendBeacon still goes out while the page unloads; fall back to a keepalive fetch
+        if (navigator.sendBeacon && navigator.sendBeacon('/cancel', new Blob([payload], { type: 'application/json' }))) return;
+        fetch('/cancel', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: payload,
+            keepalive: true,
+        }).catch(error => console.error('Error cancelling request:', error));
+    }
+
+    function cancelChatRequests() {
+        for (const [requestId, controller] of inFlightChatRequests) {
+            controller.abort();
+            sendCancel(requestId);
         }
+        inFlightChatRequests.clear();
+        updateStopButton();
+    }
 
-        currentChats.forEach(chat => {
-            const listItem = document.createElement('li');
-            listItem.className = 'chat-list-item';
-            listItem.dataset.threadId = chat.thread_id;
+    if (stopButton) {
+        stopButton.addEventListener('click', function() {
+            cancelChatRequests();
+            removeTypingIndicator();
+            userInput.focus();
+        });
+    }
+    window.addEventListener('pagehide', cancelChatRequests);
 
-            if (chat.thread_id === currentActiveThreadId && currentActiveThreadId !== TEMP_NEW_CHAT_ID) {
-                listItem.classList.add('active');
-            }
+    // --- Generated Titles ---
+    // With TITLE_GENERATION_MODE=llm a new chat first shows its word-based title; the
+    // generated one is written in the background, so the chat list is polled until it changes.
+    const TITLE_POLL_DELAYS_MS = [1500, 3000, 6000, 12000];
 
-            if (chat.is_pinned) {
-                listItem.classList.add('pinned');
+    async function pollForGeneratedTitle(threadId) {
+        const chat = currentChats.find(c => c.thread_id === threadId);
+        const initialTitle = chat ? chat.title : null;
+        for (const delay of TITLE_POLL_DELAYS_MS) {
+            await new Promise(resolve => setTimeout(resolve, delay));
+            try {
+                const response = await fetch('/chats');
+                if (!response.ok) return;
+                const data = await response.json();
+                const updated = data.chats.find(c => c.thread_id === threadId);
+                if (!updated) return; // Deleted meanwhile
+                if (updated.title !== initialTitle) {
+                    renderSidebar(data.chats, currentActiveThreadId);
+                    return;
+                }
+            } catch (error) {
+                return;
             }
+        }
+    }
+
+    // --- Branching ---
+    // Regenerating a reply or editing an earlier prompt never changes the thread: the server
+    // starts a branch that shares everything before that point and the page switches to it.
+    // Editing puts the prompt back in the input; the next send goes to /edit_message.
+    let pendingEdit = null; // { threadId, index, content } of the prompt being edited
+    const defaultInputPlaceholder = userInput.placeholder;
+
+    function startEdit(index, item) {
+        pendingEdit = { threadId: currentActiveThreadId, index: index, content: item.text };
+        userInput.value = item.text;
+        userInput.placeholder = 'Edit message (Esc to cancel)';
+        sendButton.classList.add('active');
+        userInput.focus();
+    }
+
+    function cancelEdit() {
+        if (!pendingEdit) return;
+        pendingEdit = null;
+        userInput.value = '';
+        userInput.placeholder = defaultInputPlaceholder;
+        sendButton.classList.remove('active');
+    }
+
+    function submitEdit(message) {
+        const edit = pendingEdit;
+        cancelEdit();
+        if (edit.threadId !== currentActiveThreadId) return; // Switched chats while editing
+        branchConversation('/edit_message', { thread_id: edit.threadId, index: edit.index, content: edit.content, message: message });
+    }
 
-            let timeDisplay = chat.time || '';
-            if (chat.thread_id === currentActiveThreadId && currentActiveThreadId !== TEMP_NEW_CHAT_ID) {
-                timeDisplay = chat.time || ''; 
+    async function branchConversation(endpoint, payload) {
+        const { requestId, signal } = startChatRequest();
+        try {
+            showTypingIndicator();
+            const response = await fetch(endpoint, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ ...payload, request_id: requestId }),
+                signal: signal,
+            });
+            const data = await response.json();
+            removeTypingIndicator();
+            if (data.cancelled) return;
+            if (data.error) {
+                addMessage(`Error: ${data.error}`, false);
+                return;
             }
+            currentChats = data.chats;
+            await handleSwitchChat(data.newly_created_thread_id);
+        } catch (error) {
+            removeTypingIndicator();
+            if (error.name === 'AbortError') return; // Stopped by the user
+            addMessage(`Sorry, there was an error communicating with the server.`, false);
+            console.error('Error:', error);
+        } finally {
+            finishChatRequest(requestId);
+        }
+    }
 
-            listItem.innerHTML = `
-                <span class="chat-item-icon">${chat.icon || '📄'}</span>
-                <span class="chat-item-text">${chat.title}</span>
-                <span class="chat-item-time">${timeDisplay}</span>
-                <div class="chat-item-options-button">
-                    <i class="fa-solid fa-ellipsis-vertical"></i>
-                </div>
-            `;
-            
-            listItem.addEventListener('click', (event) => {
-                if (!event.target.closest('.chat-item-options-button')) {
-                    handleSwitchChat(chat.thread_id);
+    // One delegated listener handles the action buttons of every message
+    messagesContainer.addEventListener('click', (event) => {
+        const button = event.target.closest('.message-action');
+        if (!button) return;
+        const messageNode = button.closest('.message');
+        const index = messageItems.findIndex(item => mountedMessageNodes.get(item) === messageNode);
+        if (index === -1 || currentActiveThreadId === TEMP_NEW_CHAT_ID || inFlightChatRequests.size > 0) return;
+        const item = messageItems[index];
+        if (button.dataset.action === 'edit') {
+            startEdit(index, item);
+        } else if (button.dataset.action === 'regenerate') {
+            branchConversation('/regenerate', { thread_id: currentActiveThreadId, index: index, content: item.text });
+        }
+    });
+
+    userInput.addEventListener('keydown', function(event) {
+        if (event.key === 'Escape' && pendingEdit) {
+            event.preventDefault();
+            cancelEdit();
+        }
+    });
+
+    // --- Conversation Cache ---
+    // Threads are cached in IndexedDB together with the server's version string (message
+    // count and last sequence). Switching to a cached thread renders it immediately, and
+    // /switch_chat only sends the messages again if that version changed. Pinned and recent
+    // threads are prefetched when the browser is idle, and any thread after a short hover.
+    const CONVERSATION_CACHE_DB = 'magnus-conversations';
+    const CONVERSATION_CACHE_DB_VERSION = 1; // Bump to discard caches written in an old format
+    const CONVERSATION_CACHE_STORE = 'conversations';
+    const CONVERSATION_CACHE_MAX_THREADS = 50;
+    const PREFETCH_PINNED_THREADS = 5;
+    const PREFETCH_RECENT_THREADS = 5;
+    const HOVER_PREFETCH_DELAY_MS = 150;
+    let conversationCacheDbPromise = null;
+    let switchChatCounter = 0; // Lets a slow /switch_chat response see it has been superseded
+    const pendingPrefetches = new Set();
+
+    function openConversationCache() {
+        if (!conversationCacheDbPromise) {
+            conversationCacheDbPromise = new Promise(resolve => {
+                if (!window.indexedDB) {
+                    resolve(null);
+                    return;
                 }
+                let request;
+                try {
+                    request = indexedDB.open(CONVERSATION_CACHE_DB, CONVERSATION_CACHE_DB_VERSION);
+                } catch (error) {
+                    console.warn('Conversation cache unavailable:', error);
+                    resolve(null);
+                    return;
+                }
+                request.onupgradeneeded = () => {
+                    const db = request.result;
+                    if (db.objectStoreNames.contains(CONVERSATION_CACHE_STORE)) {
+                        db.deleteObjectStore(CONVERSATION_CACHE_STORE);
+                    }
+                    const store = db.createObjectStore(CONVERSATION_CACHE_STORE, { keyPath: 'threadId' });
+                    store.createIndex('accessedAt', 'accessedAt');
+                };
+                request.onsuccess = () => {
+                    const db = request.result;
+                    db.onversionchange = () => db.close(); // Don't block a newer tab's upgrade
+                    resolve(db);
+                };
+                request.onerror = () => {
+                    console.warn('Conversation cache unavailable:', request.error);
+                    resolve(null);
+                };
+                request.onblocked = () => resolve(null);
             });
+        }
+        return conversationCacheDbPromise;
+    }
 
-            const optionsButton = listItem.querySelector('.chat-item-options-button');
-            if (optionsButton) {
-                optionsButton.addEventListener('click', (event) => {
-                    event.stopPropagation();
-                    const chatContext = { thread_id: chat.thread_id, title: chat.title, is_pinned: chat.is_pinned };
-                    if (globalOptionsMenu && globalOptionsMenu.classList.contains('visible') && currentOpenMenuChatContext && currentOpenMenuChatContext.thread_id === chat.thread_id) {
-                        hideGlobalOptionsMenu();
-                    } else {
-                        hideGlobalOptionsMenu();
-                        showGlobalOptionsMenu(chatContext, optionsButton);
-                    }
+    // Runs work(store, setResult) in one transaction and resolves with the result once it
+    // has committed. Every cache failure resolves to null: the cache is only an optimization.
+    function runCacheTransaction(mode, work) {
+        return openConversationCache().then(db => new Promise(resolve => {
+            if (!db) {
+                resolve(null);
+                return;
+            }
+            let result = null;
+            try {
+                const tx = db.transaction(CONVERSATION_CACHE_STORE, mode);
+                work(tx.objectStore(CONVERSATION_CACHE_STORE), value => { result = value; });
+                tx.oncomplete = () => resolve(result);
+                tx.onerror = () => resolve(null);
+                tx.onabort = () => resolve(null);
+            } catch (error) {
+                console.warn('Conversation cache error:', error);
+                resolve(null);
+            }
+        }));
+    }
+
+    function getCachedConversation(threadId) {
+        return runCacheTransaction('readwrite', (store, setResult) => {
+            const request = store.get(threadId);
+            request.onsuccess = () => {
+                const entry = request.result;
+                if (!entry) return;
+                entry.accessedAt = Date.now();
+                store.put(entry);
+                setResult(entry);
+            };
+        });
+    }
+
+    function getCachedVersions(threadIds) {
+        return runCacheTransaction('readonly', (store, setResult) => {
+            const versions = {};
+            setResult(versions);
+            threadIds.forEach(threadId => {
+                const request = store.get(threadId);
+                request.onsuccess = () => {
+                    if (request.result) versions[threadId] = request.result.version;
+                };
+            });
+        }).then(versions => versions || {});
+    }
+
+    function toCachedMessages(messages) {
+        return messages.map(msg => {
+            const cached = { type: msg.type, content: msg.content };
+            if (msg.html) cached.html = msg.html; // Server-rendered, so cached chats open without re-parsing
+            return cached;
+        });
+    }
+
+    function cacheConversation(threadId, version, messages) {
+        if (!version) return Promise.resolve(null);
+        const entry = { threadId: threadId, version: version, messages: toCachedMessages(messages), accessedAt: Date.now() };
+        return runCacheTransaction('readwrite', store => { store.put(entry); }).then(pruneConversationCache);
+    }
+
+    // Apply a finished chat turn to the cached copy if that copy was current, else drop it
+    function extendCachedConversation(threadId, baseVersion, version, newMessages) {
+        return runCacheTransaction('readwrite', store => {
+            const request = store.get(threadId);
+            request.onsuccess = () => {
+                const entry = request.result;
+                if (!entry && !baseVersion) {
+                    store.put({ threadId: threadId, version: version, messages: toCachedMessages(newMessages), accessedAt: Date.now() });
+                } else if (entry && baseVersion && entry.version === baseVersion) {
+                    entry.messages.push(...toCachedMessages(newMessages));
+                    entry.version = version;
+                    entry.accessedAt = Date.now();
+                    store.put(entry);
+                } else if (entry) {
+                    store.delete(threadId);
+                }
+            };
+        });
+    }
+
+    function forgetCachedConversation(threadId) {
+        return runCacheTransaction('readwrite', store => { store.delete(threadId); });
+    }
+
+    function clearConversationCache() {
+        return runCacheTransaction('readwrite', store => { store.clear(); });
+    }
+
+    function pruneConversationCache() {
+        return runCacheTransaction('readwrite', store => {
+            const countRequest = store.count();
+            countRequest.onsuccess = () => {
+                let excess = countRequest.result - CONVERSATION_CACHE_MAX_THREADS;
+                if (excess <= 0) return;
+                // Least recently opened threads go first
+                store.index('accessedAt').openCursor().onsuccess = event => {
+                    const cursor = event.target.result;
+                    if (!cursor || excess <= 0) return;
+                    cursor.delete();
+                    excess--;
+                    cursor.continue();
+                };
+            };
+        });
+    }
+
+    async function prefetchConversation(threadId) {
+        if (!threadId || threadId === TEMP_NEW_CHAT_ID || pendingPrefetches.has(threadId)) return;
+        pendingPrefetches.add(threadId);
+        try {
+            const response = await fetch(`/chat_messages/${encodeURIComponent(threadId)}`);
+            if (response.status === 404) {
+                await forgetCachedConversation(threadId);
+                return;
+            }
+            if (!response.ok) return;
+            const data = await response.json();
+            await cacheConversation(threadId, data.version, data.messages);
+        } catch (error) {
+            console.warn(`Prefetching chat ${threadId} failed:`, error);
+        } finally {
+            pendingPrefetches.delete(threadId);
+        }
+    }
+
+    async function prefetchRecentConversations() {
+        const pinned = currentChats.filter(chat => chat.is_pinned).slice(0, PREFETCH_PINNED_THREADS);
+        const recent = currentChats.filter(chat => !chat.is_pinned).slice(0, PREFETCH_RECENT_THREADS);
+        const threadIds = [...pinned, ...recent]
+            .map(chat => chat.thread_id)
+            .filter(threadId => threadId !== currentActiveThreadId);
+        if (threadIds.length === 0) return;
+
+        const cachedVersions = await getCachedVersions(threadIds);
+        const cachedThreadIds = threadIds.filter(threadId => cachedVersions[threadId]);
+        let serverVersions = {};
+        if (cachedThreadIds.length > 0) {
+            try {
+                const response = await fetch('/chat_versions', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ thread_ids: cachedThreadIds }),
                 });
+                if (!response.ok) return;
+                serverVersions = (await response.json()).versions || {};
+            } catch (error) {
+                console.warn('Checking cached chat versions failed:', error);
+                return;
+            }
+        }
+
+        // One at a time, so prefetching never competes with the user's own requests
+        for (const threadId of threadIds) {
+            if (cachedVersions[threadId] && cachedVersions[threadId] === serverVersions[threadId]) continue;
+            await prefetchConversation(threadId);
+        }
+    }
+
+    let hoverPrefetchTimer = null;
+    chatListUL.addEventListener('mouseover', (event) => {
+        const listItem = event.target.closest('.chat-list-item');
+        if (!listItem) return;
+        const threadId = listItem.dataset.threadId;
+        clearTimeout(hoverPrefetchTimer);
+        if (threadId === TEMP_NEW_CHAT_ID || threadId === currentActiveThreadId) return;
+        hoverPrefetchTimer = setTimeout(async () => {
+            const cachedVersions = await getCachedVersions([threadId]);
+            if (!cachedVersions[threadId]) prefetchConversation(threadId);
+        }, HOVER_PREFETCH_DELAY_MS);
+    });
+    chatListUL.addEventListener('mouseleave', () => clearTimeout(hoverPrefetchTimer));
+
+    // Runs after the initial chat has loaded
+    (window.requestIdleCallback || (callback => setTimeout(callback, 2000)))(() => prefetchRecentConversations());
+
+    function showConversationMessages(threadId, messages) {
+        setMessages(messages);
+        const userHistory = (messages || [])
+            .filter(msg => msg.type === 'human')
+            .map(msg => msg.content);
+        inputHistories[threadId] = userHistory;
+        historyIndex = userHistory.length;
+    }
+
+    // --- Sidebar Rendering ---
+    // Sidebar items are keyed by thread ID and reused between renders: only changed text
+    // and classes are touched, and items are moved only when their position changed.
+    function createChatListItem(threadId) {
+        const listItem = document.createElement('li');
+        listItem.className = 'chat-list-item';
+        listItem.dataset.threadId = threadId;
+        listItem.innerHTML = `
+            <span class="chat-item-icon"></span>
+            <span class="chat-item-text"></span>
+            <span class="chat-item-time"></span>
+            <div class="chat-item-options-button">
+                <i class="fa-solid fa-ellipsis-vertical"></i>
+            </div>
+        `;
+        return listItem;
+    }
+
+    function setTextIfChanged(element, text) {
+        if (element.textContent !== text) {
+            element.textContent = text;
+        }
+    }
+
+    function updateChatListItem(listItem, chat) {
+        const isPlaceholder = chat.thread_id === TEMP_NEW_CHAT_ID;
+        setTextIfChanged(listItem.querySelector('.chat-item-icon'), chat.icon || '📄');
+        setTextIfChanged(listItem.querySelector('.chat-item-text'), chat.title);
+        setTextIfChanged(listItem.querySelector('.chat-item-time'), chat.time || '');
+        listItem.classList.toggle('active', chat.thread_id === currentActiveThreadId);
+        listItem.classList.toggle('pinned', !!chat.is_pinned);
+
+        const optionsButton = listItem.querySelector('.chat-item-options-button');
+        const optionsDisplay = isPlaceholder ? 'none' : '';
+        if (optionsButton.style.display !== optionsDisplay) {
+            optionsButton.style.display = optionsDisplay;
+        }
+    }
+
+    function renderSidebar(chatsFromServer, activeThreadIdToSet) {
+        currentChats = chatsFromServer;
+        currentActiveThreadId = activeThreadIdToSet;
+
+        const rows = [];
+        if (currentActiveThreadId === TEMP_NEW_CHAT_ID) {
+            rows.push({ thread_id: TEMP_NEW_CHAT_ID, title: 'New Conversation', icon: NEW_CHAT_PLACEHOLDER_ICON_JS, time: 'Now', is_pinned: false });
+        }
+        rows.push(...currentChats);
+
+        const existingItems = new Map();
+        chatListUL.querySelectorAll('.chat-list-item').forEach(listItem => {
+            existingItems.set(listItem.dataset.threadId, listItem);
+        });
+
+        let previousItem = null;
+        rows.forEach(chat => {
+            let listItem = existingItems.get(chat.thread_id);
+            if (listItem) {
+                existingItems.delete(chat.thread_id);
+            } else {
+                listItem = createChatListItem(chat.thread_id);
+            }
+            updateChatListItem(listItem, chat);
+
+            const expectedNext = previousItem ? previousItem.nextSibling : chatListUL.firstChild;
+            if (listItem !== expectedNext) {
+                chatListUL.insertBefore(listItem, expectedNext);
             }
-            chatListUL.appendChild(listItem);
+            previousItem = listItem;
         });
+
+        existingItems.forEach(listItem => listItem.remove());
     }
 
+    // One delegated listener handles clicks for every sidebar item
+    chatListUL.addEventListener('click', (event) => {
+        const listItem = event.target.closest('.chat-list-item');
+        if (!listItem) return;
+        const threadId = listItem.dataset.threadId;
+
+        if (threadId === TEMP_NEW_CHAT_ID) {
+            if (currentActiveThreadId !== TEMP_NEW_CHAT_ID) {
+                handleSwitchChat(TEMP_NEW_CHAT_ID);
+            } else {
+                userInput.focus();
+            }
+            return;
+        }
+
+        const optionsButton = event.target.closest('.chat-item-options-button');
+        if (!optionsButton) {
+            handleSwitchChat(threadId);
+            return;
+        }
+
+        event.stopPropagation();
+        const chat = currentChats.find(c => c.thread_id === threadId);
+        if (!chat) return;
+        const chatContext = { thread_id: chat.thread_id, title: chat.title, is_pinned: chat.is_pinned };
+        if (globalOptionsMenu && globalOptionsMenu.classList.contains('visible') && currentOpenMenuChatContext && currentOpenMenuChatContext.thread_id === chat.thread_id) {
+            hideGlobalOptionsMenu();
+        } else {
+            hideGlobalOptionsMenu();
+            showGlobalOptionsMenu(chatContext, optionsButton);
+        }
+    });
+
     // Global click listener to close open menus when clicking outside
     document.addEventListener('click', function(event) {
         if (globalOptionsMenu && globalOptionsMenu.classList.contains('visible')) {
@@ -626,10 +1334,11 @@ document.addEventListener('DOMContentLoaded', function() {
         console.log(`handleSwitchChat called for threadId: ${threadId}. Current active global: ${currentActiveThreadId}`);
 
         if (threadId === TEMP_NEW_CHAT_ID) {
-            if (currentActiveThreadId === TEMP_NEW_CHAT_ID && messagesContainer.querySelector('.message')) {
+            if (currentActiveThreadId === TEMP_NEW_CHAT_ID && hasMessagesInUI()) {
                 userInput.focus();
                 return;
             }
+            switchChatCounter++; // Supersede any switch still waiting on the server
             clearMessagesUI();
             currentActiveThreadId = TEMP_NEW_CHAT_ID;
             renderSidebar(currentChats, TEMP_NEW_CHAT_ID);
@@ -637,7 +1346,7 @@ document.addEventListener('DOMContentLoaded', function() {
             return;
         }
 
-        const hasMessages = messagesContainer.querySelector('.message') !== null;
+        const hasMessages = hasMessagesInUI();
         if (threadId === currentActiveThreadId && hasMessages) {
             console.log("handleSwitchChat: Real chat already active and populated. Returning early.");
             document.querySelectorAll('.chat-list-item').forEach(item => item.classList.remove('active'));
@@ -647,12 +1356,22 @@ document.addEventListener('DOMContentLoaded', function() {
             return;
         }
         
+        // Show the cached copy right away; the server then confirms or replaces it
+        const switchToken = ++switchChatCounter;
+        const cached = await getCachedConversation(threadId);
+        if (switchToken !== switchChatCounter) return;
+        if (cached) {
+            showConversationMessages(threadId, cached.messages);
+            renderSidebar(currentChats, threadId);
+            userInput.focus();
+        }
+
         console.log("handleSwitchChat: Proceeding to fetch and update for REAL chat.");
         try {
             const response = await fetch('/switch_chat', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ thread_id: threadId }),
+                body: JSON.stringify({ thread_id: threadId, known_version: cached ? cached.version : null }),
             });
             if (!response.ok) {
                 const errData = await response.json();
@@ -662,41 +1381,42 @@ document.addEventListener('DOMContentLoaded', function() {
             }
             const data = await response.json();
             console.log("handleSwitchChat: Received data from /switch_chat:", data);
+            if (switchToken !== switchChatCounter) return; // A newer switch superseded this one
             
             currentActiveThreadId = data.active_thread_id;
             console.log(`handleSwitchChat: currentActiveThreadId updated to: ${currentActiveThreadId}`);
 
-            clearMessagesUI();
-            data.messages.forEach(msg => {
-                addMessage(msg.content, msg.type === 'human');
-            });
+            if (!data.not_modified) { // Otherwise the cached copy already on screen is current
+                showConversationMessages(threadId, data.messages);
+                if (data.version) {
+                    cacheConversation(threadId, data.version, data.messages);
+                } else {
+                    forgetCachedConversation(threadId);
+                }
 
-            if (data.messages.length === 0 && 
-                data.chats && data.chats.length > 0) {
-                const switchedToChat = data.chats.find(c => c.thread_id === threadId);
-                if (switchedToChat && switchedToChat.title === 'New Conversation') {
-                    console.log("handleSwitchChat: Switched to a real chat titled 'New Conversation' with no messages. No greeting displayed.");
+                if (data.messages.length === 0 && 
+                    data.chats && data.chats.length > 0) {
+                    const switchedToChat = data.chats.find(c => c.thread_id === threadId);
+                    if (switchedToChat && switchedToChat.title === 'New Conversation') {
+                        console.log("handleSwitchChat: Switched to a real chat titled 'New Conversation' with no messages. No greeting displayed.");
+                    }
                 }
             }
             
             renderSidebar(data.chats, data.active_thread_id || threadId);
 
-            const userHistory = (data.messages || [])
-                .filter(msg => msg.type === 'human')
-                .map(msg => msg.content);
-            inputHistories[threadId] = userHistory;
-            historyIndex = userHistory.length;
-
             userInput.focus();
 
         } catch (error) {
             console.error('Error switching chat:', error);
+            if (cached) return; // Keep showing the cached copy while offline
             addMessage('Error: Could not connect to server to switch chat.', false);
         }
     }
 
     // Function to send message to backend and get response
     async function sendMessage(message) {
+        const { requestId, signal } = startChatRequest();
         try {
             showTypingIndicator();
             
@@ -712,15 +1432,30 @@ document.addEventListener('DOMContentLoaded', function() {
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify({ message: message, thread_id: payloadThreadId }),
+                body: JSON.stringify({ message: message, thread_id: payloadThreadId, request_id: requestId }),
+                signal: signal,
             });
             
             const data = await response.json();
             removeTypingIndicator();
             
+            if (data.cancelled || data.error) {
+                // The server keeps the user's message, so the cached copy is now stale
+                if (payloadThreadId) forgetCachedConversation(payloadThreadId);
+            }
+            if (data.cancelled) {
+                return;
+            }
             if (data.error) {
                 addMessage(`Error: ${data.error}`, false);
             } else {
+                const turnThreadId = isPlaceholderChat ? data.newly_created_thread_id : payloadThreadId;
+                if (turnThreadId && data.version) {
+                    extendCachedConversation(turnThreadId, data.base_version, data.version, [
+                        { type: 'human', content: message },
+                        { type: 'ai', content: data.response },
+                    ]);
+                }
                 if (data.response) {
                     if (data.has_thinking && data.thinking) {
                         console.log('Adding message with thinking content:', data.thinking.substring(0, 100) + '...');
@@ -740,17 +1475,27 @@ document.addEventListener('DOMContentLoaded', function() {
                     currentActiveThreadId = data.active_thread_id;
                     renderSidebar(currentChats, currentActiveThreadId);
                 }
+                if (data.title_pending && data.active_thread_id) {
+                    pollForGeneratedTitle(data.active_thread_id);
+                }
             }
         } catch (error) {
             removeTypingIndicator();
+            if (error.name === 'AbortError') return; // Stopped by the user
             addMessage(`Sorry, there was an error communicating with the server.`, false);
             console.error('Error:', error);
+        } finally {
+            finishChatRequest(requestId);
         }
     }
     
     // Send message when button is clicked or Enter key is pressed
     function handleSendMessage() {
         const message = userInput.value.trim();
+        if (message && pendingEdit) {
+            submitEdit(message);
+            return;
+        }
         if (message) {
             if (!inputHistories[currentActiveThreadId]) inputHistories[currentActiveThreadId] = [];
             inputHistories[currentActiveThreadId].push(message);
@@ -1282,10 +2027,11 @@ document.addEventListener('DOMContentLoaded', function() {
         console.log(`handleSwitchChat called for threadId: ${threadId}. Current active global: ${currentActiveThreadId}`);
 
         if (threadId === TEMP_NEW_CHAT_ID) {
-            if (currentActiveThreadId === TEMP_NEW_CHAT_ID && messagesContainer.querySelector('.message')) {
+            if (currentActiveThreadId === TEMP_NEW_CHAT_ID && hasMessagesInUI()) {
                 userInput.focus();
                 return;
             }
+            switchChatCounter++; // Supersede any switch still waiting on the server
             clearMessagesUI();
             currentActiveThreadId = TEMP_NEW_CHAT_ID;
             renderSidebar(currentChats, TEMP_NEW_CHAT_ID);
@@ -1293,7 +2039,7 @@ document.addEventListener('DOMContentLoaded', function() {
             return;
         }
 
-        const hasMessages = messagesContainer.querySelector('.message') !== null;
+        const hasMessages = hasMessagesInUI();
         if (threadId === currentActiveThreadId && hasMessages) {
             console.log("handleSwitchChat: Real chat already active and populated. Returning early.");
             document.querySelectorAll('.chat-list-item').forEach(item => item.classList.remove('active'));
@@ -1303,12 +2049,22 @@ document.addEventListener('DOMContentLoaded', function() {
             return;
         }
         
+        // Show the cached copy right away; the server then confirms or replaces it
+        const switchToken = ++switchChatCounter;
+        const cached = await getCachedConversation(threadId);
+        if (switchToken !== switchChatCounter) return;
+        if (cached) {
+            showConversationMessages(threadId, cached.messages);
+            renderSidebar(currentChats, threadId);
+            userInput.focus();
+        }
+
         console.log("handleSwitchChat: Proceeding to fetch and update for REAL chat.");
         try {
             const response = await fetch('/switch_chat', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ thread_id: threadId }),
+                body: JSON.stringify({ thread_id: threadId, known_version: cached ? cached.version : null }),
             });
             if (!response.ok) {
                 const errData = await response.json();
@@ -1318,41 +2074,42 @@ document.addEventListener('DOMContentLoaded', function() {
             }
             const data = await response.json();
             console.log("handleSwitchChat: Received data from /switch_chat:", data);
+            if (switchToken !== switchChatCounter) return; // A newer switch superseded this one
             
             currentActiveThreadId = data.active_thread_id;
             console.log(`handleSwitchChat: currentActiveThreadId updated to: ${currentActiveThreadId}`);
 
-            clearMessagesUI();
-            data.messages.forEach(msg => {
-                addMessage(msg.content, msg.type === 'human');
-            });
+            if (!data.not_modified) { // Otherwise the cached copy already on screen is current
+                showConversationMessages(threadId, data.messages);
+                if (data.version) {
+                    cacheConversation(threadId, data.version, data.messages);
+                } else {
+                    forgetCachedConversation(threadId);
+                }
 
-            if (data.messages.length === 0 && 
-                data.chats && data.chats.length > 0) {
-                const switchedToChat = data.chats.find(c => c.thread_id === threadId);
-                if (switchedToChat && switchedToChat.title === 'New Conversation') {
-                    console.log("handleSwitchChat: Switched to a real chat titled 'New Conversation' with no messages. No greeting displayed.");
+                if (data.messages.length === 0 && 
+                    data.chats && data.chats.length > 0) {
+                    const switchedToChat = data.chats.find(c => c.thread_id === threadId);
+                    if (switchedToChat && switchedToChat.title === 'New Conversation') {
+                        console.log("handleSwitchChat: Switched to a real chat titled 'New Conversation' with no messages. No greeting displayed.");
+                    }
                 }
             }
             
             renderSidebar(data.chats, data.active_thread_id || threadId);
 
-            const userHistory = (data.messages || [])
-                .filter(msg => msg.type === 'human')
-                .map(msg => msg.content);
-            inputHistories[threadId] = userHistory;
-            historyIndex = userHistory.length;
-
             userInput.focus();
 
         } catch (error) {
             console.error('Error switching chat:', error);
+            if (cached) return; // Keep showing the cached copy while offline
             addMessage('Error: Could not connect to server to switch chat.', false);
         }
     }
 
     // --- Message sending and other functionality ---
     async function sendMessage(message) {
+        const { requestId, signal } = startChatRequest();
         try {
             showTypingIndicator();
             
@@ -1368,15 +2125,30 @@ document.addEventListener('DOMContentLoaded', function() {
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify({ message: message, thread_id: payloadThreadId }),
+                body: JSON.stringify({ message: message, thread_id: payloadThreadId, request_id: requestId }),
+                signal: signal,
             });
             
             const data = await response.json();
             removeTypingIndicator();
             
+            if (data.cancelled || data.error) {
+                // The server keeps the user's message, so the cached copy is now stale
+                if (payloadThreadId) forgetCachedConversation(payloadThreadId);
+            }
+            if (data.cancelled) {
+                return;
+            }
             if (data.error) {
                 addMessage(`Error: ${data.error}`, false);
             } else {
+                const turnThreadId = isPlaceholderChat ? data.newly_created_thread_id : payloadThreadId;
+                if (turnThreadId && data.version) {
+                    extendCachedConversation(turnThreadId, data.base_version, data.version, [
+                        { type: 'human', content: message },
+                        { type: 'ai', content: data.response },
+                    ]);
+                }
                 if (data.response) {
                     if (data.has_thinking && data.thinking) {
                         console.log('Adding message with thinking content:', data.thinking.substring(0, 100) + '...');
@@ -1396,16 +2168,26 @@ document.addEventListener('DOMContentLoaded', function() {
                     currentActiveThreadId = data.active_thread_id;
                     renderSidebar(currentChats, currentActiveThreadId);
                 }
+                if (data.title_pending && data.active_thread_id) {
+                    pollForGeneratedTitle(data.active_thread_id);
+                }
             }
         } catch (error) {
             removeTypingIndicator();
+            if (error.name === 'AbortError') return; // Stopped by the user
             addMessage(`Sorry, there was an error communicating with the server.`, false);
             console.error('Error:', error);
+        } finally {
+            finishChatRequest(requestId);
         }
     }
 
     function handleSendMessage() {
         const message = userInput.value.trim();
+        if (message && pendingEdit) {
+            submitEdit(message);
+            return;
+        }
         if (message) {
             if (!inputHistories[currentActiveThreadId]) inputHistories[currentActiveThreadId] = [];
             inputHistories[currentActiveThreadId].push(message);
@@ -1870,6 +2652,7 @@ document.addEventListener('DOMContentLoaded', function() {
             const data = await response.json();
             
             // Clear UI state
+            clearConversationCache();
             currentChats = [];
             currentActiveThreadId = TEMP_NEW_CHAT_ID;
             
@@ -2027,6 +2810,7 @@ document.addEventListener('DOMContentLoaded', function() {
             }
             
             // Clear UI state
+            clearConversationCache();
             currentChats = [];
             currentActiveThreadId = TEMP_NEW_CHAT_ID;
             
@@ -0,0 +1,98 @@
+import os
+import queue
+import threading
+import atexit
+import logging
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# --- Background Task Queue ---
+# Runs non-critical follow-up work (timestamp bumps, title generation, ...) off the
+# request path. The backlog is bounded so a slow database or LLM can't make memory
+# grow without limit; when it is full the task runs inline in the caller instead.
+BACKGROUND_WORKERS = int(os.getenv("BACKGROUND_WORKERS", "2"))
+BACKGROUND_MAX_BACKLOG = int(os.getenv("BACKGROUND_MAX_BACKLOG", "256"))
+BACKGROUND_DRAIN_TIMEOUT = float(os.getenv("BACKGROUND_DRAIN_TIMEOUT", "10"))
+
+_STOP = object()  # Sentinel telling a worker to exit
+
+
+class BackgroundTaskQueue:
+    def __init__(self, num_workers: int = BACKGROUND_WORKERS, max_backlog: int = BACKGROUND_MAX_BACKLOG):
+        self._queue = queue.Queue(maxsize=max_backlog)
+        self._num_workers = max(1, num_workers)
+        self._workers = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _ensure_workers(self):
+        # Workers are started lazily so forked server processes each get their own threads
+        with self._lock:
+            self._workers = [w for w in self._workers if w.is_alive()]
+            while len(self._workers) < self._num_workers:
+                worker = threading.Thread(target=self._worker_loop, name=f"bg-task-{len(self._workers)}", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def _worker_loop(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+                self._run(*item)
+            finally:
+                self._queue.task_done()
+
+    @staticmethod
+    def _run(fn, args, kwargs):
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            logger.error(f"❌ Background task {getattr(fn, '__name__', fn)} failed: {e}", exc_info=True)
+
+    def submit(self, fn, *args, **kwargs) -> bool:
+        """Queue fn(*args, **kwargs). Returns False if it had to run inline instead."""
+        if self._closed:
+            logger.warning(f"Task queue is shut down, running {fn.__name__} inline.")
+            self._run(fn, args, kwargs)
+            return False
+
+        self._ensure_workers()
+        try:
+            self._queue.put_nowait((fn, args, kwargs))
+            return True
+        except queue.Full:
+            logger.warning(f"⏳ Background backlog full ({self._queue.maxsize}), running {fn.__name__} inline.")
+            self._run(fn, args, kwargs)
+            return False
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def shutdown(self, timeout: float = BACKGROUND_DRAIN_TIMEOUT):
+        """Stop accepting work, let queued tasks finish and join the workers."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            workers = list(self._workers)
+
+        logger.info(f"Draining background task queue ({self.pending()} pending)...")
+        for _ in workers:
+            # Blocking put: sentinels queue up behind the remaining tasks
+            self._queue.put(_STOP)
+        for worker in workers:
+            worker.join(timeout=timeout)
+            if worker.is_alive():
+                logger.warning(f"Background worker {worker.name} did not finish within {timeout}s.")
+
+
+task_queue = BackgroundTaskQueue()
+atexit.register(task_queue.shutdown)
+
+
+def submit_background_task(fn, *args, **kwargs) -> bool:
+    return task_queue.submit(fn, *args, **kwargs)
@@ -0,0 +1,11 @@
+"""Production WSGI entry point.
+
+Run with gunicorn (see gunicorn.conf.py for worker sizing and per-worker setup):
+
+    gunicorn -c gunicorn.conf.py wsgi:application
+
+Any other WSGI server can load `wsgi:application` the same way.
+"""
+from app import app
+
+application = app